@@ -0,0 +1,240 @@
+"""Minimal in-process MQTT 3.1.1 broker for benchmarks.
+
+Supports what hub and simulated devices use: CONNECT with optional authentication callback, SUBSCRIBE with
+'+' and '#' wildcards and '$share/<group>/' subscriptions, PUBLISH with QoS 0, 1 and 2 from clients,
+retained messages, UNSUBSCRIBE, PINGREQ and DISCONNECT. Messages are delivered to subscribers with QoS 0,
+sessions aren't persisted. Client connections are announced on '$SYS/brokers/+/clients/+/connected' like EMQX does.
+"""
+import asyncio
+import itertools
+import json
+import struct
+from typing import Callable
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels) or (level != '+' and level != topic_levels[index]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value: str) -> bytes:
+    data = value.encode()
+    return struct.pack('!H', len(data)) + data
+
+
+def packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+class Session:
+    """Connected client"""
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        self.client_id = ''
+        self.subscriptions: set[str] = set()
+
+    def deliver(self, topic: str, payload: bytes, retain: bool = False) -> None:
+        if not self.writer.is_closing():
+            self.writer.write(packet(PUBLISH, int(retain), encode_string(topic) + payload))
+
+
+class Broker:
+    """Routes published messages to matching subscriptions of connected clients"""
+
+    def __init__(self, authenticate: Callable[[str, str], bool] | None = None) -> None:
+        """Create new broker
+
+            Args:
+                authenticate(Callable | None): Called with username and password, client is refused if it
+                returns False. Every client is accepted if None.
+        """
+        self.authenticate = authenticate
+        self.sessions: dict[str, Session] = {}
+        # Plain subscriptions: filter -> sessions, shared ones: (group, filter) -> sessions
+        self.subscriptions: dict[str, set[Session]] = {}
+        self.shared: dict[tuple[str, str], list[Session]] = {}
+        self._round_robin: dict[tuple[str, str], itertools.count] = {}
+        self.retained: dict[str, bytes] = {}
+        self.server: asyncio.Server | None = None
+        self.published = 0
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> int:
+        """Start listening.
+
+            Returns:
+                int: Port broker listens on.
+        """
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self.server.close()
+        for session in list(self.sessions.values()):
+            session.writer.close()
+        await self.server.wait_closed()
+
+    def publish(self, topic: str, payload: bytes, retain: bool = False) -> None:
+        self.published += 1
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for topic_filter, sessions in self.subscriptions.items():
+            if topic_matches(topic_filter, topic):
+                for session in sessions:
+                    session.deliver(topic, payload)
+        for key, sessions in self.shared.items():
+            if sessions and topic_matches(key[1], topic):
+                sessions[next(self._round_robin[key]) % len(sessions)].deliver(topic, payload)
+
+    def _subscribe(self, session: Session, topic_filter: str) -> None:
+        session.subscriptions.add(topic_filter)
+        if topic_filter.startswith('$share/'):
+            _, group, shared_filter = topic_filter.split('/', 2)
+            key = (group, shared_filter)
+            members = self.shared.setdefault(key, [])
+            if session not in members:
+                members.append(session)
+            self._round_robin.setdefault(key, itertools.count())
+            return
+        self.subscriptions.setdefault(topic_filter, set()).add(session)
+        for topic, payload in self.retained.items():
+            if topic_matches(topic_filter, topic):
+                session.deliver(topic, payload, retain=True)
+
+    def _unsubscribe(self, session: Session, topic_filter: str) -> None:
+        session.subscriptions.discard(topic_filter)
+        if topic_filter.startswith('$share/'):
+            _, group, shared_filter = topic_filter.split('/', 2)
+            members = self.shared.get((group, shared_filter), [])
+            if session in members:
+                members.remove(session)
+        else:
+            self.subscriptions.get(topic_filter, set()).discard(session)
+
+    def _drop(self, session: Session) -> None:
+        for topic_filter in list(session.subscriptions):
+            self._unsubscribe(session, topic_filter)
+        if self.sessions.get(session.client_id) is session:
+            del self.sessions[session.client_id]
+        session.writer.close()
+
+    @staticmethod
+    async def _read_packet(reader: asyncio.StreamReader) -> tuple[int, int, bytes]:
+        header = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0F, await reader.readexactly(length)
+
+    def _connect(self, session: Session, body: bytes) -> bool:
+        """Handle CONNECT, returns False if client is refused."""
+        offset = 2 + struct.unpack_from('!H', body)[0] + 1
+        flags = body[offset]
+        offset += 3
+        fields = []
+        while offset < len(body):
+            size = struct.unpack_from('!H', body, offset)[0]
+            fields.append(body[offset + 2:offset + 2 + size])
+            offset += 2 + size
+        session.client_id = fields.pop(0).decode()
+        if flags & 0x04:
+            # Will topic and message aren't used
+            fields = fields[2:]
+        username = fields.pop(0).decode() if flags & 0x80 else ''
+        password = fields.pop(0).decode() if flags & 0x40 else ''
+        if self.authenticate is not None and not self.authenticate(username, password):
+            session.writer.write(packet(CONNACK, 0, b'\x00\x05'))
+            return False
+        previous = self.sessions.get(session.client_id)
+        if previous is not None:
+            # Same client id takes over, like real broker does
+            self._drop(previous)
+        self.sessions[session.client_id] = session
+        session.writer.write(packet(CONNACK, 0, b'\x00\x00'))
+        self.publish(f'$SYS/brokers/fake/clients/{session.client_id}/connected',
+                     json.dumps({'clientid': session.client_id, 'username': username}).encode())
+        return True
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session = Session(writer)
+        # QoS 2 messages waiting for PUBREL by packet id
+        incomplete: dict[int, tuple[str, bytes, bool]] = {}
+        try:
+            packet_type, _, body = await self._read_packet(reader)
+            if packet_type != CONNECT or not self._connect(session, body):
+                return
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == PUBLISH:
+                    qos, retain = (flags >> 1) & 0x03, bool(flags & 0x01)
+                    size = struct.unpack_from('!H', body)[0]
+                    topic = body[2:2 + size].decode()
+                    offset = 2 + size
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                    payload = body[offset:]
+                    if qos == 2:
+                        incomplete[int.from_bytes(packet_id, 'big')] = (topic, payload, retain)
+                        writer.write(packet(PUBREC, 0, packet_id))
+                        continue
+                    if qos == 1:
+                        writer.write(packet(PUBACK, 0, packet_id))
+                    self.publish(topic, payload, retain)
+                elif packet_type == PUBREL:
+                    message = incomplete.pop(int.from_bytes(body[:2], 'big'), None)
+                    writer.write(packet(PUBCOMP, 0, body[:2]))
+                    if message is not None:
+                        self.publish(*message)
+                elif packet_type == SUBSCRIBE:
+                    packet_id, offset, granted = body[:2], 2, bytearray()
+                    topic_filters = []
+                    while offset < len(body):
+                        size = struct.unpack_from('!H', body, offset)[0]
+                        topic_filters.append(body[offset + 2:offset + 2 + size].decode())
+                        granted.append(min(body[offset + 2 + size], 2))
+                        offset += 3 + size
+                    writer.write(packet(SUBACK, 0, packet_id + bytes(granted)))
+                    for topic_filter in topic_filters:
+                        self._subscribe(session, topic_filter)
+                elif packet_type == UNSUBSCRIBE:
+                    packet_id, offset = body[:2], 2
+                    while offset < len(body):
+                        size = struct.unpack_from('!H', body, offset)[0]
+                        self._unsubscribe(session, body[offset + 2:offset + 2 + size].decode())
+                        offset += 2 + size
+                    writer.write(packet(UNSUBACK, 0, packet_id))
+                elif packet_type == PINGREQ:
+                    writer.write(packet(PINGRESP, 0, b''))
+                elif packet_type == DISCONNECT:
+                    return
+                # PUBACK, PUBREC and PUBCOMP from clients aren't expected, delivery is QoS 0
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._drop(session)
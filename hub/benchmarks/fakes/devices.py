@@ -0,0 +1,124 @@
+"""Simulated devices going through hub discovery, registration and answering MQTT commands."""
+import asyncio
+import json
+import threading
+import time
+import paho.mqtt.client as mqtt
+
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self) -> None:
+        self.replies: asyncio.Queue[bytes] = asyncio.Queue()
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+        self.replies.put_nowait(data)
+
+
+async def discover(port: int, timeout: float = 2) -> tuple[dict, float]:
+    """Send discovery request to hub and wait for reply.
+
+        Args:
+            port(int): Hub discovery port.
+            timeout(float): Seconds to wait for reply.
+
+        Returns:
+            tuple[dict, float]: Registration server address from reply and seconds reply took.
+    """
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(DiscoveryProtocol, remote_addr=('127.0.0.1', port))
+    try:
+        start = time.perf_counter()
+        transport.sendto(b'discover')
+        async with asyncio.timeout(timeout):
+            reply = await protocol.replies.get()
+        return json.loads(reply), time.perf_counter() - start
+    finally:
+        transport.close()
+
+
+def specification(index: int, device_type: str, fields: int) -> dict:
+    """Build device specification with several numeric fields and one switch."""
+    device_fields = [{'name': f'level{number}', 'type': 'int', 'value': 0, 'min': 0, 'max': 100}
+                     for number in range(fields - 1)]
+    device_fields.append({'name': 'power', 'type': 'bool', 'value': False})
+    return {'name': f'bench-{device_type}-{index}', 'type': device_type, 'fields': device_fields}
+
+
+class SimulatedDevice:
+    """Device registering itself in hub and confirming every received command"""
+
+    def __init__(self, index: int, device_type: str = 'device', fields: int = 4) -> None:
+        self.specification = specification(index, device_type, fields)
+        self.credentials: dict | None = None
+        self.client: mqtt.Client | None = None
+        self.commands = 0
+        self._connected = threading.Event()
+
+    @property
+    def id(self) -> str:
+        return self.credentials['clientid']
+
+    async def register(self, port: int, timeout: float = 30) -> float:
+        """Send specification to registration server, wait until operator approves it and confirm credentials.
+
+            Args:
+                port(int): Hub registration port.
+                timeout(float): Seconds to wait for credentials.
+
+            Returns:
+                float: Seconds from sending specification to receiving credentials.
+        """
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            start = time.perf_counter()
+            writer.write(json.dumps(self.specification).encode() + b'\n')
+            await writer.drain()
+            async with asyncio.timeout(timeout):
+                frame = await reader.readuntil(b'\n')
+            elapsed = time.perf_counter() - start
+            credentials = json.loads(frame)
+            if 'clientid' not in credentials:
+                raise RuntimeError(f'Registration refused: {credentials}')
+            writer.write(json.dumps({'status': True}).encode() + b'\n')
+            await writer.drain()
+            self.credentials = credentials
+            return elapsed
+        finally:
+            writer.close()
+
+    def connect(self, host: str, port: int, timeout: float = 10) -> None:
+        """Connect to broker with received credentials and start answering commands in paho thread."""
+        self.client = mqtt.Client(client_id=self.id)
+        self.client.username_pw_set(self.id, self.credentials['password'])
+        self.client.on_connect = self._on_connect
+        self.client.on_subscribe = self._on_subscribe
+        self.client.on_message = self._on_command
+        self.client.connect(host, port)
+        self.client.loop_start()
+        if not self._connected.wait(timeout):
+            raise RuntimeError(f'Device {self.id} is not connected to broker')
+
+    def disconnect(self) -> None:
+        if self.client is not None:
+            self.client.disconnect()
+            self.client.loop_stop()
+
+    def publish_telemetry(self, values: dict, timestamp: str | None = None) -> None:
+        payload = {'values': values} if timestamp is None else {'values': values, 'timestamp': timestamp}
+        self.client.publish(f'{self.credentials["topic"]}/publish', json.dumps(payload), qos=0)
+
+    def _on_connect(self, client, user_data, flags, rc):
+        client.subscribe(self.credentials['topic'], qos=0)
+
+    def _on_subscribe(self, client, user_data, mid, granted_qos):
+        self._connected.set()
+
+    def _on_command(self, client, user_data, message):
+        if not message.payload:
+            # Retained command cleared by hub
+            return
+        command = json.loads(message.payload)
+        self.commands += 1
+        confirmation = {'status': True, 'message': 'ok', 'correlation_id': command.get('correlation_id')}
+        client.publish(f'{self.credentials["topic"]}/publish', json.dumps(confirmation), qos=0)
@@ -0,0 +1,107 @@
+"""In-process stand-in for the part of EMQX v5 management API the hub registrator calls."""
+import asyncio
+from aiohttp import web
+
+USERS = '/api/v5/authentication/password_based:built_in_database'
+ACL = '/api/v5/authorization/sources/built_in_database/rules/users'
+
+
+class FakeEMQX:
+    """Keeps users and ACL rules in memory, optionally delays every response to imitate real API latency"""
+
+    def __init__(self, latency: float = 0, admin: tuple[str, str] = ('admin', 'admin')) -> None:
+        """Create new fake API
+
+            Args:
+                latency(float): Seconds added to every response.
+                admin(tuple[str, str]): Superuser credentials accepted by broker authentication.
+        """
+        self.latency = latency
+        self.users: dict[str, str] = {admin[0]: admin[1]}
+        self.rules: dict[str, list] = {}
+        self.requests = 0
+        self.runner: web.AppRunner | None = None
+
+    def authenticate(self, username: str, password: str) -> bool:
+        return self.users.get(username) == password
+
+    @web.middleware
+    async def _count(self, request: web.Request, handler):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    async def _create_user(self, request: web.Request) -> web.Response:
+        user = await request.json()
+        if user['user_id'] in self.users:
+            return web.json_response({'code': 'ALREADY_EXISTS'}, status=409)
+        self.users[user['user_id']] = user['password']
+        return web.json_response({'user_id': user['user_id'], 'is_superuser': False}, status=201)
+
+    async def _import_users(self, request: web.Request) -> web.Response:
+        users = await request.json()
+        for user in users:
+            self.users[user['user_id']] = user['password']
+        return web.json_response({'total': len(users), 'success': len(users),
+                                  'override': 0, 'skipped': 0, 'failed': 0})
+
+    async def _update_user(self, request: web.Request) -> web.Response:
+        user_id = request.match_info['user_id']
+        if user_id not in self.users:
+            return web.json_response({'code': 'NOT_FOUND'}, status=404)
+        self.users[user_id] = (await request.json())['password']
+        return web.json_response({'user_id': user_id, 'is_superuser': False})
+
+    @staticmethod
+    def _page(request: web.Request, items: list) -> web.Response:
+        page = int(request.query.get('page', 1))
+        limit = int(request.query.get('limit', 100))
+        data = items[(page - 1) * limit:page * limit]
+        return web.json_response({'data': data,
+                                  'meta': {'page': page, 'limit': limit, 'hasnext': page * limit < len(items)}})
+
+    async def _list_users(self, request: web.Request) -> web.Response:
+        return self._page(request, [{'user_id': user_id, 'is_superuser': False} for user_id in self.users])
+
+    async def _list_rules(self, request: web.Request) -> web.Response:
+        return self._page(request, [{'username': username, 'rules': rules} for username, rules in self.rules.items()])
+
+    async def _delete_user(self, request: web.Request) -> web.Response:
+        if self.users.pop(request.match_info['user_id'], None) is None:
+            return web.json_response({'code': 'NOT_FOUND'}, status=404)
+        return web.Response(status=204)
+
+    async def _create_rules(self, request: web.Request) -> web.Response:
+        for rule in await request.json():
+            self.rules[rule['username']] = rule['rules']
+        return web.Response(status=204)
+
+    async def _delete_rules(self, request: web.Request) -> web.Response:
+        self.rules.pop(request.match_info['user_id'], None)
+        return web.Response(status=204)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Start serving.
+
+            Returns:
+                str: API url to pass to hub as EMQX_API_URL.
+        """
+        app = web.Application(middlewares=[self._count])
+        app.add_routes([web.get(f'{USERS}/users', self._list_users),
+                        web.post(f'{USERS}/users', self._create_user),
+                        web.put(f'{USERS}/users/{{user_id}}', self._update_user),
+                        web.post(f'{USERS}/import_users', self._import_users),
+                        web.delete(f'{USERS}/users/{{user_id}}', self._delete_user),
+                        web.get(ACL, self._list_rules),
+                        web.post(ACL, self._create_rules),
+                        web.delete(f'{ACL}/{{user_id}}', self._delete_rules)])
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f'http://{host}:{port}/api/v5'
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
@@ -0,0 +1,60 @@
+"""mongomock based stand-in for Motor client, with the parts mongomock lacks filled in for hub needs.
+
+Sessions and transactions are no-ops, time-series and expiration options are ignored and change streams fail
+like on a standalone server, so the device registry falls back to polling.
+"""
+import mongomock
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import OperationFailure
+
+_create_collection = mongomock.database.Database.create_collection
+_run_command = mongomock.database.Database.command
+
+
+def _create_plain_collection(self, name, **kwargs):
+    kwargs.pop('timeseries', None)
+    kwargs.pop('expireAfterSeconds', None)
+    return _create_collection(self, name, **kwargs)
+
+
+def _command(self, command, *args, **kwargs):
+    if isinstance(command, dict) and 'collMod' in command:
+        return {'ok': 1.0}
+    return _run_command(self, command, *args, **kwargs)
+
+
+def _watch(self, *args, **kwargs):
+    raise OperationFailure('The $changeStream stage is only supported on replica sets', code=40573)
+
+
+mongomock.database.Database.create_collection = _create_plain_collection
+mongomock.database.Database.command = _command
+mongomock.collection.Collection.watch = _watch
+
+
+class FakeSession:
+    """Session accepted by hub transaction code, operations aren't isolated"""
+
+    def __init__(self, client: 'FakeMongoClient') -> None:
+        self.client = client
+
+    async def __aenter__(self) -> 'FakeSession':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+    def start_transaction(self) -> 'FakeSession':
+        return self
+
+    async def commit_transaction(self) -> None:
+        pass
+
+    async def abort_transaction(self) -> None:
+        pass
+
+
+class FakeMongoClient(AsyncMongoMockClient):
+
+    async def start_session(self, *args, **kwargs) -> FakeSession:
+        return FakeSession(self)
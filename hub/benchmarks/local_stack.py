@@ -0,0 +1,243 @@
+"""Run hub in process against local stand-ins and measure its hot paths.
+
+EMQX API is replaced by aiohttp fake, broker by minimal in-process MQTT broker and Mongo by mongomock
+(or by any mongod, e.g. ephemeral one, passed with --mongo-uri). Simulated devices go through UDP discovery,
+TCP registration with operator approval and answer MQTT commands, then device endpoints are loaded over ASGI:
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/local_stack.py --devices 50 --changes 1000 --reads 5000 --concurrency 20
+
+Throughput and p50/p99/max latency are reported for discovery, register_device, chage_value, group changes,
+device reads and history queries over telemetry published by devices.
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from statistics import quantiles
+
+from fakes.broker import Broker
+from fakes.devices import SimulatedDevice, discover
+from fakes.emqx_api import FakeEMQX
+
+
+def free_port(kind: int) -> int:
+    with socket.socket(socket.AF_INET, kind) as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def report(name: str, latencies: list[float], errors: int, elapsed: float) -> None:
+    if not latencies:
+        print(f'{name:<22} no successful operations, errors: {errors}')
+        return
+    cuts = quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    print(f'{name:<22} ops: {len(latencies):>6}  errors: {errors:>4}  '
+          f'throughput: {len(latencies) / elapsed:>9.1f}/s  '
+          f'p50: {cuts[49] * 1000:>8.2f} ms  p99: {cuts[98] * 1000:>8.2f} ms  max: {max(latencies) * 1000:>8.2f} ms')
+
+
+async def measure(name: str, operation, count: int, concurrency: int) -> None:
+    """Run operation count times by concurrent workers and report latencies.
+
+        Args:
+            name(str): Name in report.
+            operation: Coroutine function called with operation number, returns seconds it took.
+            count(int): Number of operations.
+            concurrency(int): Number of workers.
+    """
+    numbers = iter(range(count))
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for number in numbers:
+            try:
+                latencies.append(await operation(number))
+            except Exception:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    report(name, latencies, errors, time.perf_counter() - start)
+
+
+async def timed_request(client, method: str, url: str, **kwargs) -> float:
+    start = time.perf_counter()
+    response = await client.request(method, url, **kwargs)
+    if response.status_code != 200:
+        raise RuntimeError(f'{method} {url}: {response.status_code} {response.text}')
+    return time.perf_counter() - start
+
+
+async def register_devices(registration_service, devices: list[SimulatedDevice], discovery_port: int,
+                           concurrency: int, discovery_attempts: int = 5) -> None:
+    """Discover hub and register devices, operator approves every announced one like websocket session does."""
+    events = registration_service.subscribe()
+    approve_latencies = []
+    approvals = set()
+
+    async def approve(pending_id: str) -> None:
+        start = time.perf_counter()
+        if await registration_service.approve(pending_id):
+            approve_latencies.append(time.perf_counter() - start)
+
+    async def operator():
+        while True:
+            event = await events.get()
+            if event.event == 'announced':
+                task = asyncio.create_task(approve(event.id))
+                approvals.add(task)
+                task.add_done_callback(approvals.discard)
+
+    operator_task = asyncio.create_task(operator())
+    start = time.perf_counter()
+
+    async def onboard(number: int) -> float:
+        # Device repeats discovery until hub answers, like real devices do when they are rate limited
+        for attempt in range(discovery_attempts):
+            try:
+                reply, _ = await discover(discovery_port, timeout=0.5)
+                break
+            except TimeoutError:
+                if attempt == discovery_attempts - 1:
+                    raise
+        return await devices[number].register(reply['port'])
+    await measure('device_onboarding', onboard, len(devices), concurrency)
+    await asyncio.gather(*approvals)
+    operator_task.cancel()
+    registration_service.unsubscribe(events)
+    report('register_device', approve_latencies, len(devices) - len(approve_latencies),
+           time.perf_counter() - start)
+
+
+async def publish_telemetry(client, devices: list[SimulatedDevice], count: int, timeout: float = 60) -> None:
+    """Publish numeric values spread over the last hour from devices and wait until hub writes them."""
+    now = time.time()
+    written = (await client.get('/local_control/stats/telemetry/')).json()['results']['written']
+    start = time.perf_counter()
+    for number in range(count):
+        device = devices[number % len(devices)]
+        values = {field['name']: random.randint(0, 100) for field in device.specification['fields']
+                  if field['type'] == 'int'}
+        timestamp = datetime.fromtimestamp(now - random.uniform(0, 3600), timezone.utc)
+        device.publish_telemetry(values, timestamp.isoformat())
+    while time.perf_counter() - start < timeout:
+        stats = (await client.get('/local_control/stats/telemetry/')).json()['results']
+        if stats['written'] - written >= count:
+            break
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - start
+    print(f'{"telemetry_ingest":<22} ops: {stats["written"] - written:>6}  throughput: {count / elapsed:>9.1f}/s')
+
+
+async def main(args: argparse.Namespace) -> None:
+    emqx = FakeEMQX(latency=args.emqx_latency)
+    emqx_api_url = await emqx.start()
+    broker = Broker(authenticate=emqx.authenticate)
+    broker_port = await broker.start()
+    discovery_port = free_port(socket.SOCK_DGRAM)
+    registration_port = free_port(socket.SOCK_STREAM)
+
+    # Hub reads configuration at import
+    os.environ.update({'HOST': '127.0.0.1',
+                       'EMQX_PORT': str(broker_port),
+                       'EMQX_API_KEY': 'bench:bench',
+                       'EMQX_API_URL': emqx_api_url,
+                       'DB_URI': args.mongo_uri or 'mongodb://localhost',
+                       'DISCOVERY_PORT': str(discovery_port),
+                       'REGISTRATION_PORT': str(registration_port),
+                       'LOG_LEVEL': args.log_level})
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+    import database
+    if args.mongo_uri is None:
+        from fakes.mongo import FakeMongoClient
+
+        def connect():
+            database.client = FakeMongoClient()
+            return database.client
+        database.connect = connect
+    from httpx import ASGITransport, AsyncClient
+    from main import app
+    from registration.router import registration_service
+
+    devices = [SimulatedDevice(index, fields=args.fields) for index in range(args.devices)]
+    async with app.router.lifespan_context(app):
+        from prometheus_client import REGISTRY
+        broadcast_server = registration_service.broadcast_server
+
+        # All simulated devices share loopback address, so default per source rate limit applies to the whole
+        # burst, requests above it are unanswered and counted as errors
+        async def discovery(number: int) -> float:
+            return (await discover(discovery_port, timeout=args.discovery_timeout))[1]
+        await measure('discovery', discovery, args.discovery, args.concurrency)
+        limited = REGISTRY.get_sample_value('hub_discovery_requests_total', {'result': 'rate_limited'}) or 0
+        print(f'{"discovery_limited":<22} ops: {limited:>6.0f}  '
+              f'limit: {broadcast_server.rate_limit} per {broadcast_server.rate_period:g} s per source')
+        await asyncio.sleep(broadcast_server.rate_period)
+
+        await register_devices(registration_service, devices, discovery_port, args.concurrency)
+        devices = [device for device in devices if device.credentials is not None]
+        await asyncio.gather(*[asyncio.to_thread(device.connect, '127.0.0.1', broker_port) for device in devices])
+
+        async with AsyncClient(transport=ASGITransport(app=app), base_url='http://hub') as client:
+            def change_value(number: int):
+                device = random.choice(devices)
+                field = random.choice(device.specification['fields'])
+                value = random.randint(0, 100) if field['type'] == 'int' else bool(number % 2)
+                return timed_request(client, 'PATCH', f'/local_control/devices/{device.id}/change_value/',
+                                     json=[{'name': field['name'], 'value': value}])
+            await measure('chage_value', change_value, args.changes, args.concurrency)
+
+            def change_group(number: int):
+                # Scene like "all lights off", switch of every device in one request
+                scene = [{'device_id': device.id, 'fields': [{'name': 'power', 'value': bool(number % 2)}]}
+                         for device in devices]
+                return timed_request(client, 'PATCH', '/local_control/devices/change_value/', json=scene)
+            await measure('change_group_values', change_group, args.scenes, 1)
+
+            if args.telemetry:
+                await publish_telemetry(client, devices, args.telemetry)
+                day_ago = datetime.fromtimestamp(time.time() - 86400, timezone.utc).isoformat()
+
+                def get_history(number: int):
+                    return timed_request(client, 'GET', f'/local_control/devices/{random.choice(devices).id}/history/',
+                                         params={'field': 'level0', 'start': day_ago})
+                await measure('get_history', get_history, args.reads, args.concurrency)
+
+            await measure('get_devices', lambda number: timed_request(client, 'GET', '/local_control/devices/',
+                                                                     params={'limit': 100}),
+                          args.reads, args.concurrency)
+            await measure('get_device', lambda number: timed_request(
+                client, 'GET', f'/local_control/devices/{random.choice(devices).id}/'),
+                          args.reads, args.concurrency)
+
+        for device in devices:
+            device.disconnect()
+    await broker.stop()
+    await emqx.stop()
+    print(f'EMQX API requests: {emqx.requests}, broker messages: {broker.published}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--fields', type=int, default=4, help='Fields of every simulated device')
+    parser.add_argument('--discovery', type=int, default=500, help='Number of discovery requests')
+    parser.add_argument('--discovery-timeout', type=float, default=0.2,
+                        help='Seconds to wait for discovery reply before request is counted as unanswered')
+    parser.add_argument('--changes', type=int, default=1000, help='Number of chage_value requests')
+    parser.add_argument('--scenes', type=int, default=20, help='Number of requests changing all devices at once')
+    parser.add_argument('--telemetry', type=int, default=5000, help='Number of telemetry messages, 0 skips history')
+    parser.add_argument('--reads', type=int, default=5000, help='Number of requests to every read endpoint')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--emqx-latency', type=float, default=0, help='Seconds added to every EMQX API response')
+    parser.add_argument('--mongo-uri', default=None, help='Use real mongod instead of mongomock')
+    parser.add_argument('--log-level', default='WARNING')
+    asyncio.run(main(parser.parse_args()))
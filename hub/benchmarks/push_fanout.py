@@ -0,0 +1,82 @@
+"""Measure push fan-out cost with many idle dashboards.
+
+Every idle dashboard follows its own device which never changes, a few active ones follow a device publishing
+events. Reports CPU time the process spends while everybody waits, CPU cost of one event for devices nobody
+follows and for the followed one, and how slow consumers are coalesced:
+
+    python benchmarks/push_fanout.py --idle 10000 --active 100 --events 100000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+# Hub reads configuration at import, broker isn't used
+os.environ.setdefault('EMQX_PORT', '1883')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+from local_control.push import PushHub, STATE, TELEMETRY  # noqa: E402
+from local_control.registry import DeviceRegistry  # noqa: E402
+from local_control.shadow import ShadowStore  # noqa: E402
+
+
+async def consume(subscriber, delay: float, received: list[int]) -> None:
+    """Client reading events, delay imitates slow network."""
+    while True:
+        received[0] += len(await subscriber.receive())
+        if delay:
+            await asyncio.sleep(delay)
+
+
+async def run(args: argparse.Namespace) -> None:
+    push = PushHub('bench', 'bench', DeviceRegistry(), ShadowStore(DeviceRegistry()),
+                   max_subscribers=args.idle + args.active)
+    received = [0]
+    tasks = []
+    for number in range(args.idle):
+        subscriber = push.subscribe({f'idle-{number}'}, {TELEMETRY, STATE})
+        tasks.append(asyncio.create_task(consume(subscriber, 0, received)))
+    for number in range(args.active):
+        subscriber = push.subscribe({'hot'}, {TELEMETRY})
+        # Every second active client is slow
+        tasks.append(asyncio.create_task(consume(subscriber, args.slow_delay if number % 2 else 0, received)))
+    await asyncio.sleep(0.1)
+
+    start = time.process_time()
+    await asyncio.sleep(args.idle_seconds)
+    idle_cpu = time.process_time() - start
+    print(f'{"idle":<14} clients: {len(push.subscribers):>7}  '
+          f'cpu: {idle_cpu * 1000:>8.2f} ms over {args.idle_seconds:.0f} s')
+
+    start = time.process_time()
+    for number in range(args.events):
+        push.publish(TELEMETRY, f'other-{number}', {'level0': number})
+    elapsed = time.process_time() - start
+    print(f'{"not followed":<14} events: {args.events:>7}  cpu: {elapsed / args.events * 1e6:>8.2f} us/event')
+
+    start = time.process_time()
+    for number in range(args.events):
+        push.publish(TELEMETRY, 'hot', {'level0': number})
+        if number % 100 == 0:
+            # Let consumers run like network reads would between events
+            await asyncio.sleep(0)
+    await asyncio.sleep(args.slow_delay * 2)
+    elapsed = time.process_time() - start
+    stats = push.stats()
+    print(f'{"followed":<14} events: {args.events:>7}  cpu: {elapsed / args.events * 1e6:>8.2f} us/event  '
+          f'received: {received[0]:>8}  coalesced: {stats["coalesced"]:>8}  dropped: {stats["dropped"]}')
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--idle', type=int, default=10000, help='Dashboards following devices without events')
+    parser.add_argument('--active', type=int, default=100, help='Dashboards following the publishing device')
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--idle-seconds', type=float, default=2)
+    parser.add_argument('--slow-delay', type=float, default=0.05, help='Seconds slow client takes per read')
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,60 @@
+"""Measure requests per second of device list and device detail endpoints.
+
+Run against running hub, e.g. once on previous revision and once on current one:
+
+    python benchmarks/read_endpoints.py --url http://localhost:8000 --concurrency 50 --duration 10
+"""
+import argparse
+import asyncio
+import time
+from statistics import quantiles
+from aiohttp import ClientSession, TCPConnector
+
+
+async def worker(session: ClientSession, url: str, deadline: float, latencies: list[float], errors: list[int]):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        async with session.get(url) as response:
+            await response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        latencies.append(time.perf_counter() - start)
+
+
+async def measure(session: ClientSession, url: str, concurrency: int, duration: float) -> None:
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(session, url, deadline, latencies, errors) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    cuts = quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    print(f'{url}\n'
+          f'  requests: {len(latencies)}, errors: {len(errors)}\n'
+          f'  rps: {len(latencies) / elapsed:.1f}\n'
+          f'  p50: {cuts[49] * 1000:.2f} ms, p99: {cuts[98] * 1000:.2f} ms')
+
+
+async def main(args: argparse.Namespace) -> None:
+    connector = TCPConnector(limit=args.concurrency)
+    async with ClientSession(connector=connector) as session:
+        list_url = f'{args.url}/local_control/devices/'
+        device_id = args.device_id
+        if device_id is None:
+            async with session.get(list_url) as response:
+                device_ids = (await response.json())['results']['device_ids']
+            if not device_ids:
+                raise SystemExit('No devices registered, pass --device-id or register one')
+            device_id = device_ids[0]
+
+        await measure(session, list_url, args.concurrency, args.duration)
+        await measure(session, f'{list_url}{device_id}/', args.concurrency, args.duration)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--device-id', default=None)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,121 @@
+"""Measure rule evaluation cost per telemetry message as the number of rules grows.
+
+Rules are spread over more and more trigger devices with the same number of rules per device field, messages
+change random fields of random devices. Indexed engine cost per message should stay flat, linear scan over
+all rules is reported for comparison. Rule state is stored in memory instead of rules collection, so database
+round trips aren't included:
+
+    python benchmarks/rule_engine.py --rules 10 100 1000 10000 100000 --messages 100000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from bson import ObjectId
+
+# Hub reads configuration at import, broker and database aren't used
+os.environ.setdefault('EMQX_PORT', '1883')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+from local_control.registry import DeviceRegistry  # noqa: E402
+from local_control.rules import RuleEngine  # noqa: E402
+from local_control.shadow import ShadowStore  # noqa: E402
+
+FIELDS = ['level0', 'level1', 'level2', 'level3']
+
+
+class Record:
+    """Command record as much as rule engine uses it"""
+
+    def __init__(self) -> None:
+        self.id = ''
+        self.status = 'queued'
+        self.error = None
+        self.done = asyncio.get_running_loop().create_future()
+
+
+class CommandSink:
+    """Takes fired actions instead of command queue, only evaluation is measured"""
+
+    def __init__(self) -> None:
+        self.submitted = 0
+
+    def submit(self, device_id: str, changes: dict) -> Record:
+        self.submitted += 1
+        return Record()
+
+
+class RuleStates:
+    """Keeps state of rules instead of rules collection, only the conditional updates engine makes are served"""
+
+    def __init__(self) -> None:
+        self.states: dict[ObjectId, dict] = {}
+
+    async def update_one(self, query: dict, update: dict) -> SimpleNamespace:
+        state = self.states.setdefault(query['_id'], {'active': False, 'fired_at': None})
+        if 'active' in query:
+            matched = state['active'] != query['active']['$ne']
+        else:
+            matched = state['fired_at'] is None or state['fired_at'] <= query['$or'][1]['fired_at']['$lte']
+        if matched:
+            state.update(update['$set'])
+        return SimpleNamespace(modified_count=int(matched))
+
+
+def build(rules: int, rules_per_field: int) -> tuple[RuleEngine, list[str], list[dict]]:
+    engine = RuleEngine(CommandSink(), ShadowStore(DeviceRegistry()))
+    engine.collection = RuleStates()
+    devices = [str(ObjectId()) for _ in range(max(1, rules // (rules_per_field * len(FIELDS))))]
+    documents = []
+    for number in range(rules):
+        device_id = devices[number % len(devices)]
+        rule = {'_id': ObjectId(),
+                'name': f'rule-{number}',
+                'device_id': device_id,
+                'field': FIELDS[number // len(devices) % len(FIELDS)],
+                'operator': random.choice(['>', '<']),
+                'threshold': random.randint(0, 100),
+                'action': {'device_id': random.choice(devices), 'fields': [{'name': 'level0', 'value': 1}]},
+                'debounce': 1}
+        engine.add(rule)
+        documents.append(rule)
+    return engine, devices, documents
+
+
+async def run(args: argparse.Namespace) -> None:
+    for count in args.rules:
+        engine, devices, documents = build(count, args.rules_per_field)
+        messages = [(random.choice(devices), {random.choice(FIELDS): random.randint(0, 100)})
+                    for _ in range(args.messages)]
+
+        start = time.perf_counter()
+        for device_id, values in messages:
+            engine.evaluate(device_id, values)
+        await asyncio.gather(*engine.evaluations)
+        indexed = (time.perf_counter() - start) / len(messages)
+
+        # Without index every rule is checked against every message
+        scanned = messages[:max(1, args.messages * 1000 // max(count, 1000))]
+        start = time.perf_counter()
+        for device_id, values in scanned:
+            for rule in documents:
+                if rule['device_id'] == device_id and rule['field'] in values:
+                    pass
+        scan = (time.perf_counter() - start) / len(scanned)
+
+        print(f'rules: {count:>7}  indexed: {indexed * 1e6:>8.2f} us/message  '
+              f'linear scan: {scan * 1e6:>10.2f} us/message  '
+              f'evaluated: {engine.stats["evaluated"]:>8}  fired: {engine.stats["fired"]:>7}  '
+              f'debounced: {engine.stats["debounced"]:>6}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rules', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument('--rules-per-field', type=int, default=2, help='Rules triggered by one device field')
+    parser.add_argument('--messages', type=int, default=100000)
+    asyncio.run(run(parser.parse_args()))
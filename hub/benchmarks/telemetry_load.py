@@ -0,0 +1,115 @@
+"""Publish sensor telemetry to EMQX and report how fast the hub ingests it.
+
+Sensors and their fields are taken from the hub export endpoint, values are generated inside field bounds.
+Publishing is split between several MQTT connections, each running in its own thread:
+
+    python benchmarks/telemetry_load.py --hub http://localhost:8000 --rate 20000 --duration 30 --clients 8
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import paho.mqtt.client as mqtt
+import requests
+
+
+def random_value(field: dict):
+    if field.get('enum'):
+        return random.choice(field['enum'])
+    if field.get('step') and field['type'] in ('int', 'float'):
+        steps = int((field['max'] - field['min']) // field['step'])
+        return field['min'] + random.randint(0, steps) * field['step']
+    if field['type'] == 'int':
+        return random.randint(field['min'], field['max'])
+    if field['type'] == 'float':
+        return random.uniform(field['min'], field['max'])
+    if field['type'] == 'bool':
+        return random.random() < 0.5
+    return 'x'
+
+
+def load_sensors(hub: str) -> list[dict]:
+    response = requests.get(f'{hub}/local_control/devices/export/', params={'type': 'sensor'}, stream=True)
+    response.raise_for_status()
+    return [json.loads(line) for line in response.iter_lines() if line]
+
+
+def get_stats(hub: str) -> dict:
+    return requests.get(f'{hub}/local_control/stats/telemetry/').json()['results']
+
+
+def publisher(index: int, args: argparse.Namespace, sensors: list[dict], deadline: float, sent: list[int]) -> None:
+    client = mqtt.Client(client_id=f'{args.username}-load-{index}')
+    client.username_pw_set(args.username, args.password)
+    client.max_queued_messages_set(0)
+    client.connect(args.host, args.port)
+    client.loop_start()
+    # Every client publishes its share of target rate in small bursts
+    rate = args.rate / args.clients
+    burst = max(1, int(rate / 100))
+    interval = burst / rate
+    count = 0
+    next_burst = time.perf_counter()
+    while time.perf_counter() < deadline:
+        for _ in range(burst):
+            sensor = random.choice(sensors)
+            values = {field['name']: random_value(field) for field in sensor['fields']}
+            client.publish(f'/devices/{sensor["_id"]}/publish', json.dumps({'values': values}), qos=0)
+            count += 1
+        next_burst += interval
+        delay = next_burst - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    client.loop_stop()
+    client.disconnect()
+    sent[index] = count
+
+
+def main(args: argparse.Namespace) -> None:
+    sensors = [sensor for sensor in load_sensors(args.hub) if sensor['fields']]
+    if not sensors:
+        raise SystemExit('No sensors with fields registered in hub')
+
+    before = get_stats(args.hub)
+    sent = [0] * args.clients
+    start = time.perf_counter()
+    deadline = start + args.duration
+    threads = [threading.Thread(target=publisher, args=(index, args, sensors, deadline, sent))
+               for index in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    published = time.perf_counter() - start
+
+    # Wait until hub stops writing
+    after = get_stats(args.hub)
+    finished = time.perf_counter()
+    while True:
+        time.sleep(0.5)
+        current = get_stats(args.hub)
+        if current['written'] == after['written'] and current['pending'] == 0:
+            break
+        after = current
+        finished = time.perf_counter()
+    elapsed = finished - start
+
+    written = after['written'] - before['written']
+    print(f'published: {sum(sent)} in {published:.1f} s, {sum(sent) / published:.0f} msg/s\n'
+          f'written: {written} in {elapsed:.1f} s, {written / elapsed:.0f} msg/s\n'
+          f'invalid: {after["invalid"] - before["invalid"]}, dropped: {after["dropped"] - before["dropped"]}, '
+          f'failed: {after["failed"] - before["failed"]}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hub', default='http://localhost:8000')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--rate', type=float, default=20000, help='Target messages per second')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--clients', type=int, default=8)
+    main(parser.parse_args())
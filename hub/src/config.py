@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 
@@ -8,3 +9,31 @@ API_KEY = os.environ.get('EMQX_API_KEY')
 DB_URI = os.environ.get('DB_URI')
 HOST = os.environ.get('HOST')
 EMQX_PORT = int(os.environ.get('EMQX_PORT'))
+EMQX_API_URL = os.environ.get('EMQX_API_URL', 'http://localhost:18083/api/v5')
+
+# Ports devices use to find hub and to send registration request
+DISCOVERY_PORT = int(os.environ.get('DISCOVERY_PORT', 15555))
+REGISTRATION_PORT = int(os.environ.get('REGISTRATION_PORT', 12222))
+# Directory of lock electing the hub worker which runs registration servers and reconciler
+LOCK_DIR = os.environ.get('LOCK_DIR', tempfile.gettempdir())
+# Max discovery replies per second to one source address, devices behind one NAT share it
+DISCOVERY_RATE_LIMIT = int(os.environ.get('DISCOVERY_RATE_LIMIT', 200))
+
+# Motor connection pool and read settings
+DB_MAX_POOL_SIZE = int(os.environ.get('DB_MAX_POOL_SIZE', 100))
+DB_MIN_POOL_SIZE = int(os.environ.get('DB_MIN_POOL_SIZE', 10))
+DB_MAX_IDLE_TIME_MS = int(os.environ.get('DB_MAX_IDLE_TIME_MS', 60000))
+DB_READ_PREFERENCE = os.environ.get('DB_READ_PREFERENCE', 'primaryPreferred')
+DB_READ_CONCERN = os.environ.get('DB_READ_CONCERN', 'local')
+
+# Minimal level of hub logs: DEBUG, INFO, WARNING or ERROR
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+# Database for sensor data, time-series collections can't be created in 'local'
+TELEMETRY_DB = os.environ.get('TELEMETRY_DB', 'hub')
+
+# Seconds telemetry is kept, 0 keeps it forever: raw points and 1 minute, 1 hour and 1 day rollups
+TELEMETRY_RAW_RETENTION = int(os.environ.get('TELEMETRY_RAW_RETENTION', 7 * 24 * 60 * 60))
+TELEMETRY_MINUTE_RETENTION = int(os.environ.get('TELEMETRY_MINUTE_RETENTION', 30 * 24 * 60 * 60))
+TELEMETRY_HOUR_RETENTION = int(os.environ.get('TELEMETRY_HOUR_RETENTION', 2 * 365 * 24 * 60 * 60))
+TELEMETRY_DAY_RETENTION = int(os.environ.get('TELEMETRY_DAY_RETENTION', 0))
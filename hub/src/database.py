@@ -1,11 +1,80 @@
 from motor.core import AgnosticClientSession
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo import ASCENDING, IndexModel, ReadPreference
+from pymongo.read_concern import ReadConcern
 from typing import Coroutine, Any
-from config import DB_URI
+from config import (DB_URI, DB_MAX_POOL_SIZE, DB_MIN_POOL_SIZE, DB_MAX_IDLE_TIME_MS,
+                    DB_READ_PREFERENCE, DB_READ_CONCERN)
+from metrics import MongoCommandMetrics
 
-client = AsyncIOMotorClient(DB_URI)
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST,
+}
+
+# Indexes for queries hub runs on local.devices: listing and export filtered by type and name prefix
+# with _id pagination. Single device reads and updates go by _id, fields are addressed by position.
+DEVICE_INDEXES = [
+    IndexModel([('type', ASCENDING), ('_id', ASCENDING)], name='type_id'),
+    IndexModel([('type', ASCENDING), ('name', ASCENDING), ('_id', ASCENDING)], name='type_name_id'),
+    IndexModel([('name', ASCENDING), ('_id', ASCENDING)], name='name_id'),
+]
+
+# Registration outbox is scanned by reconciler for abandoned registrations
+REGISTRATION_INDEXES = [
+    IndexModel([('updated_at', ASCENDING)], name='updated_at'),
+]
+
+# Created and closed in application lifespan
+client: AsyncIOMotorClient | None = None
+
+
+def connect() -> AsyncIOMotorClient:
+    """Create application-wide Motor client.
+
+        Returns:
+            AsyncIOMotorClient: Created client.
+    """
+    global client
+    client = AsyncIOMotorClient(DB_URI,
+                                maxPoolSize=DB_MAX_POOL_SIZE,
+                                minPoolSize=DB_MIN_POOL_SIZE,
+                                maxIdleTimeMS=DB_MAX_IDLE_TIME_MS,
+                                event_listeners=[MongoCommandMetrics()])
+    return client
+
+
+def close() -> None:
+    global client
+    if client is not None:
+        client.close()
+        client = None
+
+
+async def create_indexes() -> None:
+    """Create indexes used by hub queries, existing indexes are left as is."""
+    await client.local.devices.create_indexes(DEVICE_INDEXES)
+    await client.local.registrations.create_indexes(REGISTRATION_INDEXES)
 
 
 async def get_db_session() -> Coroutine[Any, Any, AgnosticClientSession]:
     session = await client.start_session()
     return session
+
+
+def get_read_collection(name: str, database: str = 'local') -> AsyncIOMotorCollection:
+    """Get collection for session-less reads with configured read preference and read concern.
+
+        Args:
+            name(str): Collection name.
+            database(str): Database name.
+
+        Returns:
+            AsyncIOMotorCollection: Collection for reading.
+    """
+    return client[database].get_collection(name,
+                                           read_preference=READ_PREFERENCES[DB_READ_PREFERENCE],
+                                           read_concern=ReadConcern(DB_READ_CONCERN))
@@ -0,0 +1,482 @@
+import asyncio
+import logging
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
+
+import database
+from .mqtt_schemas import CommandSchema
+from .registry import DeviceRegistry
+from .sender import MQTTSender
+from .shadow import ShadowStore
+
+logger = logging.getLogger('hub.commands')
+
+QUEUED = 'queued'
+SENT = 'sent'
+CONFIRMED = 'confirmed'
+SUPERSEDED = 'superseded'
+EXPIRED = 'expired'
+FAILED = 'failed'
+FINISHED = (CONFIRMED, SUPERSEDED, EXPIRED, FAILED)
+
+
+class CommandRecord:
+    """Value changes requested for device by one request"""
+
+    def __init__(self, device_id: str, changes: dict, ttl: float) -> None:
+        loop = asyncio.get_running_loop()
+        self.id = uuid.uuid4().hex
+        self.device_id = device_id
+        self.changes = changes
+        self.status = QUEUED
+        self.error: str | None = None
+        self.created_at = datetime.now(timezone.utc)
+        self.updated_at = self.created_at
+        self.expires_at = loop.time() + ttl
+        # Resolved with device document when command is finished, None if it isn't applied
+        self.done: asyncio.Future = loop.create_future()
+
+    def set_status(self, status: str, error: str | None = None) -> None:
+        self.status = status
+        self.error = error
+        self.updated_at = datetime.now(timezone.utc)
+
+    def as_dict(self) -> dict:
+        return {'id': self.id, 'device_id': self.device_id, 'changes': self.changes, 'status': self.status,
+                'error': self.error, 'created_at': self.created_at, 'updated_at': self.updated_at}
+
+
+class DeviceCommands:
+    """Unconfirmed changes of one device, coalesced by field"""
+
+    def __init__(self) -> None:
+        # Latest requested value of every field not confirmed yet and number of submit which set it
+        self.changes: dict[str, object] = {}
+        self.versions: dict[str, int] = {}
+        self.version = 0
+        self.records: list[CommandRecord] = []
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        # Command published directly by fan-out is in flight, queued changes wait for it
+        self.reserved = False
+
+
+class CommandQueue:
+    """Per-device command queues delivering value changes in background.
+
+    Changes requested while previous command is in flight are merged, latest value of field wins, and sent as
+    one command after confirmation. Device not confirming in delivery timeout is considered asleep: command is
+    republished as retained message, so broker hands it to device when it subscribes again, and it is replaced
+    by merged one if more changes come meanwhile. Requested values are kept in device shadows as desired state,
+    device connecting with nothing queued gets the desired values it hasn't reported yet."""
+
+    def __init__(self,
+                 sender: MQTTSender,
+                 registry: DeviceRegistry,
+                 shadows: ShadowStore,
+                 delivery_timeout: float = 5,
+                 command_ttl: float = 24 * 60 * 60,
+                 history_size: int = 10_000) -> None:
+        """Create new command queue
+
+            Args:
+                sender(MQTTSender): Sender publishing commands.
+                registry(DeviceRegistry): Registry updated with confirmed values.
+                shadows(ShadowStore): Shadows updated with requested and confirmed values.
+                delivery_timeout(float): Seconds to wait for confirmation before device is considered asleep.
+                command_ttl(float): Seconds command waits for sleeping device before it expires.
+                history_size(int): Max number of finished commands kept for status requests.
+        """
+        self.sender = sender
+        self.registry = registry
+        self.shadows = shadows
+        self.delivery_timeout = delivery_timeout
+        self.command_ttl = command_ttl
+        self.history_size = history_size
+        self.devices: dict[str, DeviceCommands] = {}
+        self.commands: OrderedDict[str, CommandRecord] = OrderedDict()
+        self.resyncs: set[asyncio.Task] = set()
+
+    async def stop(self) -> None:
+        tasks = [device.task for device in self.devices.values() if device.task is not None]
+        tasks.extend(self.resyncs)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.devices.clear()
+
+    def get(self, command_id: str) -> CommandRecord | None:
+        return self.commands.get(command_id)
+
+    def submit(self, device_id: str, changes: dict) -> CommandRecord:
+        """Queue validated value changes for device.
+
+            Args:
+                device_id(str): Device id.
+                changes(dict): New values by field name.
+
+            Returns:
+                CommandRecord: Queued command.
+        """
+        record = CommandRecord(device_id, changes, self.command_ttl)
+        self._remember(record)
+        self.shadows.desire(device_id, changes)
+        device = self.devices.setdefault(device_id, DeviceCommands())
+        for previous in device.records:
+            # Every value of queued command is overwritten, it will never be sent as is
+            if previous.status == QUEUED and previous.changes.keys() <= changes.keys():
+                previous.set_status(SUPERSEDED)
+        device.version += 1
+        device.changes.update(changes)
+        device.versions.update(dict.fromkeys(changes, device.version))
+        device.records.append(record)
+        device.wakeup.set()
+        if device.task is None and not device.reserved:
+            device.task = asyncio.create_task(self._deliver(device_id, device))
+        return record
+
+    def _requeue(self, device_id: str, changes: dict) -> CommandRecord:
+        """Queue changes of direct command which isn't confirmed in time ahead of changes requested after it.
+
+            Args:
+                device_id(str): Reserved device id.
+                changes(dict): New values by field name.
+
+            Returns:
+                CommandRecord: Queued command.
+        """
+        record = CommandRecord(device_id, changes, self.command_ttl)
+        self._remember(record)
+        device = self.devices[device_id]
+        # Values requested later win
+        earlier = {name: value for name, value in changes.items() if name not in device.changes}
+        if not earlier:
+            record.set_status(SUPERSEDED)
+        device.changes.update(earlier)
+        device.versions.update(dict.fromkeys(earlier, device.version))
+        device.records.insert(0, record)
+        return record
+
+    def _release(self, device_id: str) -> None:
+        """Let queue deliver changes requested while direct command was in flight."""
+        device = self.devices[device_id]
+        device.reserved = False
+        if device.records:
+            device.task = asyncio.create_task(self._deliver(device_id, device))
+        else:
+            del self.devices[device_id]
+
+    async def fan_out(self, changes: dict[str, dict], timeout: float) -> dict[str, dict]:
+        """Send changes to many devices at once and store confirmed values with one bulk write.
+
+        Every command is published before any confirmation is awaited, so the whole group takes about one device
+        round-trip. Devices with unconfirmed commands get changes through their queue to keep order of changes.
+        Other devices are reserved while their command is in flight, so changes requested meanwhile are queued
+        behind it and stored after it. Devices not confirming in time get changes queued for later delivery.
+
+            Args:
+                changes(dict[str, dict]): New values by field name for every device id.
+                timeout(float): Seconds to wait for confirmations.
+
+            Returns:
+                dict[str, dict]: Result of every device with status, error and id of command left in queue.
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        published = {}
+        queued = {}
+
+        def observe_confirmation(future: asyncio.Future) -> None:
+            if not future.cancelled():
+                self.sender.observe('confirmed', loop.time() - start)
+
+        for device_id, device_changes in changes.items():
+            if device_id in self.devices:
+                queued[device_id] = self.submit(device_id, device_changes)
+            else:
+                self.shadows.desire(device_id, device_changes)
+                self.devices[device_id] = DeviceCommands()
+                self.devices[device_id].reserved = True
+                topic = f'/devices/{device_id}'
+                correlation_id, future = self.sender.publish_command(topic, self._command(device_changes))
+                future.add_done_callback(observe_confirmation)
+                published[device_id] = (topic, correlation_id, future)
+        results = {}
+        try:
+            futures = [future for _, _, future in published.values()] + [record.done for record in queued.values()]
+            if futures:
+                await asyncio.wait(futures, timeout=timeout)
+
+            confirmed = {}
+            for device_id, (topic, correlation_id, future) in published.items():
+                self.sender.forget(topic, correlation_id)
+                if future.done():
+                    confirmed[device_id] = changes[device_id]
+                else:
+                    self.sender.observe('timeout', loop.time() - start)
+                    queued[device_id] = self._requeue(device_id, changes[device_id])
+
+            try:
+                stored = await self._store_many(confirmed)
+            except PyMongoError as e:
+                logger.error('Confirmed values are not stored', extra={'device_ids': list(confirmed),
+                                                                       'error': repr(e)})
+                stored = {}
+                results.update(dict.fromkeys(confirmed, {'status': FAILED,
+                                                         'error': 'Values are applied by device, but not stored'}))
+        finally:
+            for device_id in published:
+                self._release(device_id)
+        for device_id, device in stored.items():
+            results[device_id] = {'status': CONFIRMED} if device is not None \
+                else {'status': FAILED, 'error': 'Device not found'}
+        for device_id, record in queued.items():
+            if not record.done.done():
+                results[device_id] = {'status': QUEUED, 'command_id': record.id}
+            elif record.done.result() is not None:
+                results[device_id] = {'status': CONFIRMED, 'command_id': record.id}
+            else:
+                results[device_id] = {'status': FAILED, 'error': record.error, 'command_id': record.id}
+        return results
+
+    def resync(self, device_id: str) -> None:
+        """Send desired values device missed while it was offline, called when device connects to broker.
+
+        Connection is announced to one hub worker only, so desired values are read from stored shadow, which has
+        values requested through every worker.
+
+            Args:
+                device_id(str): Device id.
+        """
+        task = asyncio.create_task(self._resync(device_id))
+        self.resyncs.add(task)
+        task.add_done_callback(self.resyncs.discard)
+
+    async def _resync(self, device_id: str) -> None:
+        try:
+            await self.shadows.refresh(device_id)
+        except PyMongoError as e:
+            logger.warning('Stored shadow is not read, device is resynchronized from local shadow',
+                           extra={'device_id': device_id, 'error': repr(e)})
+        delta = self.shadows.delta(device_id)
+        device = self.devices.get(device_id)
+        if device is not None:
+            # Queued changes are delivered by queue
+            delta = {name: value for name, value in delta.items() if name not in device.changes}
+        if delta:
+            logger.info('Device is resynchronized', extra={'device_id': device_id, 'fields': list(delta)})
+            self.submit(device_id, delta)
+
+    def _remember(self, record: CommandRecord) -> None:
+        self.commands[record.id] = record
+        # Unfinished commands are kept, e.g. ones waiting for sleeping device, and moved behind the rest,
+        # so finished commands behind them are evicted and every command is passed over once per round
+        for _ in range(len(self.commands)):
+            if len(self.commands) <= self.history_size:
+                break
+            command_id, oldest = next(iter(self.commands.items()))
+            if oldest.status in FINISHED:
+                self.commands.popitem(last=False)
+            else:
+                self.commands.move_to_end(command_id)
+
+    async def _wait_confirmation(self, topic: str, device: DeviceCommands, command: CommandSchema,
+                                 deadline: float, asleep: bool) -> bool | None:
+        """Publish command and wait until device confirms it.
+
+            Args:
+                topic(str): Device topic.
+                device(DeviceCommands): Device queue.
+                command(CommandSchema): Command to send.
+                deadline(float): Event loop time command expires at.
+                asleep(bool): Device hasn't confirmed previous command, it is published as retained at once.
+
+            Returns:
+                bool | None: True if confirmed, None if new changes came while device sleeps, False if expired.
+        """
+        loop = asyncio.get_running_loop()
+        device.wakeup.clear()
+        if not asleep:
+            correlation_id, future = self.sender.publish_command(topic, command)
+            try:
+                done, _ = await asyncio.wait({future}, timeout=self.delivery_timeout)
+                if done:
+                    return True
+            finally:
+                self.sender.forget(topic, correlation_id)
+
+        correlation_id, future = self.sender.publish_command(topic, command, retain=True)
+        wakeup = asyncio.ensure_future(device.wakeup.wait())
+        try:
+            done, _ = await asyncio.wait({future, wakeup}, timeout=max(0.0, deadline - loop.time()),
+                                         return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            wakeup.cancel()
+            self.sender.forget(topic, correlation_id)
+        if future in done:
+            self.sender.clear_retained(topic)
+            return True
+        if wakeup in done:
+            return None
+        self.sender.clear_retained(topic)
+        return False
+
+    async def _deliver(self, device_id: str, device: DeviceCommands) -> None:
+        """Send coalesced changes until device has nothing unconfirmed."""
+        topic = f'/devices/{device_id}'
+        asleep = False
+        try:
+            while device.records:
+                changes = dict(device.changes)
+                version = device.version
+                records = list(device.records)
+                for record in records:
+                    if record.status == QUEUED:
+                        record.set_status(SENT)
+                confirmed = await self._wait_confirmation(topic, device, self._command(changes),
+                                                          records[0].expires_at, asleep)
+                asleep = confirmed is None
+                if asleep:
+                    # Retained command is replaced by merged one
+                    continue
+
+                del device.records[:len(records)]
+                for name in changes:
+                    # Keep values changed again while command was in flight
+                    if device.versions[name] <= version:
+                        del device.changes[name]
+                        del device.versions[name]
+                if not confirmed:
+                    self._finish(records, EXPIRED, None, 'Device has not confirmed command in time')
+                    continue
+                try:
+                    stored = await self._store(device_id, changes)
+                except PyMongoError as e:
+                    logger.error('Confirmed values are not stored', extra={'device_id': device_id, 'error': repr(e)})
+                    self._finish(records, FAILED, None, 'Values are applied by device, but not stored')
+                    continue
+                if stored is None:
+                    self._finish(records, FAILED, None, 'Device not found')
+                else:
+                    self._finish(records, CONFIRMED, stored)
+        finally:
+            device.task = None
+            if not device.records:
+                self.devices.pop(device_id, None)
+
+    @staticmethod
+    def _finish(records: list[CommandRecord], status: str, device: dict | None, error: str | None = None) -> None:
+        for record in records:
+            # Superseded commands keep their status, but are done together with the command carrying their fields
+            if record.status != SUPERSEDED:
+                record.set_status(status, error)
+            if not record.done.done():
+                record.done.set_result(device)
+
+    @staticmethod
+    def _command(changes: dict) -> CommandSchema:
+        return CommandSchema(command='update',
+                             content=[{'name': name, 'value': value} for name, value in changes.items()])
+
+    def _positional_update(self, device: dict, changes: dict) -> tuple[dict, dict]:
+        """Build update addressing fields by cached positions, name conditions guard against reordered fields.
+
+            Args:
+                device(dict): Device document taken from registry.
+                changes(dict): New values by field name.
+
+            Returns:
+                tuple[dict, dict]: Query and '$set' document.
+        """
+        positions = self.registry.field_positions(device)
+        query = {'_id': device['_id']}
+        update = {}
+        for name, value in changes.items():
+            index = positions[name]
+            query[f'fields.{index}.name'] = name
+            update[f'fields.{index}.value'] = value
+        return query, update
+
+    async def _store_many(self, changes: dict[str, dict]) -> dict[str, dict | None]:
+        """Write confirmed values of many devices with one bulk write and update registry.
+
+            Args:
+                changes(dict[str, dict]): Confirmed values by field name for every device id.
+
+            Returns:
+                dict[str, dict | None]: Updated device document or None if device doesn't exist, by device id.
+        """
+        stored = {}
+        devices = {}
+        operations = []
+        for device_id, device_changes in changes.items():
+            device = await self.registry.fetch(device_id)
+            if device is None:
+                stored[device_id] = None
+                continue
+            devices[device_id] = device
+            query, update = self._positional_update(device, device_changes)
+            operations.append(UpdateOne(query, {'$set': update}))
+        if not operations:
+            return stored
+
+        result = await database.client.local.devices.bulk_write(operations, ordered=False)
+        if result.matched_count < len(operations):
+            # Bulk result doesn't tell which devices are deleted or have stale positions, values are set
+            # again one by one, which is idempotent for already updated ones
+            device_ids = list(devices)
+            updated = await asyncio.gather(*[self._store(device_id, changes[device_id]) for device_id in device_ids])
+            stored.update(zip(device_ids, updated))
+            return stored
+
+        for device_id, device in devices.items():
+            device_changes = changes[device_id]
+            fields = [{**field, 'value': device_changes[field['name']]} if field['name'] in device_changes else field
+                      for field in device['fields']]
+            changed_device = {**device, 'fields': fields}
+            self.registry.put(changed_device, specification_changed=False)
+            self.shadows.report(device_id, device_changes)
+            stored[device_id] = changed_device
+        return stored
+
+    async def _store(self, device_id: str, changes: dict) -> dict | None:
+        """Write confirmed values to devices collection and registry.
+
+            Args:
+                device_id(str): Device id.
+                changes(dict): Confirmed values by field name.
+
+            Returns:
+                dict | None: Updated device document or None if device doesn't exist.
+        """
+        device = await self.registry.fetch(device_id)
+        if device is None:
+            return None
+        query, update = self._positional_update(device, changes)
+        # Every update is atomic on one document, devices live in local database which doesn't allow transactions
+        collection = database.client.local.devices
+        stale_positions = False
+        changed_device = await collection.find_one_and_update(query,
+                                                              {'$set': update},
+                                                              return_document=ReturnDocument.AFTER)
+        if changed_device is None:
+            # Cached positions are stale or device is deleted, match fields by name instead
+            array_filters = []
+            update = {}
+            for index, (name, value) in enumerate(changes.items()):
+                update[f'fields.$[field{index}].value'] = value
+                array_filters.append({f'field{index}.name': name})
+            changed_device = await collection.find_one_and_update({'_id': device['_id']},
+                                                                  {'$set': update},
+                                                                  array_filters=array_filters,
+                                                                  return_document=ReturnDocument.AFTER)
+            stale_positions = True
+        if changed_device is None:
+            self.registry.remove(device_id)
+            return None
+        self.registry.put(changed_device, specification_changed=stale_positions)
+        self.shadows.report(device_id, changes)
+        return changed_device
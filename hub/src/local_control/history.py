@@ -0,0 +1,240 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo import ASCENDING, IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+
+RAW = 'raw'
+
+logger = logging.getLogger('hub.history')
+
+
+def _floor(timestamp: datetime, seconds: int) -> datetime:
+    """Get start of bucket timestamp falls into, buckets are aligned to UTC epoch."""
+    if timestamp.tzinfo is None:
+        # Device timestamps without offset and ones read from database are UTC
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return datetime.fromtimestamp(timestamp.timestamp() // seconds * seconds, timezone.utc)
+
+
+def _merge(stats: list, other: list) -> None:
+    """Merge [min, max, sum, count] of other values into stats."""
+    stats[0] = min(stats[0], other[0])
+    stats[1] = max(stats[1], other[1])
+    stats[2] += other[2]
+    stats[3] += other[3]
+
+
+def _bucket_update(stats: dict[str, list]) -> dict:
+    """Build update adding [min, max, sum, count] of every field to bucket."""
+    update = {'$min': {}, '$max': {}, '$inc': {}}
+    for name, (minimum, maximum, total, count) in stats.items():
+        update['$min'][f'fields.{name}.min'] = minimum
+        update['$max'][f'fields.{name}.max'] = maximum
+        update['$inc'][f'fields.{name}.sum'] = total
+        update['$inc'][f'fields.{name}.count'] = count
+    return update
+
+
+class Tier:
+    """One rollup resolution stored in its own collection"""
+
+    def __init__(self, name: str, seconds: int, retention: int) -> None:
+        """Create new rollup tier
+
+            Args:
+                name(str): Resolution name, used in collection name and queries.
+                seconds(int): Bucket length.
+                retention(int): Seconds buckets are kept, 0 keeps them forever.
+        """
+        self.name = name
+        self.seconds = seconds
+        self.retention = retention
+        self.collection: AsyncIOMotorCollection | None = None
+        # Bucket updates which failed, written together with the next batch
+        self.backlog: list[UpdateOne] = []
+
+    def covers(self, start: datetime, now: datetime) -> bool:
+        return not self.retention or start >= now - timedelta(seconds=self.retention)
+
+
+class TelemetryHistory:
+    """Min, max, average and count of numeric telemetry fields in 1 minute, 1 hour and 1 day buckets.
+
+    Buckets are updated incrementally from every written telemetry batch, so history queries read one document
+    per returned point instead of raw data. Every tier expires by its own retention."""
+
+    def __init__(self,
+                 minute_retention: int = 0,
+                 hour_retention: int = 0,
+                 day_retention: int = 0,
+                 max_backlog: int = 100_000) -> None:
+        """Create new telemetry history
+
+            Args:
+                minute_retention(int): Seconds 1 minute buckets are kept, 0 keeps them forever.
+                hour_retention(int): Seconds 1 hour buckets are kept.
+                day_retention(int): Seconds 1 day buckets are kept.
+                max_backlog(int): Max number of failed bucket updates of one tier kept for retry.
+        """
+        self.max_backlog = max_backlog
+        # Ordered from the finest resolution
+        self.tiers = [Tier('1m', 60, minute_retention),
+                      Tier('1h', 60 * 60, hour_retention),
+                      Tier('1d', 24 * 60 * 60, day_retention)]
+        self.raw: AsyncIOMotorCollection | None = None
+
+    async def start(self, database: AsyncIOMotorDatabase, raw_collection: str = 'telemetry') -> None:
+        """Create rollup collections indexes.
+
+            Args:
+                database(AsyncIOMotorDatabase): Database for telemetry.
+                raw_collection(str): Time-series collection raw points are written to.
+        """
+        self.raw = database[raw_collection]
+        for tier in self.tiers:
+            tier.collection = database[f'{raw_collection}_{tier.name}']
+            await tier.collection.create_indexes([IndexModel([('device_id', ASCENDING), ('start', ASCENDING)],
+                                                             name='device_start', unique=True)])
+            await self._set_retention(database, tier)
+
+    @staticmethod
+    async def _set_retention(database: AsyncIOMotorDatabase, tier: Tier) -> None:
+        """Create TTL index of tier, or change it if retention is changed since index is created."""
+        indexes = await tier.collection.index_information()
+        if not tier.retention:
+            if 'start_ttl' in indexes:
+                await tier.collection.drop_index('start_ttl')
+            return
+        try:
+            await tier.collection.create_indexes([IndexModel([('start', ASCENDING)], name='start_ttl',
+                                                             expireAfterSeconds=tier.retention)])
+        except OperationFailure:
+            await database.command({'collMod': tier.collection.name,
+                                    'index': {'name': 'start_ttl', 'expireAfterSeconds': tier.retention}})
+
+    async def add(self, documents: list[dict]) -> None:
+        """Add values of written telemetry documents to rollup buckets.
+
+            Args:
+                documents(list[dict]): Telemetry documents with timestamp, device_id and values.
+
+            Raises:
+                PyMongoError: If some tier isn't updated, its failed updates are retried with the next batch.
+        """
+        # Batch is aggregated in memory first, every tier gets one update per device and bucket
+        minutes: dict[tuple[str, datetime], dict[str, list]] = {}
+        for document in documents:
+            stats = minutes.setdefault((document['device_id'], _floor(document['timestamp'], 60)), {})
+            for name, value in document['values'].items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                if name in stats:
+                    _merge(stats[name], [value, value, value, 1])
+                else:
+                    stats[name] = [value, value, value, 1]
+
+        writes = []
+        for tier in self.tiers:
+            buckets: dict[tuple[str, datetime], dict[str, list]] = {}
+            for (device_id, minute), minute_stats in minutes.items():
+                stats = buckets.setdefault((device_id, _floor(minute, tier.seconds)), {})
+                for name, values in minute_stats.items():
+                    if name in stats:
+                        _merge(stats[name], values)
+                    else:
+                        stats[name] = list(values)
+            operations = [UpdateOne({'device_id': device_id, 'start': start}, _bucket_update(stats), upsert=True)
+                          for (device_id, start), stats in buckets.items() if stats]
+            if operations or tier.backlog:
+                writes.append(self._write(tier, operations))
+        for result in await asyncio.gather(*writes, return_exceptions=True):
+            if isinstance(result, Exception):
+                raise result
+
+    async def _write(self, tier: Tier, operations: list[UpdateOne]) -> None:
+        """Write bucket updates of tier together with updates failed before, failed ones are kept.
+
+        Updates reported failed by server aren't applied. After connection error result is unknown, updates are
+        retried and bucket can count some values twice."""
+        operations = tier.backlog + operations
+        tier.backlog = []
+        try:
+            await tier.collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            failed = sorted({error['index'] for error in e.details['writeErrors']})
+            self._keep(tier, [operations[index] for index in failed])
+            raise
+        except PyMongoError:
+            self._keep(tier, operations)
+            raise
+
+    def _keep(self, tier: Tier, operations: list[UpdateOne]) -> None:
+        tier.backlog = operations[-self.max_backlog:]
+        if len(operations) > self.max_backlog:
+            logger.error('Rollup updates are lost', extra={'tier': tier.name,
+                                                           'updates': len(operations) - self.max_backlog})
+
+    def resolution(self, start: datetime, end: datetime, max_points: int) -> str:
+        """Choose the finest rollup returning at most max_points points which still keeps data from start.
+
+            Args:
+                start(datetime): Window start.
+                end(datetime): Window end.
+                max_points(int): Max number of points.
+
+            Returns:
+                str: Resolution name.
+        """
+        now = datetime.now(timezone.utc)
+        window = (end - start).total_seconds()
+        for tier in self.tiers:
+            if window / tier.seconds <= max_points and tier.covers(start, now):
+                return tier.name
+        return self.tiers[-1].name
+
+    async def query(self,
+                    device_id: str,
+                    field: str,
+                    start: datetime,
+                    end: datetime,
+                    resolution: str,
+                    max_points: int) -> list[dict]:
+        """Get points of field in window, raw points have equal min, max and average.
+
+            Args:
+                device_id(str): Device id.
+                field(str): Numeric field name.
+                start(datetime): Window start, included.
+                end(datetime): Window end, excluded.
+                resolution(str): 'raw' or rollup resolution name.
+                max_points(int): Max number of returned points, the earliest are returned.
+
+            Returns:
+                list[dict]: Points with time, min, max, avg and count, ordered by time.
+        """
+        if resolution == RAW:
+            cursor = self.raw.find({'device_id': device_id,
+                                    'timestamp': {'$gte': start, '$lt': end},
+                                    f'values.{field}': {'$exists': True}},
+                                   {'_id': 0, 'timestamp': 1, f'values.{field}': 1})
+            cursor = cursor.sort('timestamp', ASCENDING).limit(max_points)
+            points = []
+            async for document in cursor:
+                value = document['values'][field]
+                points.append({'time': document['timestamp'], 'min': value, 'max': value, 'avg': value, 'count': 1})
+            return points
+
+        tier = next(tier for tier in self.tiers if tier.name == resolution)
+        cursor = tier.collection.find({'device_id': device_id,
+                                       'start': {'$gte': _floor(start, tier.seconds), '$lt': end},
+                                       f'fields.{field}': {'$exists': True}},
+                                      {'_id': 0, 'start': 1, f'fields.{field}': 1})
+        cursor = cursor.sort('start', ASCENDING).limit(max_points)
+        points = []
+        async for document in cursor:
+            stats = document['fields'][field]
+            points.append({'time': document['start'], 'min': stats['min'], 'max': stats['max'],
+                           'avg': stats['sum'] / stats['count'], 'count': stats['count']})
+        return points
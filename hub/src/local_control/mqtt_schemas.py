@@ -1,11 +1,24 @@
+from datetime import datetime
 from pydantic import BaseModel
 
 
 class ConfirmSchema(BaseModel):
     status: bool
     message: object
+    correlation_id: str | None = None
 
 
 class CommandSchema(BaseModel):
     command: str
     content: object
+    correlation_id: str | None = None
+
+
+class TelemetrySchema(BaseModel):
+    values: dict[str, int | float | str | bool]
+    timestamp: datetime | None = None
+
+
+class StateSchema(BaseModel):
+    values: dict[str, bool | int | float | str]
+    time: datetime
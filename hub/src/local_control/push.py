@@ -0,0 +1,245 @@
+import asyncio
+import os
+from datetime import datetime, timezone
+import paho.mqtt.client as mqtt
+from pydantic import ValidationError
+from config import EMQX_PORT, HOST
+from .mqtt_schemas import StateSchema, TelemetrySchema
+from .registry import DeviceRegistry
+from .shadow import ShadowStore
+
+TELEMETRY = 'telemetry'
+STATE = 'state'
+EVENTS = (TELEMETRY, STATE)
+TELEMETRY_TOPIC = '/devices/{}/publish'
+# Value changes stored by any hub worker are announced to all of them
+STATE_TOPIC = '/hub/state/{}'
+
+
+class Subscriber:
+    """Events waiting to be sent to one client.
+
+    Pending events are kept by event kind and device, so event coming while previous one of the same device is
+    still unsent is merged into it, latest value of field wins. Slow client gets fewer, coalesced events and
+    memory it takes is bounded by number of devices it follows."""
+
+    def __init__(self, device_ids: set[str] | None, events: set[str], max_pending: int) -> None:
+        """Create new subscriber
+
+            Args:
+                device_ids(set[str] | None): Devices client follows, None follows all devices.
+                events(set[str]): Event kinds client receives.
+                max_pending(int): Max number of unsent events, events of other devices are dropped above it.
+        """
+        self.device_ids = device_ids
+        self.events = events
+        self.max_pending = max_pending
+        self.pending: dict[tuple[str, str], dict] = {}
+        self.wakeup = asyncio.Event()
+        self.coalesced = 0
+        self.dropped = 0
+
+    def offer(self, event: str, device_id: str, values: dict, time: datetime) -> None:
+        key = (event, device_id)
+        pending = self.pending.get(key)
+        if pending is not None:
+            pending['values'].update(values)
+            pending['time'] = time
+            self.coalesced += 1
+            return
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.pending[key] = {'event': event, 'device_id': device_id, 'values': dict(values), 'time': time}
+        self.wakeup.set()
+
+    async def receive(self) -> list[dict]:
+        """Wait for events and take all pending ones.
+
+            Returns:
+                list[dict]: Events in order of their first arrival.
+        """
+        await self.wakeup.wait()
+        self.wakeup.clear()
+        events = list(self.pending.values())
+        self.pending.clear()
+        return events
+
+
+class PushHub:
+    """Fans device events out to connected clients.
+
+    Telemetry comes from MQTT subscription of the worker, not from shared telemetry group, so every worker sees
+    all devices. Shadow of worker sees only changes it stores, so they are published to state topic and every
+    worker reads them from it. Topics of device are subscribed only while some client of worker follows it.
+    Subscribers are indexed by device id, event of device is offered only to clients following it, idle clients
+    cost nothing."""
+
+    def __init__(self,
+                 mqtt_user: str,
+                 mqtt_password: str,
+                 registry: DeviceRegistry,
+                 shadows: ShadowStore,
+                 max_subscribers: int = 10_000,
+                 max_pending: int = 1000) -> None:
+        """Create new push hub
+
+            Args:
+                mqtt_user(str): EMQX username.
+                mqtt_password(str): EMQX password.
+                registry(DeviceRegistry): Registry of existing devices, messages of unknown devices are skipped.
+                shadows(ShadowStore): Shadows reporting changed values.
+                max_subscribers(int): Max number of connected clients.
+                max_pending(int): Max number of unsent events of one client.
+        """
+        self.client = mqtt.Client(client_id=f'{mqtt_user}-push-{os.getpid()}')
+        self.client.username_pw_set(mqtt_user, mqtt_password)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._receive_telemetry
+        self.client.message_callback_add(STATE_TOPIC.format('+'), self._receive_state)
+        self.registry = registry
+        self.shadows = shadows
+        self.max_subscribers = max_subscribers
+        self.max_pending = max_pending
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.subscribers: set[Subscriber] = set()
+        # Subscribers by followed device id, and ones following all devices
+        self.by_device: dict[str, set[Subscriber]] = {}
+        self.everything: set[Subscriber] = set()
+        self.delivered = 0
+        # Counters of clients which are gone
+        self.coalesced = 0
+        self.dropped = 0
+
+    async def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.shadows.listeners.append(self._state_changed)
+        self.client.connect_async(host=HOST,
+                                  port=EMQX_PORT)
+        self.client.loop_start()
+
+    def stop(self) -> None:
+        if self._state_changed in self.shadows.listeners:
+            self.shadows.listeners.remove(self._state_changed)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def stats(self) -> dict[str, int]:
+        return {'subscribers': len(self.subscribers),
+                'delivered': self.delivered,
+                'coalesced': self.coalesced + sum(subscriber.coalesced for subscriber in self.subscribers),
+                'dropped': self.dropped + sum(subscriber.dropped for subscriber in self.subscribers)}
+
+    def subscribe(self, device_ids: set[str] | None, events: set[str]) -> Subscriber | None:
+        """Register client.
+
+            Args:
+                device_ids(set[str] | None): Devices client follows, None follows all devices.
+                events(set[str]): Event kinds client receives.
+
+            Returns:
+                Subscriber | None: Client subscriber, None if there are too many clients.
+        """
+        if len(self.subscribers) >= self.max_subscribers:
+            return None
+        subscriber = Subscriber(device_ids, events, self.max_pending)
+        self.subscribers.add(subscriber)
+        if device_ids is None:
+            if not self.everything:
+                # Wildcard replaces topics of single devices, broker would send messages twice otherwise
+                self._unlisten(list(self.by_device))
+                self._listen(['+'])
+            self.everything.add(subscriber)
+        else:
+            new = [device_id for device_id in device_ids if device_id not in self.by_device]
+            for device_id in device_ids:
+                self.by_device.setdefault(device_id, set()).add(subscriber)
+            if not self.everything:
+                self._listen(new)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        if subscriber not in self.subscribers:
+            return
+        self.subscribers.discard(subscriber)
+        self.coalesced += subscriber.coalesced
+        self.dropped += subscriber.dropped
+        if subscriber in self.everything:
+            self.everything.discard(subscriber)
+            if not self.everything:
+                self._unlisten(['+'])
+                self._listen(list(self.by_device))
+        gone = []
+        for device_id in subscriber.device_ids or ():
+            followers = self.by_device.get(device_id)
+            if followers is not None:
+                followers.discard(subscriber)
+                if not followers:
+                    del self.by_device[device_id]
+                    gone.append(device_id)
+        if not self.everything:
+            self._unlisten(gone)
+
+    def _listen(self, device_ids: list[str]) -> None:
+        if device_ids:
+            self.client.subscribe([(topic.format(device_id), 0) for device_id in device_ids
+                                   for topic in (TELEMETRY_TOPIC, STATE_TOPIC)])
+
+    def _unlisten(self, device_ids: list[str]) -> None:
+        if device_ids:
+            self.client.unsubscribe([topic.format(device_id) for device_id in device_ids
+                                     for topic in (TELEMETRY_TOPIC, STATE_TOPIC)])
+
+    def publish(self, event: str, device_id: str, values: dict, time: datetime | None = None) -> None:
+        """Offer event to clients following device.
+
+            Args:
+                event(str): Event kind.
+                device_id(str): Device id.
+                values(dict): Values by field name.
+                time(datetime | None): Time of values, now if None.
+        """
+        followers = self.by_device.get(device_id)
+        if followers is None and not self.everything:
+            return
+        time = time or datetime.now(timezone.utc)
+        for subscribers in (followers or (), self.everything):
+            for subscriber in subscribers:
+                if event in subscriber.events:
+                    subscriber.offer(event, device_id, values, time)
+
+    def _state_changed(self, device_id: str, values: dict) -> None:
+        state = StateSchema(values=values, time=datetime.now(timezone.utc))
+        self.client.publish(STATE_TOPIC.format(device_id), state.model_dump_json(), qos=0)
+
+    def _on_connect(self, client, user_data, flags, rc):
+        # Subscribe on every (re)connect, clean session drops subscriptions
+        self._listen(['+'] if self.everything else list(self.by_device))
+
+    def _receive_state(self, client, user_data, message):
+        """Pass value changes stored by any worker from paho network thread to event loop."""
+        device_id = message.topic.split('/')[3]
+        try:
+            state = StateSchema.model_validate_json(message.payload)
+        except ValidationError:
+            return
+        self.loop.call_soon_threadsafe(self.publish, STATE, device_id, state.values, state.time)
+
+    def _receive_telemetry(self, client, user_data, message):
+        """Pass telemetry of followed devices from paho network thread to event loop."""
+        device_id = message.topic.split('/')[2]
+        # Index is only read here, message of device nobody follows isn't even parsed
+        if device_id not in self.by_device and not self.everything:
+            return
+        try:
+            telemetry = TelemetrySchema.model_validate_json(message.payload)
+        except ValidationError:
+            # Not telemetry, e.g. command confirmation
+            return
+        self.loop.call_soon_threadsafe(self._telemetry_received, device_id, telemetry)
+
+    def _telemetry_received(self, device_id: str, telemetry: TelemetrySchema) -> None:
+        device = self.registry.get(device_id)
+        if device is None or not self.registry.validator(device).is_valid(telemetry.values):
+            return
+        self.publish(TELEMETRY, device_id, telemetry.values, telemetry.timestamp)
@@ -0,0 +1,250 @@
+import asyncio
+import bisect
+import logging
+import re
+from bson import ObjectId
+from bson.errors import InvalidId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import OperationFailure, PyMongoError
+from validation import DeviceValidator, ValidatorCache
+
+# Updated field paths that change only field values, not device specification
+VALUE_PATH = re.compile(r'fields\.\d+\.value')
+
+logger = logging.getLogger('hub.registry')
+
+
+class DeviceRegistry:
+    """In-memory copy of devices collection indexed by device id.
+
+    Kept current by change stream, or by periodic reload when change streams are unavailable
+    (standalone mongod or 'local' database)."""
+
+    def __init__(self, poll_interval: float = 30) -> None:
+        """Create new empty registry
+
+            Args:
+                poll_interval(float): Seconds between full reloads if change stream can't be opened.
+        """
+        self.poll_interval = poll_interval
+        self.collection: AsyncIOMotorCollection | None = None
+        self.devices: dict[str, dict] = {}
+        # Device ids in ascending order, the same as order of ObjectIds, for cursor pagination
+        self.order: list[str] = []
+        self.validators = ValidatorCache()
+        # Position of every field in device fields array by field name
+        self.positions: dict[str, dict[str, int]] = {}
+        self._task: asyncio.Task | None = None
+
+    async def start(self, collection: AsyncIOMotorCollection) -> None:
+        """Load all devices and start following collection changes.
+
+            Args:
+                collection(AsyncIOMotorCollection): Devices collection.
+        """
+        self.collection = collection
+        await self.reload()
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def reload(self) -> None:
+        """Replace registry content with actual collection content."""
+        devices = {}
+        async for device in self.collection.find():
+            devices[str(device['_id'])] = device
+        previous = self.devices
+        self.devices = devices
+        self.order = sorted(devices)
+        # Compiled data is kept for devices whose fields specification is the same
+        for device_id, device in previous.items():
+            reloaded = devices.get(device_id)
+            if reloaded is None or self._specification(reloaded) != self._specification(device):
+                self._invalidate(device_id)
+
+    def get(self, device_id: str) -> dict | None:
+        """Get cached device document. Returned document must not be changed.
+
+            Args:
+                device_id(str): Device id.
+
+            Returns:
+                dict | None: Device document or None if device isn't cached.
+        """
+        return self.devices.get(device_id)
+
+    async def fetch(self, device_id: str) -> dict | None:
+        """Get device from registry, loading it from database if it isn't cached yet.
+
+            Args:
+                device_id(str): Device id.
+
+            Returns:
+                dict | None: Device document or None if device doesn't exist.
+        """
+        device = self.devices.get(device_id)
+        if device is not None:
+            return device
+        try:
+            object_id = ObjectId(device_id)
+        except InvalidId:
+            return None
+        device = await self.collection.find_one({'_id': object_id})
+        if device is not None:
+            self.put(device)
+        return device
+
+    def validator(self, device: dict) -> DeviceValidator:
+        """Get compiled validator for fields of cached device.
+
+            Args:
+                device(dict): Device document taken from registry.
+
+            Returns:
+                DeviceValidator: Validator for device fields.
+        """
+        return self.validators.get(device)
+
+    def field_positions(self, device: dict) -> dict[str, int]:
+        """Get positions of device fields in fields array by field name.
+
+            Args:
+                device(dict): Device document taken from registry.
+
+            Returns:
+                dict[str, int]: Field index by field name.
+        """
+        device_id = str(device['_id'])
+        positions = self.positions.get(device_id)
+        if positions is None:
+            positions = {field['name']: index for index, field in enumerate(device['fields'])}
+            self.positions[device_id] = positions
+        return positions
+
+    def ids(self) -> list[str]:
+        return list(self.devices)
+
+    def page(self,
+             after: str | None,
+             limit: int,
+             device_type: str | None = None,
+             name: str | None = None) -> tuple[list[str], str | None]:
+        """Get ids of cached devices following cursor in ascending order.
+
+            Args:
+                after(str | None): Id of the last device of previous page, None for the first page.
+                limit(int): Max number of ids.
+                device_type(str | None): Type of device, device or sensor.
+                name(str | None): Beginning of device name.
+
+            Returns:
+                tuple[list[str], str | None]: Device ids and cursor of next page, None if it is the last page.
+        """
+        start = bisect.bisect_right(self.order, after) if after is not None else 0
+        ids = []
+        for device_id in self.order[start:]:
+            device = self.devices[device_id]
+            if device_type is not None and device['type'] != device_type:
+                continue
+            if name is not None and not device['name'].startswith(name):
+                continue
+            if len(ids) == limit:
+                return ids, ids[-1]
+            ids.append(device_id)
+        return ids, None
+
+    def put(self, device: dict, specification_changed: bool = True) -> None:
+        """Store new version of device, used by writers to see own changes without waiting for change stream.
+
+            Args:
+                device(dict): Full device document.
+                specification_changed(bool): False if only field values changed, so compiled data is kept.
+        """
+        device_id = str(device['_id'])
+        if device_id not in self.devices:
+            bisect.insort(self.order, device_id)
+        self.devices[device_id] = device
+        if specification_changed:
+            self._invalidate(device_id)
+
+    def remove(self, device_id: str) -> None:
+        if self.devices.pop(device_id, None) is not None:
+            del self.order[bisect.bisect_left(self.order, device_id)]
+        self._invalidate(device_id)
+
+    def _invalidate(self, device_id: str) -> None:
+        self.validators.invalidate(device_id)
+        self.positions.pop(device_id, None)
+
+    def _apply(self, change: dict) -> None:
+        """Apply change stream event to registry.
+
+            Args:
+                change(dict): Change event.
+        """
+        operation = change['operationType']
+        if operation in ('insert', 'update', 'replace'):
+            device = change.get('fullDocument')
+            if device is not None:
+                self.put(device, not self._values_only(change))
+            else:
+                # Document was deleted before update lookup
+                self.remove(str(change['documentKey']['_id']))
+        elif operation == 'delete':
+            self.remove(str(change['documentKey']['_id']))
+
+    @staticmethod
+    def _specification(device: dict) -> list[dict]:
+        """Get fields of device without their values, validators and positions depend only on it."""
+        return [{key: value for key, value in field.items() if key != 'value'} for field in device['fields']]
+
+    @staticmethod
+    def _values_only(change: dict) -> bool:
+        """Check if update event changes nothing but field values.
+
+            Args:
+                change(dict): Change event.
+
+            Returns:
+                bool: True for update touching only 'fields.N.value' paths.
+        """
+        if change['operationType'] != 'update':
+            return False
+        description = change.get('updateDescription', {})
+        if description.get('removedFields') or description.get('truncatedArrays'):
+            return False
+        return all(VALUE_PATH.fullmatch(path) for path in description.get('updatedFields', {}))
+
+    async def _watch(self) -> None:
+        """Follow collection changes, falling back to polling if change streams aren't supported."""
+        resume_token = None
+        while True:
+            try:
+                async with self.collection.watch(full_document='updateLookup',
+                                                 resume_after=resume_token) as stream:
+                    async for change in stream:
+                        self._apply(change)
+                        resume_token = stream.resume_token
+            except OperationFailure as e:
+                if resume_token is None:
+                    logger.info('Change streams are unavailable, polling devices', extra={'error': str(e)})
+                    break
+                # Resume token is lost, start over from actual state
+                resume_token = None
+                await self.reload()
+            except PyMongoError:
+                await asyncio.sleep(1)
+
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.reload()
+            except PyMongoError:
+                continue
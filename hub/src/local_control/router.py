@@ -1,15 +1,45 @@
-from fastapi import APIRouter, Response, status
+import asyncio
+import json
+import re
+from datetime import datetime, timezone
+from typing import Literal
+from fastapi import APIRouter, Response, Query, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
 from bson import ObjectId
 from bson.errors import InvalidId
+from pymongo.errors import PyMongoError
 
-from config import DB_URI
-from schemas import ResponseSchema, ErrorSchema, DeviceResponseSchema
-from .mqtt_schemas import CommandSchema
-from .schemas import ChangingField, DevicesIdsSchema
+from config import (DB_URI, TELEMETRY_RAW_RETENTION, TELEMETRY_MINUTE_RETENTION, TELEMETRY_HOUR_RETENTION,
+                    TELEMETRY_DAY_RETENTION)
+from schemas import ResponseSchema, ErrorSchema, DeviceResponseSchema, ShadowSchema
+from validation import TYPE_CHECKS
+from .schemas import (ChangingField, CommandStatusSchema, DeviceChangesSchema, DeviceResultSchema, DevicesIdsSchema,
+                      HistorySchema, LatencySchema, PushEventSchema, PushStatsSchema, RuleResponseSchema, RuleSchema,
+                      TelemetryStatsSchema)
+from .commands import CommandQueue
+from .history import TelemetryHistory
+from .push import PushHub, Subscriber
 from .sender import MQTTSender
-from database import get_db_session
+from .registry import DeviceRegistry
+from .rules import RuleEngine
+from .shadow import ShadowStore
+from .telemetry import TelemetryIngester
+import database
 
 sender = MQTTSender("admin", "admin")  # TODO: loading admin credentials
+registry = DeviceRegistry()
+shadows = ShadowStore(registry)
+history = TelemetryHistory(TELEMETRY_MINUTE_RETENTION, TELEMETRY_HOUR_RETENTION, TELEMETRY_DAY_RETENTION)
+ingester = TelemetryIngester("admin", "admin", registry, shadows, history, TELEMETRY_RAW_RETENTION)
+commands = CommandQueue(sender, registry, shadows)
+sender.on_device_connected = commands.resync
+rules = RuleEngine(commands, shadows)
+push = PushHub("admin", "admin", registry, shadows)
+
+EXPORT_BATCH_SIZE = 500
+# Seconds between comments keeping idle event stream open through proxies
+STREAM_KEEPALIVE = 15
+GROUP_MAX_DEVICES = 1000
 
 router = APIRouter(
     prefix="/local_control",
@@ -17,97 +47,380 @@ router = APIRouter(
 )
 
 
+def _devices_filter(device_type: str | None, name: str | None) -> dict:
+    """Build devices query from optional filters, name is matched as prefix.
+
+        Args:
+            device_type(str | None): Type of device, device or sensor.
+            name(str | None): Beginning of device name.
+
+        Returns:
+            dict: Mongo query.
+    """
+    devices_filter = {}
+    if device_type is not None:
+        devices_filter['type'] = device_type
+    if name is not None:
+        devices_filter['name'] = {'$regex': f'^{re.escape(name)}'}
+    return devices_filter
+
+
+def _validate_changes(device: dict, changing_fields: list[ChangingField]) -> tuple[dict, ErrorSchema | None]:
+    """Collect requested changes and check them against device fields.
+
+        Args:
+            device(dict): Device document.
+            changing_fields(list[ChangingField]): Requested changes.
+
+        Returns:
+            tuple[dict, ErrorSchema | None]: New values by field name and error if some change is invalid.
+    """
+    validator = registry.validator(device)
+    # Latest value wins if field is passed several times
+    changes = {field_to_change.name: field_to_change.value for field_to_change in changing_fields}
+    for name, value in changes.items():
+        if name not in validator.checkers:
+            return changes, ErrorSchema(type='Invalid Field', message=f'{device["_id"]} has not "{name}" field')
+        message = validator.check(name, value)
+        if message is not None:
+            return changes, ErrorSchema(type='Invalid value', message=message)
+    return changes, None
+
+
 @router.patch('/devices/{device_id}/change_value/', response_model=ResponseSchema)
 async def chage_value(device_id: str,
                       changing_fields: list[ChangingField],
+                      response: Response,
+                      timeout: float | None = Query(None, gt=0, le=60)):
+    device = await registry.fetch(device_id)
+    if device is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        error = ErrorSchema(type="Invalid id", message="Device not found")
+        return ResponseSchema(status="Failure", results=error)
+
+    changes, error = _validate_changes(device, changing_fields)
+    if error is not None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        response_message = ResponseSchema(status="Failure", results=error)
+        return response_message
+
+    if not changes:
+        return ResponseSchema(status='Success',
+                              results={**device, '_id': str(device['_id'])})
+
+    # Command goes through device queue, so it is merged with concurrent changes of the same device
+    command = commands.submit(device_id, changes)
+    try:
+        async with asyncio.timeout(timeout or sender.timeout):
+            changed_device = await asyncio.shield(command.done)
+    except TimeoutError:
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        error = ErrorSchema(type='Connection Error',
+                            message=f'Device response timed out, command {command.id} stays queued')
+        response_message = ResponseSchema(status="Failure", results=error)
+        return response_message
+
+    if changed_device is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST if command.error == 'Device not found' \
+            else status.HTTP_500_INTERNAL_SERVER_ERROR
+        error = ErrorSchema(type='Command error', message=command.error or 'Command is not applied')
+        return ResponseSchema(status="Failure", results=error)
+    return ResponseSchema(status='Success',
+                          results={**changed_device, '_id': str(changed_device['_id'])})
+
+
+@router.patch('/devices/change_value/', response_model=ResponseSchema)
+async def change_group_values(devices_changes: list[DeviceChangesSchema],
+                              response: Response,
+                              timeout: float | None = Query(None, gt=0, le=60)):
+    """Change values of many devices at once, e.g. scene, and get result of every device."""
+    if len(devices_changes) > GROUP_MAX_DEVICES:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        error = ErrorSchema(type='Invalid value', message=f'At most {GROUP_MAX_DEVICES} devices can be changed at once')
+        return ResponseSchema(status="Failure", results=error)
+
+    # Device may be listed several times, its latest values win
+    requested = {}
+    for device_changes in devices_changes:
+        requested.setdefault(device_changes.device_id, []).extend(device_changes.fields)
+
+    results = {}
+    changes = {}
+    for device_id, changing_fields in requested.items():
+        device = await registry.fetch(device_id)
+        if device is None:
+            results[device_id] = DeviceResultSchema(device_id=device_id, status='invalid', error='Device not found')
+            continue
+        device_changes, error = _validate_changes(device, changing_fields)
+        if error is not None:
+            results[device_id] = DeviceResultSchema(device_id=device_id, status='invalid', error=error.message)
+        elif device_changes:
+            changes[device_id] = device_changes
+        else:
+            # Empty change list, nothing to wait for
+            results[device_id] = DeviceResultSchema(device_id=device_id, status='confirmed')
+
+    for device_id, result in (await commands.fan_out(changes, timeout or sender.timeout)).items():
+        results[device_id] = DeviceResultSchema(device_id=device_id, **result)
+    all_confirmed = all(result.status == 'confirmed' for result in results.values())
+    return ResponseSchema(status='Success' if all_confirmed else 'Partial',
+                          results=[results[device_id] for device_id in requested])
+
+
+@router.post('/devices/{device_id}/commands/', response_model=ResponseSchema,
+             status_code=status.HTTP_202_ACCEPTED)
+async def queue_command(device_id: str,
+                        changing_fields: list[ChangingField],
+                        response: Response):
+    """Queue value changes without waiting for device, progress is available by returned command id."""
+    device = await registry.fetch(device_id)
+    if device is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        error = ErrorSchema(type="Invalid id", message="Device not found")
+        return ResponseSchema(status="Failure", results=error)
+
+    changes, error = _validate_changes(device, changing_fields)
+    if error is None and not changes:
+        error = ErrorSchema(type='Invalid value', message='Nothing to change')
+    if error is not None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return ResponseSchema(status="Failure", results=error)
+
+    command = commands.submit(device_id, changes)
+    return ResponseSchema(status='Success', results=CommandStatusSchema(**command.as_dict()))
+
+
+@router.get('/commands/{command_id}/', response_model=ResponseSchema)
+async def get_command(command_id: str,
+                      response: Response):
+    command = commands.get(command_id)
+    if command is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        error = ErrorSchema(type="Invalid id", message="Command not found")
+        return ResponseSchema(status="Failure", results=error)
+    return ResponseSchema(status='Success', results=CommandStatusSchema(**command.as_dict()))
+
+
+@router.post('/rules/', response_model=ResponseSchema, status_code=status.HTTP_201_CREATED)
+async def create_rule(rule: RuleSchema,
+                      response: Response):
+    """Create automation rule changing values of action device when trigger field crosses threshold."""
+    trigger = await registry.fetch(rule.device_id)
+    target = await registry.fetch(rule.action.device_id)
+    if trigger is None or target is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        error = ErrorSchema(type="Invalid id", message="Device not found")
+        return ResponseSchema(status="Failure", results=error)
+
+    field = next((field for field in trigger['fields'] if field['name'] == rule.field), None)
+    if field is None:
+        error = ErrorSchema(type='Invalid Field', message=f'{rule.device_id} has not "{rule.field}" field')
+    elif rule.operator not in ('==', '!=') and field['type'] not in ('int', 'float'):
+        error = ErrorSchema(type='Invalid value', message=f'Only == and != can be used with {field["type"]} field')
+    elif not TYPE_CHECKS[field['type']](rule.threshold):
+        error = ErrorSchema(type='Invalid value', message=f'Threshold must be {field["type"]}')
+    else:
+        changes, error = _validate_changes(target, rule.action.fields)
+        if error is None and not changes:
+            error = ErrorSchema(type='Invalid value', message='Nothing to change')
+    if error is not None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return ResponseSchema(status="Failure", results=error)
+
+    stored = await rules.create(rule.model_dump())
+    return ResponseSchema(status='Success', results=RuleResponseSchema(id=str(stored['_id']), **rule.model_dump()))
+
+
+@router.get('/rules/', response_model=ResponseSchema)
+async def get_rules():
+    results = [RuleResponseSchema(id=str(rule.pop('_id')), **rule) async for rule in rules.collection.find()]
+    return ResponseSchema(status='Success', results=results)
+
+
+@router.delete('/rules/{rule_id}/', response_model=ResponseSchema)
+async def delete_rule(rule_id: str,
                       response: Response):
-    async with await get_db_session() as session:
-        async with session.start_transaction():
-            collection = session.client.local.devices
-            id_filter = {"_id": ObjectId(device_id)}
-            device = await collection.find_one(id_filter)
-            fields = device['fields']
-            for field_to_change in changing_fields:
-                for field in fields:
-                    if field_to_change.name == field['name']:
-                        if field['type'] in ['int', 'float']:
-                            if field_to_change.value not in range(field['min'], field['max'] + 1):
-                                response.status = status.HTTP_400_BAD_REQUEST
-                                error = ErrorSchema(type='Invalid value',
-                                                    message=f'Value must be between {field["min"]} and {field["max"]}')
-                                response_message = ResponseSchema(status="Failure", results=error)
-                                return response_message
-
-                        topic = f'/devices/{str(device["_id"])}'
-                        command = CommandSchema(command='update',
-                                                content=field_to_change.model_dump_json())
-                        try:
-                            result = await sender.send_command(topic, command)
-                            if result is None:
-                                response.status = status.HTTP_500_INTERNAL_SERVER_ERROR
-                                error = ErrorSchema(type='Connection error',
-                                                    message='Device response is empty')
-                                response_message = ResponseSchema(status='Failure',
-                                                                  results=error)
-                                return response_message
-
-                        except TimeoutError:
-                            response.status = status.HTTP_500_INTERNAL_SERVER_ERROR
-                            error = ErrorSchema(type='Connection Error',
-                                                message='Device response timed out')
-                            response_message = ResponseSchema(status="Failure", results=error)
-                            return response_message
-
-                        await collection.update_one(id_filter,
-                                                    {'$set': {f"fields.$[fields].value": field_to_change.value}},
-                                                    array_filters=[{'fields.name': field_to_change.name}])
-                        break
-
-                else:
-                    error = ErrorSchema(type='Invalid Field', message=f'{device_id} has not "{field_to_change}" field')
-                    response_message = ResponseSchema(status="Failure", results=error)
-                    return response_message
-            changed_device = await collection.find_one(id_filter)
-            await session.commit_transaction()
-            changed_device["_id"] = str(changed_device["_id"])
-            return ResponseSchema(status='Success',
-                                  results=changed_device)
+    if not ObjectId.is_valid(rule_id) or not await rules.delete(rule_id):
+        response.status_code = status.HTTP_404_NOT_FOUND
+        error = ErrorSchema(type="Invalid id", message="Rule not found")
+        return ResponseSchema(status="Failure", results=error)
+    return ResponseSchema(status='Success', results=None)
+
+
+@router.websocket('/ws/devices')
+async def push_devices(websocket: WebSocket,
+                       device_id: list[str] | None = Query(None),
+                       events: list[Literal['telemetry', 'state']] = Query(['telemetry', 'state'])):
+    """Client session: receives telemetry and value changes of followed devices, all devices if none is given."""
+    subscriber = push.subscribe(set(device_id) if device_id else None, set(events))
+    if subscriber is None:
+        # Try again later
+        await websocket.close(code=1013)
+        return
+    await websocket.accept()
+
+    async def forward(subscriber: Subscriber) -> None:
+        while True:
+            for event in await subscriber.receive():
+                await websocket.send_text(PushEventSchema(**event).model_dump_json())
+                push.delivered += 1
+
+    sender = asyncio.create_task(forward(subscriber))
+    try:
+        while True:
+            # Clients don't send anything, reading only notices disconnect
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        push.unsubscribe(subscriber)
+        sender.cancel()
+
+
+@router.get('/stream/devices/')
+async def stream_devices(response: Response,
+                         device_id: list[str] | None = Query(None),
+                         events: list[Literal['telemetry', 'state']] = Query(['telemetry', 'state'])):
+    """Server-sent events with telemetry and value changes of followed devices, all devices if none is given."""
+    subscriber = push.subscribe(set(device_id) if device_id else None, set(events))
+    if subscriber is None:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        error = ErrorSchema(type='Connection Error', message='Too many subscribers')
+        return ResponseSchema(status="Failure", results=error)
+
+    async def stream():
+        try:
+            while True:
+                try:
+                    async with asyncio.timeout(STREAM_KEEPALIVE):
+                        pending = await subscriber.receive()
+                except TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                push.delivered += len(pending)
+                yield ''.join(f'event: {event["event"]}\ndata: {PushEventSchema(**event).model_dump_json()}\n\n'
+                              for event in pending)
+        finally:
+            push.unsubscribe(subscriber)
+
+    return StreamingResponse(stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@router.get('/devices/export/')
+async def export_devices(type: Literal["device", "sensor"] | None = None,
+                         name: str | None = None):
+    """Stream full device documents as newline delimited json."""
+    collection = database.get_read_collection('devices')
+    cursor = collection.find(_devices_filter(type, name), batch_size=EXPORT_BATCH_SIZE).sort('_id', 1)
+
+    async def lines():
+        async for device in cursor:
+            device['_id'] = str(device['_id'])
+            yield json.dumps(device, default=str) + '\n'
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
 
 
 @router.get('/devices/{device_id}/', response_model=ResponseSchema)
 async def get_device(device_id: str,
                      response: Response):
-    async with await get_db_session() as session:
-        async with session.start_transaction():
-            collection = session.client.local.devices
-            try:
-                device = await collection.find_one({'_id': ObjectId(device_id)})
-            except InvalidId:
-                device = None
-
-            if device is None:
-                error = ErrorSchema(type="Invalid id", message="Device not found")
-                response_message = ResponseSchema(status="Failure", results=error)
-                response.status_code = status.HTTP_400_BAD_REQUEST
-                return response_message
-
-            fields_names = [field['name'] for field in device['fields']]
-            response_device = DeviceResponseSchema(
-                name=device['name'],
-                type=device['type'],
-                fields=fields_names,
-            )
-            response = ResponseSchema(status='Success', results=response_device)
-            return response
+    device = await registry.fetch(device_id)
+
+    if device is None:
+        error = ErrorSchema(type="Invalid id", message="Device not found")
+        response_message = ResponseSchema(status="Failure", results=error)
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return response_message
+
+    fields_names = [field['name'] for field in device['fields']]
+    try:
+        # Every worker stores its own share of telemetry and commands
+        shadow = await shadows.fresh(device_id)
+    except PyMongoError:
+        # Values known to this worker are better than none
+        shadow = shadows.get(device_id)
+    response_device = DeviceResponseSchema(
+        name=device['name'],
+        type=device['type'],
+        fields=fields_names,
+        shadow=ShadowSchema(**shadow.as_dict()) if shadow is not None else None,
+    )
+    response = ResponseSchema(status='Success', results=response_device)
+    return response
+
+
+@router.get('/devices/{device_id}/history/', response_model=ResponseSchema)
+async def get_history(device_id: str,
+                      field: str,
+                      start: datetime,
+                      response: Response,
+                      end: datetime | None = None,
+                      resolution: Literal['auto', 'raw', '1m', '1h', '1d'] = 'auto',
+                      max_points: int = Query(500, gt=0, le=5000)):
+    """Get min, max and average of numeric field over time window, by default in the finest rollup
+    returning at most max_points points."""
+    device = await registry.fetch(device_id)
+    if device is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        error = ErrorSchema(type="Invalid id", message="Device not found")
+        return ResponseSchema(status="Failure", results=error)
+
+    if not any(field_spec['name'] == field and field_spec['type'] in ('int', 'float')
+               for field_spec in device['fields']):
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        error = ErrorSchema(type='Invalid Field', message=f'{device_id} has not numeric "{field}" field')
+        return ResponseSchema(status="Failure", results=error)
+
+    # Time without offset is UTC, like telemetry timestamps
+    start = start if start.tzinfo is not None else start.replace(tzinfo=timezone.utc)
+    if end is None:
+        end = datetime.now(timezone.utc)
+    elif end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    if start >= end:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        error = ErrorSchema(type='Invalid value', message='Start must be earlier than end')
+        return ResponseSchema(status="Failure", results=error)
+
+    if resolution == 'auto':
+        resolution = history.resolution(start, end, max_points)
+    points = await history.query(device_id, field, start, end, resolution, max_points)
+    return ResponseSchema(status='Success',
+                          results=HistorySchema(device_id=device_id, field=field, resolution=resolution, points=points))
 
 
 @router.get('/devices/', response_model=ResponseSchema)
-async def get_devices(response: Response):
-    async with await get_db_session() as session:
-        async with session.start_transaction():
-            collection = session.client.local.devices
-            devices = collection.find()
-            ids = [str(device['_id']) async for device in devices]
-            response_device = DevicesIdsSchema(device_ids=ids)
-            response_message = ResponseSchema(status="Success", results=response_device)
-            return response_message
+async def get_devices(response: Response,
+                      after: str | None = None,
+                      limit: int = Query(100, gt=0, le=1000),
+                      type: Literal["device", "sensor"] | None = None,
+                      name: str | None = None):
+    if after is not None:
+        try:
+            after = str(ObjectId(after))
+        except InvalidId:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            error = ErrorSchema(type="Invalid cursor", message="'after' must be device id")
+            return ResponseSchema(status="Failure", results=error)
+
+    ids, next_cursor = registry.page(after, limit, type, name)
+    response_device = DevicesIdsSchema(device_ids=ids, next_cursor=next_cursor)
+    response_message = ResponseSchema(status="Success", results=response_device)
+    return response_message
+
+
+@router.get('/stats/confirmation_latency/', response_model=ResponseSchema)
+async def get_confirmation_latency():
+    latency = LatencySchema(**sender.latency.percentiles())
+    return ResponseSchema(status='Success', results=latency)
+
+
+@router.get('/stats/push/', response_model=ResponseSchema)
+async def get_push_stats():
+    return ResponseSchema(status='Success', results=PushStatsSchema(**push.stats()))
+
+
+@router.get('/stats/telemetry/', response_model=ResponseSchema)
+async def get_telemetry_stats():
+    stats = TelemetryStatsSchema(**ingester.stats, pending=len(ingester.pending))
+    return ResponseSchema(status='Success', results=stats)
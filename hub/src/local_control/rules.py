@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import operator
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import OperationFailure, PyMongoError
+
+from .commands import CommandQueue, EXPIRED, FAILED
+from .shadow import ShadowStore
+
+logger = logging.getLogger('hub.rules')
+
+OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+
+class CompiledRule:
+    """Rule condition bound to its threshold"""
+
+    def __init__(self, rule: dict) -> None:
+        """Compile rule document
+
+            Args:
+                rule(dict): Rule document.
+        """
+        self.id = str(rule['_id'])
+        self.device_id = rule['device_id']
+        self.field = rule['field']
+        self.compare = OPERATORS[rule['operator']]
+        self.threshold = rule['threshold']
+        self.target = rule['action']['device_id']
+        self.changes = {field['name']: field['value'] for field in rule['action']['fields']}
+        self.debounce = rule.get('debounce', 0)
+        # Evaluations of rule in this worker are applied to stored state in order they are made
+        self.lock = asyncio.Lock()
+
+    def matches(self, value: object) -> bool:
+        try:
+            return self.compare(value, self.threshold)
+        except TypeError:
+            # Value of other type than threshold never matches
+            return False
+
+
+class RuleEngine:
+    """Local automation rules: when field of device crosses threshold, values of target device are changed.
+
+    Rules are indexed by trigger device id and field name, so changed values are checked only against rules
+    which could fire and evaluation cost doesn't depend on the total number of rules. Rule fires when its
+    condition becomes true and at most once per its debounce seconds, actions go through command queue.
+    Every hub worker evaluates telemetry it receives, so index follows rules collection by change stream,
+    or by periodic reload when change streams are unavailable, like device registry. Telemetry of one device
+    is spread over workers, so whether condition is true and when rule fired last is kept in rule document and
+    changed by conditional updates, only the worker whose update changes it fires rule."""
+
+    def __init__(self, commands: CommandQueue, shadows: ShadowStore, poll_interval: float = 5) -> None:
+        """Create new rule engine
+
+            Args:
+                commands(CommandQueue): Queue actions are submitted to.
+                shadows(ShadowStore): Shadows reporting changed values, current values are taken from them.
+                poll_interval(float): Seconds between reloads of rules if change stream can't be opened.
+        """
+        self.commands = commands
+        self.shadows = shadows
+        self.poll_interval = poll_interval
+        self.collection: AsyncIOMotorCollection | None = None
+        self.rules: dict[str, CompiledRule] = {}
+        # Rules by trigger device id and field name
+        self.index: dict[tuple[str, str], list[CompiledRule]] = {}
+        self.stats = {'evaluated': 0, 'fired': 0, 'debounced': 0}
+        self.evaluations: set[asyncio.Task] = set()
+        self._task: asyncio.Task | None = None
+
+    async def start(self, collection: AsyncIOMotorCollection) -> None:
+        """Load rules and start evaluating reported values.
+
+            Args:
+                collection(AsyncIOMotorCollection): Rules collection.
+        """
+        self.collection = collection
+        await self.reload()
+        self.shadows.listeners.append(self.evaluate)
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self.evaluate in self.shadows.listeners:
+            self.shadows.listeners.remove(self.evaluate)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in self.evaluations:
+            task.cancel()
+        await asyncio.gather(*self.evaluations, return_exceptions=True)
+
+    async def reload(self) -> None:
+        """Add rules created and remove rules deleted by other workers, state of kept rules is preserved."""
+        rules = {str(rule['_id']): rule async for rule in self.collection.find()}
+        for rule_id in self.rules.keys() - rules.keys():
+            self.remove(rule_id)
+        for rule_id in rules.keys() - self.rules.keys():
+            self.add(rules[rule_id])
+
+    async def _watch(self) -> None:
+        """Follow rules collection, falling back to polling if change streams aren't supported."""
+        resume_token = None
+        while True:
+            try:
+                async with self.collection.watch(resume_after=resume_token) as stream:
+                    async for change in stream:
+                        if change['operationType'] == 'insert':
+                            self.add(change['fullDocument'])
+                        elif change['operationType'] == 'delete':
+                            self.remove(str(change['documentKey']['_id']))
+                        resume_token = stream.resume_token
+            except OperationFailure as e:
+                if resume_token is None:
+                    logger.info('Change streams are unavailable, polling rules', extra={'error': str(e)})
+                    break
+                # Resume token is lost, start over from actual state
+                resume_token = None
+                await self.reload()
+            except PyMongoError:
+                await asyncio.sleep(1)
+
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.reload()
+            except PyMongoError:
+                continue
+
+    def add(self, rule: dict) -> None:
+        """Compile rule and add it to index, rule with the same id is replaced.
+
+            Args:
+                rule(dict): Rule document.
+        """
+        self.remove(str(rule['_id']))
+        compiled = CompiledRule(rule)
+        self.rules[compiled.id] = compiled
+        self.index.setdefault((compiled.device_id, compiled.field), []).append(compiled)
+
+    def remove(self, rule_id: str) -> bool:
+        """Remove rule from index.
+
+            Args:
+                rule_id(str): Rule id.
+
+            Returns:
+                bool: True if rule existed.
+        """
+        compiled = self.rules.pop(rule_id, None)
+        if compiled is None:
+            return False
+        key = (compiled.device_id, compiled.field)
+        self.index[key].remove(compiled)
+        if not self.index[key]:
+            del self.index[key]
+        return True
+
+    def evaluate(self, device_id: str, values: dict) -> None:
+        """Check changed values of device against rules triggered by them and fire matched ones.
+
+            Args:
+                device_id(str): Device id.
+                values(dict): Changed values by field name.
+        """
+        for name, value in values.items():
+            rules = self.index.get((device_id, name))
+            if rules is None:
+                continue
+            for rule in rules:
+                self.stats['evaluated'] += 1
+                task = asyncio.create_task(self._apply(rule, rule.matches(value)))
+                self.evaluations.add(task)
+                task.add_done_callback(self.evaluations.discard)
+
+    async def _apply(self, rule: CompiledRule, active: bool) -> None:
+        """Store result of evaluation and fire rule if this worker has seen condition become true first.
+
+            Args:
+                rule(CompiledRule): Evaluated rule.
+                active(bool): Condition is true for reported value.
+        """
+        object_id = ObjectId(rule.id)
+        async with rule.lock:
+            try:
+                result = await self.collection.update_one({'_id': object_id, 'active': {'$ne': active}},
+                                                          {'$set': {'active': active}})
+                if not active or result.modified_count == 0:
+                    return
+                now = datetime.now(timezone.utc)
+                result = await self.collection.update_one(
+                    {'_id': object_id, '$or': [{'fired_at': None},
+                                               {'fired_at': {'$lte': now - timedelta(seconds=rule.debounce)}}]},
+                    {'$set': {'fired_at': now}})
+            except PyMongoError as e:
+                logger.warning('Rule state is not stored, rule is not fired', extra={'rule_id': rule.id,
+                                                                                     'error': repr(e)})
+                return
+        if result.modified_count == 0:
+            self.stats['debounced'] += 1
+            return
+        if rule.id in self.rules:
+            self._fire(rule)
+
+    def _fire(self, rule: CompiledRule) -> None:
+        self.stats['fired'] += 1
+        record = self.commands.submit(rule.target, dict(rule.changes))
+        logger.info('Rule fired', extra={'rule_id': rule.id, 'device_id': rule.target, 'command_id': record.id})
+
+        def log_result(done: asyncio.Future) -> None:
+            if record.status in (EXPIRED, FAILED):
+                logger.warning('Rule action is not applied', extra={'rule_id': rule.id, 'command_id': record.id,
+                                                                    'status': record.status, 'error': record.error})
+        record.done.add_done_callback(log_result)
+
+    async def create(self, rule: dict) -> dict:
+        """Store new rule and start evaluating it.
+
+            Args:
+                rule(dict): Validated rule without id.
+
+            Returns:
+                dict: Stored rule document.
+        """
+        rule = {'_id': ObjectId(), **rule}
+        shadow = self.shadows.get(rule['device_id'])
+        value = shadow.reported.get(rule['field']) if shadow is not None else None
+        # Condition already true doesn't fire rule
+        rule['active'] = value is not None and CompiledRule(rule).matches(value)
+        rule['fired_at'] = None
+        await self.collection.insert_one(rule)
+        self.add(rule)
+        return rule
+
+    async def delete(self, rule_id: str) -> bool:
+        """Delete rule.
+
+            Args:
+                rule_id(str): Rule id.
+
+            Returns:
+                bool: True if rule existed.
+        """
+        result = await self.collection.delete_one({'_id': ObjectId(rule_id)})
+        return self.remove(rule_id) or result.deleted_count > 0
@@ -1,10 +1,93 @@
-from pydantic import BaseModel
+from datetime import datetime
+from typing import Literal
+from pydantic import BaseModel, Field
 
 
 class ChangingField(BaseModel):
     name: str
-    value: int | float | bool | str
+    value: bool | int | float | str
+
+
+class DeviceChangesSchema(BaseModel):
+    device_id: str
+    fields: list[ChangingField]
+
+
+class DeviceResultSchema(BaseModel):
+    device_id: str
+    status: Literal["confirmed", "queued", "failed", "invalid"]
+    error: str | None = None
+    command_id: str | None = None
+
+
+class RuleSchema(BaseModel):
+    name: str
+    device_id: str
+    field: str
+    operator: Literal[">", ">=", "<", "<=", "==", "!="]
+    threshold: bool | int | float | str
+    action: DeviceChangesSchema
+    debounce: float = Field(0, ge=0)
+
+
+class RuleResponseSchema(RuleSchema):
+    id: str
+
+
+class PushEventSchema(BaseModel):
+    event: Literal["telemetry", "state"]
+    device_id: str
+    values: dict[str, bool | int | float | str]
+    time: datetime
+
+
+class PushStatsSchema(BaseModel):
+    subscribers: int
+    delivered: int
+    coalesced: int
+    dropped: int
+
+
+class HistoryPointSchema(BaseModel):
+    time: datetime
+    min: float
+    max: float
+    avg: float
+    count: int
+
+
+class HistorySchema(BaseModel):
+    device_id: str
+    field: str
+    resolution: Literal["raw", "1m", "1h", "1d"]
+    points: list[HistoryPointSchema]
 
 
 class DevicesIdsSchema(BaseModel):
     device_ids: list[str]
+    next_cursor: str | None = None
+
+
+class LatencySchema(BaseModel):
+    count: int
+    p50: float | None
+    p99: float | None
+
+
+class TelemetryStatsSchema(BaseModel):
+    received: int
+    written: int
+    invalid: int
+    dropped: int
+    failed: int
+    pending: int
+
+
+class CommandStatusSchema(BaseModel):
+    id: str
+    device_id: str
+    changes: dict[str, bool | int | float | str]
+    status: Literal["queued", "sent", "confirmed", "superseded", "expired", "failed"]
+    error: str | None = None
+    created_at: datetime
+    updated_at: datetime
@@ -1,45 +1,205 @@
 import paho.mqtt.client as mqtt
 import asyncio
-from datetime import datetime, timedelta
+import json
+import os
+import uuid
+from typing import Callable
+from collections import deque
+from statistics import quantiles
+from pydantic import ValidationError
 from config import EMQX_PORT, HOST
+from metrics import MQTT_COMMAND_SECONDS
 from .mqtt_schemas import ConfirmSchema, CommandSchema
 
+# EMQX system message published when client connects, username of device client is device id
+CONNECTED_TOPIC = '$SYS/brokers/+/clients/+/connected'
+
+
+class LatencyStats:
+    """Keeps last confirmation latencies and computes percentiles over them"""
+
+    def __init__(self, size: int = 1000) -> None:
+        self.samples: deque[float] = deque(maxlen=size)
+
+    def add(self, latency: float) -> None:
+        self.samples.append(latency)
+
+    def percentiles(self) -> dict[str, float | int | None]:
+        """Get count, p50 and p99 of stored latencies in milliseconds.
+
+            Returns:
+                dict: Number of samples, p50 and p99, percentiles are None if there are no samples.
+        """
+        count = len(self.samples)
+        if count == 0:
+            return {'count': 0, 'p50': None, 'p99': None}
+        if count == 1:
+            p50 = p99 = self.samples[0]
+        else:
+            cuts = quantiles(self.samples, n=100, method='inclusive')
+            p50, p99 = cuts[49], cuts[98]
+        return {'count': count, 'p50': p50 * 1000, 'p99': p99 * 1000}
+
 
 class MQTTSender:
+    """Long-lived MQTT connection that sends commands to devices and matches confirmations to them.
 
-    def __init__(self, mqtt_user: str, mqtt_password: str) -> None:
-        self.client = mqtt.Client(client_id=mqtt_user)
+    Every hub worker has its own sender with its own client id. Messages of device are subscribed without shared
+    group only while commands this worker has sent to it wait for confirmation, so broker doesn't send telemetry
+    of every device to every worker, and worker resolves only correlation ids of commands it has sent itself.
+    Connected devices are announced through shared group, worker receiving announcement resynchronizes device
+    from stored shadow."""
+
+    def __init__(self, mqtt_user: str, mqtt_password: str, timeout: float = 20, group: str = 'hub-connected') -> None:
+        """Create new instance of MQTT sender
+
+            Args:
+                mqtt_user(str): EMQX username.
+                mqtt_password(str): EMQX password.
+                timeout(float): Default seconds to wait for device confirmation.
+                group(str): Shared subscription group of device connection announcements.
+        """
+        # Client id is unique per process, broker disconnects previous client connecting with the same id
+        self.client_id = f'{mqtt_user}-sender-{os.getpid()}'
+        self.client = mqtt.Client(client_id=self.client_id)
         self.client.username_pw_set(mqtt_user, mqtt_password)
-        self.confirm = False
-        self.message = None
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._receive_confirm
+        self.client.message_callback_add(CONNECTED_TOPIC, self._receive_connected)
+        self.timeout = timeout
+        self.connected_topic = f'$share/{group}/{CONNECTED_TOPIC}'
+        self.latency = LatencyStats()
+        self.loop: asyncio.AbstractEventLoop | None = None
+        # Futures of commands waiting for confirmation by correlation id
+        self.pending: dict[str, asyncio.Future] = {}
+        # Correlation ids in sending order per device topic, for devices that don't echo correlation id
+        self.pending_by_topic: dict[str, deque[str]] = {}
+        # Called in event loop with device id when device connects to broker
+        self.on_device_connected: Callable[[str], None] | None = None
+
+    async def connect(self) -> None:
+        """Open connection to EMQX and start network loop in background thread."""
+        self.loop = asyncio.get_running_loop()
+        self.client.connect_async(host=HOST,
+                                  port=EMQX_PORT)
+        self.client.loop_start()
+
+    def disconnect(self) -> None:
+        """Close connection and cancel commands waiting for confirmation."""
+        self.client.disconnect()
+        self.client.loop_stop()
+        for future in self.pending.values():
+            if not future.done():
+                future.cancel()
+        self.pending.clear()
+        self.pending_by_topic.clear()
+
+    def _on_connect(self, client, user_data, flags, rc):
+        # Subscribe on every (re)connect, clean session drops subscriptions
+        topics = [f'{topic}/publish' for topic in list(self.pending_by_topic)]
+        client.subscribe([(self.connected_topic, 0)] + [(topic, 0) for topic in topics])
+
+    def _receive_connected(self, client, user_data, message):
+        """Pass connected device id from paho network thread to event loop."""
+        if self.on_device_connected is None:
+            return
+        try:
+            username = json.loads(message.payload)['username']
+        except (ValueError, KeyError, TypeError):
+            return
+        if username:
+            self.loop.call_soon_threadsafe(self.on_device_connected, username)
 
     def _receive_confirm(self, client, user_data, message):
-        confirmation = ConfirmSchema.model_validate_json(message.payload)
+        """Pass confirmation from paho network thread to event loop."""
+        topic = message.topic.removesuffix('/publish')
+        # Index is only read here, data of devices this worker doesn't wait for isn't even parsed
+        if topic not in self.pending_by_topic:
+            return
+        try:
+            confirmation = ConfirmSchema.model_validate_json(message.payload)
+        except ValidationError:
+            # Not a confirmation, e.g. sensor data
+            return
         if confirmation.status:
-            self.confirm = True
-            self.message = confirmation.message
+            self.loop.call_soon_threadsafe(self._resolve, topic, confirmation)
+
+    def _resolve(self, topic: str, confirmation: ConfirmSchema) -> None:
+        """Set result of command confirmed by device.
+
+            Args:
+                topic(str): Command topic of device.
+                confirmation(ConfirmSchema): Received confirmation.
+        """
+        if confirmation.correlation_id is not None:
+            # Unknown id belongs to command of other worker
+            future = self.pending.get(confirmation.correlation_id)
+        else:
+            # Device doesn't echo correlation id, confirm the oldest unconfirmed command sent to it
+            future = None
+            for correlation_id in self.pending_by_topic.get(topic, ()):
+                if not self.pending[correlation_id].done():
+                    future = self.pending[correlation_id]
+                    break
+        if future is not None and not future.done():
+            future.set_result(confirmation.message)
+
+    def forget(self, topic: str, correlation_id: str) -> None:
+        """Stop waiting for confirmation of command.
+
+            Args:
+                topic(str): Command topic of device.
+                correlation_id(str): Correlation id of command.
+        """
+        self.pending.pop(correlation_id, None)
+        topic_queue = self.pending_by_topic.get(topic)
+        if topic_queue is not None:
+            topic_queue.remove(correlation_id)
+            if not topic_queue:
+                del self.pending_by_topic[topic]
+                self.client.unsubscribe(f'{topic}/publish')
 
-    async def send_command(self, topic: str, command: CommandSchema) -> str:
-        self.client.connect(host=HOST,
-                            port=EMQX_PORT)
+    def observe(self, outcome: str, latency: float) -> None:
+        """Record how long command waited for confirmation.
 
-        self.confirm = False
-        self.message = None
+            Args:
+                outcome(str): 'confirmed' or 'timeout'.
+                latency(float): Seconds since command was published.
+        """
+        if outcome == 'confirmed':
+            self.latency.add(latency)
+        MQTT_COMMAND_SECONDS.labels(outcome).observe(latency)
 
+    def publish_command(self, topic: str, command: CommandSchema, retain: bool = False) -> tuple[str, asyncio.Future]:
+        """Send command to device without waiting, caller must 'forget' it when confirmation isn't needed anymore.
+
+            Args:
+                topic(str): Device topic.
+                command(CommandSchema): Command to send.
+                retain(bool): Keep command in broker, so device gets it when it subscribes again.
+
+            Returns:
+                tuple[str, asyncio.Future]: Correlation id and future resolved with device confirmation message.
+        """
+        correlation_id = uuid.uuid4().hex
+        command = command.model_copy(update={'correlation_id': correlation_id})
+        future = self.loop.create_future()
+        self.pending[correlation_id] = future
+        if topic not in self.pending_by_topic:
+            # Subscription is sent before command, so confirmation can't pass by it
+            self.client.subscribe(f'{topic}/publish', qos=0)
+            self.pending_by_topic[topic] = deque()
+        self.pending_by_topic[topic].append(correlation_id)
         self.client.publish(topic=topic,
-                            payload=command.model_to_json(),
-                            qos=2)
-        receive_topic = f'{topic}/publish'
-        self.client.subscribe(receive_topic, qos=0)
-        self.client.on_message = self._receive_confirm
-        self.client.loop_start()
-        start = datetime.now()
+                            payload=command.model_dump_json(),
+                            qos=2,
+                            retain=retain)
+        return correlation_id, future
 
-        while not self.confirm:
-            await asyncio.sleep(0.5)
-            if datetime.now() - start > timedelta(seconds=20):
-                raise TimeoutError("Confirm message hasn't received")
+    def clear_retained(self, topic: str) -> None:
+        """Remove command retained in broker for device topic.
 
-        self.client.loop_stop()
-        self.client.disconnect()
-        return self.message
+            Args:
+                topic(str): Device topic.
+        """
+        self.client.publish(topic=topic, payload=b'', qos=1, retain=True)
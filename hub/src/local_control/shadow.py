@@ -0,0 +1,324 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Callable
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import PyMongoError
+
+from .registry import DeviceRegistry
+
+logger = logging.getLogger('hub.shadow')
+
+
+def _same(first: object, second: object) -> bool:
+    # True == 1 in python, but they are different values of device fields
+    return type(first) is type(second) and first == second
+
+
+class Shadow:
+    """Last reported and desired field values of one device"""
+
+    def __init__(self,
+                 reported: dict | None = None,
+                 desired: dict | None = None,
+                 version: int = 0,
+                 updated_at: datetime | None = None) -> None:
+        self.reported: dict = reported or {}
+        self.desired: dict = desired or {}
+        self.version = version
+        self.updated_at = updated_at or datetime.now(timezone.utc)
+
+    def delta(self) -> dict:
+        """Get desired values device hasn't reported yet.
+
+            Returns:
+                dict: Values by field name.
+        """
+        return {name: value for name, value in self.desired.items()
+                if name not in self.reported or not _same(self.reported[name], value)}
+
+    def as_dict(self) -> dict:
+        return {'reported': self.reported, 'desired': self.desired, 'delta': self.delta(),
+                'version': self.version, 'updated_at': self.updated_at}
+
+
+class ShadowChanges:
+    """Fields of one shadow changed since last flush"""
+
+    def __init__(self) -> None:
+        self.reported: set[str] = set()
+        # Set or reached desired fields
+        self.desired: set[str] = set()
+        self.versions = 0
+
+    def merge(self, other: 'ShadowChanges') -> None:
+        self.reported |= other.reported
+        self.desired |= other.desired
+        self.versions += other.versions
+
+
+class ShadowStore:
+    """Device shadows kept in memory and written to database in batches.
+
+    Reported state comes from device telemetry and confirmed commands, desired state from requested commands.
+    Every change bumps shadow version and marks it dirty, dirty shadows are flushed periodically with one bulk
+    write, so frequent telemetry costs one write per device per flush interval at most. Only changed fields are
+    written and version is incremented, so hub workers sharing telemetry don't overwrite fields of each other."""
+
+    def __init__(self,
+                 registry: DeviceRegistry,
+                 flush_interval: float = 1,
+                 batch_size: int = 1000,
+                 max_age: float = 1) -> None:
+        """Create new empty shadow store
+
+            Args:
+                registry(DeviceRegistry): Registry of existing devices, initial reported values are taken from it.
+                flush_interval(float): Seconds between writes of changed shadows.
+                batch_size(int): Max number of shadows in one bulk write.
+                max_age(float): Seconds shadow read by 'fresh' can miss values stored by other workers.
+        """
+        self.registry = registry
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.collection: AsyncIOMotorCollection | None = None
+        self.shadows: dict[str, Shadow] = {}
+        # Changes of shadows since last flush by device id, dict keeps order of changes
+        self.dirty: dict[str, ShadowChanges] = {}
+        # Changes of shadows being written by current flush
+        self.flushing: dict[str, ShadowChanges] = {}
+        # Event loop time of last read of stored shadow by device id
+        self.refreshed: dict[str, float] = {}
+        # Called with device id and reported values which changed
+        self.listeners: list[Callable[[str, dict], None]] = []
+        self._task: asyncio.Task | None = None
+
+    async def start(self, collection: AsyncIOMotorCollection) -> None:
+        """Load stored shadows and start periodic flushes.
+
+            Args:
+                collection(AsyncIOMotorCollection): Shadows collection.
+        """
+        self.collection = collection
+        async for document in collection.find():
+            self.shadows[str(document['_id'])] = Shadow(document.get('reported'),
+                                                        document.get('desired'),
+                                                        document.get('version', 0),
+                                                        document.get('updated_at'))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop periodic flushes and write changes made since last one."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except PyMongoError as e:
+            logger.error('Shadows are not written', extra={'shadows': len(self.dirty), 'error': repr(e)})
+
+    def get(self, device_id: str) -> Shadow | None:
+        """Get shadow of device, creating it from registry if device has none yet.
+
+            Args:
+                device_id(str): Device id.
+
+            Returns:
+                Shadow | None: Device shadow or None if device doesn't exist.
+        """
+        shadow = self.shadows.get(device_id)
+        if shadow is None:
+            device = self.registry.get(device_id)
+            if device is None:
+                return None
+            # Values confirmed before device got shadow
+            shadow = Shadow(reported={field['name']: field['value'] for field in device['fields']
+                                      if field.get('value') is not None})
+            self.shadows[device_id] = shadow
+        return shadow
+
+    def delta(self, device_id: str) -> dict:
+        shadow = self.get(device_id)
+        return shadow.delta() if shadow is not None else {}
+
+    async def fresh(self, device_id: str) -> Shadow | None:
+        """Get shadow of device, reading stored one if it was read more than max age ago.
+
+            Args:
+                device_id(str): Device id.
+
+            Returns:
+                Shadow | None: Device shadow or None if device doesn't exist.
+
+            Raises:
+                PyMongoError: If shadow can't be read.
+        """
+        refreshed = self.refreshed.get(device_id)
+        if refreshed is None or asyncio.get_running_loop().time() - refreshed >= self.max_age:
+            return await self.refresh(device_id)
+        return self.get(device_id)
+
+    async def refresh(self, device_id: str) -> Shadow | None:
+        """Read stored shadow of device, written by all hub workers, keeping changes this worker hasn't written yet.
+
+            Args:
+                device_id(str): Device id.
+
+            Returns:
+                Shadow | None: Device shadow or None if device doesn't exist.
+
+            Raises:
+                PyMongoError: If shadow can't be read.
+        """
+        if self.get(device_id) is None:
+            # Not a device, e.g. hub service connected to broker
+            return None
+        read_at = asyncio.get_running_loop().time()
+        document = await self.collection.find_one({'_id': ObjectId(device_id)})
+        shadow = self.get(device_id)
+        if shadow is not None:
+            self.refreshed[device_id] = read_at
+        if document is None or shadow is None:
+            return shadow
+        local = ShadowChanges()
+        for changes in (self.flushing.get(device_id), self.dirty.get(device_id)):
+            if changes is not None:
+                local.merge(changes)
+        reported = document.get('reported') or {}
+        reported.update({name: shadow.reported[name] for name in local.reported})
+        desired = document.get('desired') or {}
+        for name in local.desired:
+            if name in shadow.desired:
+                desired[name] = shadow.desired[name]
+            else:
+                desired.pop(name, None)
+        shadow.reported = reported
+        shadow.desired = desired
+        shadow.version = document.get('version', 0) + local.versions
+        if document.get('updated_at') is not None:
+            shadow.updated_at = max(shadow.updated_at, document['updated_at'].replace(tzinfo=timezone.utc))
+        return shadow
+
+    def report(self, device_id: str, values: dict) -> None:
+        """Update state reported by device, desired values it reached are dropped.
+
+            Args:
+                device_id(str): Device id.
+                values(dict): Reported values by field name.
+        """
+        shadow = self.get(device_id)
+        if shadow is None:
+            return
+        changed = {name: value for name, value in values.items()
+                   if name not in shadow.reported or not _same(shadow.reported[name], value)}
+        reached = [name for name, value in shadow.desired.items() if name in values and _same(values[name], value)]
+        if not changed and not reached:
+            return
+        shadow.reported.update(changed)
+        for name in reached:
+            del shadow.desired[name]
+        changes = self._touch(device_id, shadow)
+        changes.reported.update(changed)
+        changes.desired.update(reached)
+        if changed:
+            for listener in self.listeners:
+                listener(device_id, changed)
+
+    def desire(self, device_id: str, values: dict) -> None:
+        """Update state requested for device.
+
+            Args:
+                device_id(str): Device id.
+                values(dict): Requested values by field name.
+        """
+        shadow = self.get(device_id)
+        if shadow is None:
+            return
+        changed = {name: value for name, value in values.items()
+                   if name not in shadow.desired or not _same(shadow.desired[name], value)}
+        if not changed:
+            return
+        shadow.desired.update(changed)
+        self._touch(device_id, shadow).desired.update(changed)
+
+    def _touch(self, device_id: str, shadow: Shadow) -> ShadowChanges:
+        shadow.version += 1
+        shadow.updated_at = datetime.now(timezone.utc)
+        changes = self.dirty.get(device_id)
+        if changes is None:
+            changes = self.dirty[device_id] = ShadowChanges()
+        changes.versions += 1
+        return changes
+
+    def _updates(self, device_id: str, device: dict, changes: ShadowChanges) -> list[UpdateOne]:
+        """Build writes of changed fields of shadow.
+
+            Args:
+                device_id(str): Device id.
+                device(dict): Device document.
+                changes(ShadowChanges): Fields changed since last flush.
+
+            Returns:
+                list[UpdateOne]: Shadow update and removals of desired values reached according to other workers.
+        """
+        shadow = self.shadows[device_id]
+        object_id = ObjectId(device_id)
+        update = {'$inc': {'version': changes.versions}, '$max': {'updated_at': shadow.updated_at}}
+        for name in changes.reported:
+            update.setdefault('$set', {})[f'reported.{name}'] = shadow.reported[name]
+        for name in changes.desired:
+            if name in shadow.desired:
+                update.setdefault('$set', {})[f'desired.{name}'] = shadow.desired[name]
+            else:
+                update.setdefault('$unset', {})[f'desired.{name}'] = ''
+        operations = [UpdateOne({'_id': object_id}, update, upsert=True)]
+        if device['type'] != 'sensor':
+            # Value could be desired by request served by other worker, it is reached if it is equal
+            operations.extend(UpdateOne({'_id': object_id, f'desired.{name}': shadow.reported[name]},
+                                        {'$unset': {f'desired.{name}': ''}})
+                              for name in changes.reported if name not in changes.desired)
+        return operations
+
+    async def flush(self) -> None:
+        """Write changed shadows, shadows of removed devices are deleted.
+
+            Raises:
+                PyMongoError: If write fails, shadows stay dirty and are written by next flush.
+        """
+        while self.dirty:
+            batch = {device_id: self.dirty.pop(device_id) for device_id in list(self.dirty)[:self.batch_size]}
+            operations = []
+            for device_id, changes in batch.items():
+                device = self.registry.get(device_id)
+                if device is None:
+                    self.shadows.pop(device_id, None)
+                    self.refreshed.pop(device_id, None)
+                    operations.append(DeleteOne({'_id': ObjectId(device_id)}))
+                    continue
+                operations.extend(self._updates(device_id, device, changes))
+            self.flushing = batch
+            try:
+                await self.collection.bulk_write(operations, ordered=False)
+            except PyMongoError:
+                for device_id, changes in batch.items():
+                    if device_id in self.dirty:
+                        changes.merge(self.dirty[device_id])
+                    self.dirty[device_id] = changes
+                raise
+            finally:
+                self.flushing = {}
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except PyMongoError as e:
+                logger.warning('Shadows are not written', extra={'shadows': len(self.dirty), 'error': repr(e)})
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import os
+import threading
+from collections import deque
+from datetime import datetime, timezone
+import paho.mqtt.client as mqtt
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError, CollectionInvalid, PyMongoError
+from config import EMQX_PORT, HOST
+from .mqtt_schemas import TelemetrySchema
+from .history import TelemetryHistory
+from .registry import DeviceRegistry
+from .shadow import ShadowStore
+
+logger = logging.getLogger('hub.telemetry')
+
+
+class TelemetryIngester:
+    """Consumes sensor data from shared MQTT subscription and writes it to time-series collection in batches"""
+
+    def __init__(self,
+                 mqtt_user: str,
+                 mqtt_password: str,
+                 registry: DeviceRegistry,
+                 shadows: ShadowStore,
+                 history: TelemetryHistory,
+                 retention: int = 0,
+                 group: str = 'hub-telemetry',
+                 max_pending: int = 100_000,
+                 batch_size: int = 1000,
+                 flush_interval: float = 0.2,
+                 writers: int = 2,
+                 block_timeout: float = 0.5) -> None:
+        """Create new instance of telemetry ingester
+
+            Args:
+                mqtt_user(str): EMQX username.
+                mqtt_password(str): EMQX password.
+                registry(DeviceRegistry): Registry used to validate data by device fields.
+                shadows(ShadowStore): Shadows updated with reported values.
+                history(TelemetryHistory): History rollups updated with written values.
+                retention(int): Seconds raw data is kept, 0 keeps it forever.
+                group(str): Shared subscription group, hub workers in one group split messages between them.
+                max_pending(int): Max number of received messages waiting to be written.
+                batch_size(int): Max number of documents in one insert.
+                flush_interval(float): Max seconds message waits for batch to fill.
+                writers(int): Number of concurrent inserts.
+                block_timeout(float): Seconds network thread waits for free space before dropping message.
+        """
+        # Client id is unique per process, so several hub workers can join one shared subscription
+        self.client = mqtt.Client(client_id=f'{mqtt_user}-telemetry-{os.getpid()}')
+        self.client.username_pw_set(mqtt_user, mqtt_password)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._receive_data
+        self.registry = registry
+        self.shadows = shadows
+        self.history = history
+        self.retention = retention
+        self.topic = f'$share/{group}//devices/+/publish'
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.writers = writers
+        self.block_timeout = block_timeout
+
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.collection = None
+        # Filled by paho network thread, drained by writer tasks
+        self.pending: deque[tuple[str, bytes, datetime]] = deque()
+        self._drained = threading.Event()
+        self._wakeup: asyncio.Event | None = None
+        self._wakeup_scheduled = False
+        self._tasks: list[asyncio.Task] = []
+        self.stats = {'received': 0, 'written': 0, 'invalid': 0, 'dropped': 0, 'failed': 0}
+
+    async def start(self, database: AsyncIOMotorDatabase, collection_name: str = 'telemetry') -> None:
+        """Create time-series collection if needed, connect to EMQX and start writers.
+
+            Args:
+                database(AsyncIOMotorDatabase): Database for telemetry.
+                collection_name(str): Time-series collection name.
+        """
+        expiration = {'expireAfterSeconds': self.retention} if self.retention else {}
+        try:
+            await database.create_collection(collection_name,
+                                             timeseries={'timeField': 'timestamp',
+                                                         'metaField': 'device_id',
+                                                         'granularity': 'seconds'},
+                                             **expiration)
+        except CollectionInvalid:
+            # Retention may be changed since collection is created
+            await database.command({'collMod': collection_name, 'expireAfterSeconds': self.retention or 'off'})
+        self.collection = database[collection_name]
+        self.loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._write()) for _ in range(self.writers)]
+        self.client.connect_async(host=HOST,
+                                  port=EMQX_PORT)
+        self.client.loop_start()
+
+    async def stop(self) -> None:
+        """Disconnect from EMQX and write messages received before."""
+        self.client.disconnect()
+        self.client.loop_stop()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while self.pending:
+            await self._write_batch()
+
+    def _on_connect(self, client, user_data, flags, rc):
+        client.subscribe(self.topic, qos=0)
+
+    def _receive_data(self, client, user_data, message):
+        """Put received message to pending queue, runs in paho network thread."""
+        self.stats['received'] += 1
+        if len(self.pending) >= self.max_pending:
+            # Stop reading socket for a while, so broker keeps messages instead of us
+            self._drained.clear()
+            self._drained.wait(self.block_timeout)
+            if len(self.pending) >= self.max_pending:
+                self.stats['dropped'] += 1
+                return
+        self.pending.append((message.topic, message.payload, datetime.now(timezone.utc)))
+        if len(self.pending) >= self.batch_size and not self._wakeup_scheduled:
+            self._wakeup_scheduled = True
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _parse(self, topic: str, payload: bytes, received: datetime) -> dict | None:
+        """Build telemetry document from message.
+
+            Args:
+                topic(str): Message topic.
+                payload(bytes): Message payload.
+                received(datetime): Time message is received.
+
+            Returns:
+                dict | None: Document to insert or None if message isn't valid sensor data.
+        """
+        device_id = topic.split('/')[2]
+        device = self.registry.get(device_id)
+        if device is None:
+            return None
+        try:
+            telemetry = TelemetrySchema.model_validate_json(payload)
+        except ValidationError:
+            return None
+        if not self.registry.validator(device).is_valid(telemetry.values):
+            return None
+        return {'timestamp': telemetry.timestamp or received,
+                'device_id': device_id,
+                'values': telemetry.values}
+
+    async def _write_batch(self) -> None:
+        """Take up to batch size messages from queue and insert valid ones."""
+        documents = []
+        invalid = 0
+        while self.pending and len(documents) + invalid < self.batch_size:
+            document = self._parse(*self.pending.popleft())
+            if document is None:
+                invalid += 1
+            else:
+                self.shadows.report(document['device_id'], document['values'])
+                documents.append(document)
+        self._drained.set()
+        self.stats['invalid'] += invalid
+        if not documents:
+            return
+        try:
+            await self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # Unordered insert writes every document but failed ones, they are rolled up
+            failed = {error['index'] for error in e.details['writeErrors']}
+            logger.error('Telemetry batch is partially written', extra={'documents': len(documents),
+                                                                        'failed': len(failed), 'error': repr(e)})
+            self.stats['failed'] += len(failed)
+            documents = [document for index, document in enumerate(documents) if index not in failed]
+        except PyMongoError as e:
+            logger.error('Telemetry batch is not written', extra={'documents': len(documents), 'error': repr(e)})
+            self.stats['failed'] += len(documents)
+            return
+        self.stats['written'] += len(documents)
+        if not documents:
+            return
+        try:
+            await self.history.add(documents)
+        except PyMongoError as e:
+            logger.error('Telemetry rollups are not updated, failed updates are retried with next batch',
+                         extra={'documents': len(documents), 'error': repr(e)})
+
+    async def _write(self) -> None:
+        """Writer loop, flushes on full batch or after flush interval."""
+        while True:
+            try:
+                async with asyncio.timeout(self.flush_interval):
+                    await self._wakeup.wait()
+            except TimeoutError:
+                pass
+            self._wakeup.clear()
+            self._wakeup_scheduled = False
+            while self.pending:
+                await self._write_batch()
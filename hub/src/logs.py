@@ -0,0 +1,68 @@
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from datetime import datetime, timezone
+
+# Attributes every log record has, anything else is passed by caller in 'extra' and logged as field
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats record as one json line with time, level, logger, message and extra fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'message': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for listener of the same process, exception info is kept for formatter of listener."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Default prepare appends traceback to message and drops exc_info
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(level: str = 'INFO') -> None:
+    """Send hub logs through queue to background thread, so event loop never waits for stream writes.
+
+        Args:
+            level(str): Minimal level of logged records.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    records = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JSONFormatter())
+    _listener = logging.handlers.QueueListener(records, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+    logger = logging.getLogger('hub')
+    logger.setLevel(level)
+    logger.handlers = [LocalQueueHandler(records)]
+    logger.propagate = False
+
+
+def stop_logging() -> None:
+    """Write queued records and stop background thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,8 +1,45 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from registration.router import router as reg_router
+from registration.router import emqx_client, registration_service, registration_lock
+from registration.registrator import Registrator
 from local_control.router import router as local_control_router
+from local_control.router import sender, registry, shadows, history, ingester, commands, rules, push
+from config import TELEMETRY_DB, LOG_LEVEL
+from logs import setup_logging, stop_logging
+from metrics import metrics_endpoint
+import database
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    setup_logging(LOG_LEVEL)
+    database.connect()
+    await database.create_indexes()
+    await emqx_client.start()
+    await sender.connect()
+    await registry.start(database.get_read_collection('devices'))
+    await shadows.start(database.client.local.shadows)
+    await rules.start(database.client.local.rules)
+    await push.start()
+    await history.start(database.client[TELEMETRY_DB])
+    await ingester.start(database.client[TELEMETRY_DB])
+    await registration_service.start_elected(Registrator(emqx_client, database.client), registration_lock)
+    yield
+    registration_service.stop()
+    push.stop()
+    await rules.stop()
+    await commands.stop()
+    await ingester.stop()
+    await shadows.stop()
+    await registry.stop()
+    sender.disconnect()
+    await emqx_client.close()
+    database.close()
+    stop_logging()
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(reg_router)
 app.include_router(local_control_router)
+app.add_api_route('/metrics', metrics_endpoint, include_in_schema=False)
@@ -0,0 +1,77 @@
+import re
+import time
+from contextlib import contextmanager
+from fastapi import Response
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+from pymongo import monitoring
+
+# Buckets in seconds, from sub-millisecond local calls to device round trips close to command timeout
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+SLOW_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 60)
+
+MQTT_COMMAND_SECONDS = Histogram('hub_mqtt_command_seconds',
+                                 'Time from command publish to device confirmation',
+                                 ['outcome'], buckets=SLOW_BUCKETS)
+MONGO_OPERATION_SECONDS = Histogram('hub_mongo_operation_seconds',
+                                    'Mongo command latency measured by driver',
+                                    ['command', 'outcome'], buckets=FAST_BUCKETS)
+EMQX_API_SECONDS = Histogram('hub_emqx_api_seconds',
+                             'EMQX management API request latency including retries',
+                             ['method', 'endpoint', 'status'], buckets=SLOW_BUCKETS)
+REGISTRATION_STAGE_SECONDS = Histogram('hub_registration_stage_seconds',
+                                       'Duration of device registration stages',
+                                       ['stage', 'outcome'], buckets=SLOW_BUCKETS)
+DISCOVERY_REPLY_SECONDS = Histogram('hub_discovery_reply_seconds',
+                                    'Time to handle discovery datagram',
+                                    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005))
+DISCOVERY_REQUESTS = Counter('hub_discovery_requests_total',
+                             'Discovery datagrams by result',
+                             ['result'])
+
+OBJECT_ID = re.compile(r'/[0-9a-f]{24}(?=/|$)')
+
+
+def endpoint_label(path: str) -> str:
+    """Replace device ids in API path, so every device doesn't get own label value.
+
+        Args:
+            path(str): Request path.
+
+        Returns:
+            str: Path with '{id}' in place of object ids.
+    """
+    return OBJECT_ID.sub('/{id}', path)
+
+
+@contextmanager
+def registration_stage(stage: str):
+    """Observe duration of registration stage, stage fails if block raises.
+
+        Args:
+            stage(str): Stage name.
+    """
+    start = time.perf_counter()
+    outcome = 'failure'
+    try:
+        yield
+        outcome = 'success'
+    finally:
+        REGISTRATION_STAGE_SECONDS.labels(stage, outcome).observe(time.perf_counter() - start)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Driver command listener observing duration of every Mongo command, runs in driver threads."""
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        MONGO_OPERATION_SECONDS.labels(event.command_name, 'success').observe(event.duration_micros / 1e6)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        MONGO_OPERATION_SECONDS.labels(event.command_name, 'failure').observe(event.duration_micros / 1e6)
+
+
+async def metrics_endpoint() -> Response:
+    """Expose collected metrics in Prometheus text format."""
+    return Response(generate_latest(), headers={'Content-Type': CONTENT_TYPE_LATEST})
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from pymongo.errors import PyMongoError
+
+from .exceptions import RegistrationError, RegistrationRequestError
+from .registrator import DELIVERED, Registrator
+
+logger = logging.getLogger('hub.registration')
+
+
+class Reconciler:
+    """Background task compensating abandoned registrations and fixing drift between devices collection
+    and EMQX users and ACL rules."""
+
+    def __init__(self,
+                 registrator: Registrator,
+                 interval: float = 300,
+                 stale_after: float = 300,
+                 concurrency: int = 20) -> None:
+        """Create new reconciler
+
+            Args:
+                registrator(Registrator): Registrator, its outbox and EMQX client are used.
+                interval(float): Seconds between reconciliation runs.
+                stale_after(float): Seconds after last step registration is considered abandoned, must be
+                    longer than credentials delivery takes.
+                concurrency(int): Max number of concurrent EMQX requests.
+        """
+        self.registrator = registrator
+        self.interval = interval
+        self.stale_after = stale_after
+        self.concurrency = concurrency
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.reconcile()
+            except (PyMongoError, RegistrationRequestError, RegistrationError) as e:
+                logger.warning('Reconciliation failed', extra={'error': repr(e)})
+            await asyncio.sleep(self.interval)
+
+    async def _compensate_stale(self) -> int:
+        """Roll back registrations which steps stopped long ago, e.g. hub crashed in the middle.
+
+            Returns:
+                int: Number of compensated registrations.
+        """
+        deadline = datetime.now(timezone.utc) - timedelta(seconds=self.stale_after)
+        # Confirmed registrations are never compensated, even if completing them is still retried
+        stale = {'updated_at': {'$lt': deadline}, 'state': {'$ne': DELIVERED},
+                 '_id': {'$nin': [ObjectId(device_id) for device_id in self.registrator.completing]}}
+        device_ids = [str(registration['_id']) async for registration
+                      in self.registrator.outbox.find(stale, {'_id': 1})]
+        if device_ids and await self.registrator.rollback(device_ids, 'Registration is abandoned', self.concurrency):
+            return len(device_ids)
+        return 0
+
+    async def _delete(self, rollback, device_ids: set[str]) -> int:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def limited(device_id: str) -> None:
+            async with semaphore:
+                await rollback(device_id)
+
+        results = await asyncio.gather(*[limited(device_id) for device_id in device_ids], return_exceptions=True)
+        return sum(not isinstance(result, Exception) for result in results)
+
+    async def reconcile(self) -> dict[str, int]:
+        """Run one reconciliation.
+
+        EMQX state is read before outbox and devices, so user created by registration running meanwhile is
+        either found in outbox or its device document is found.
+
+            Returns:
+                dict[str, int]: Number of fixed or found items of every kind.
+        """
+        # Confirmed registrations which outbox documents weren't removed
+        stats = {'delivered': (await self.registrator.outbox.delete_many({'state': DELIVERED})).deleted_count,
+                 'abandoned': await self._compensate_stale()}
+        users = {user for user in await self.registrator.list_emqx_users() if ObjectId.is_valid(user)}
+        acl_users = {user for user in await self.registrator.list_acl_users() if ObjectId.is_valid(user)}
+        in_progress = {str(registration['_id']) async for registration
+                       in self.registrator.outbox.find({}, {'_id': 1})}
+        devices = {str(device['_id']): device async for device
+                   in self.registrator.db_client.local.devices.find({}, {'_id': 1, 'type': 1})}
+
+        # Devices removed from hub still able to connect
+        stats['orphan_users'] = await self._delete(self.registrator.emqx_user_rollback,
+                                                   users - devices.keys() - in_progress)
+        stats['orphan_acl'] = await self._delete(self.registrator.emqx_acl_rollback,
+                                                 acl_users - devices.keys() - in_progress)
+        # Rules are derived from device id and type, so lost ones are restored
+        missing_acl = [devices[device_id] for device_id in (devices.keys() & users) - acl_users - in_progress]
+        if missing_acl:
+            await self.registrator.restore_acl_rules(missing_acl)
+        stats['restored_acl'] = len(missing_acl)
+        # Password of device is known only to device, it has to be registered again
+        missing_users = devices.keys() - users - in_progress
+        stats['missing_users'] = len(missing_users)
+        if missing_users:
+            logger.warning('Registered devices have no EMQX user', extra={'device_ids': sorted(missing_users)[:100],
+                                                                          'count': len(missing_users)})
+        if any(stats.values()):
+            logger.info('Registrations reconciled', extra=stats)
+        return stats
@@ -1,30 +1,52 @@
+import asyncio
 import secrets
 import string
+from datetime import datetime, timezone
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
+from pymongo.errors import BulkWriteError, PyMongoError
 
-from .requester import APISessionMaker
+from .requester import EMQXClient
 from config import HOST, EMQX_PORT
+from metrics import registration_stage
 from .exceptions import RegistrationError, RollbackError, RegistrationRequestError
 from .schemas import DeviceSpecification
 
 
+# Registration saga, every step is recorded in 'local.registrations' outbox before the next one starts:
+# 1. outbox document is created with id reserved for device ('started')
+# 2. device document is inserted with that id ('stored')
+# 3. EMQX user is created ('user_created')
+# 4. ACL rules are created ('acl_created')
+# 5. device confirms credentials, outbox document is removed, or marked 'delivered' if removal fails
+# Any failure, or outbox document left behind by crash, is compensated by deleting everything created
+# with reserved id ('compensating'), delivered registrations are never compensated, reconciler only removes
+# their outbox documents. All steps and compensations are idempotent, so they can be retried.
+STARTED = 'started'
+STORED = 'stored'
+USER_CREATED = 'user_created'
+ACL_CREATED = 'acl_created'
+COMPENSATING = 'compensating'
+DELIVERED = 'delivered'
+
+USERS_PATH = '/authentication/password_based:built_in_database/users'
+ACL_PATH = '/authorization/sources/built_in_database/rules/users'
+# Max items per page of EMQX list endpoints
+PAGE_LIMIT = 1000
 
-# steps:
-# 1. create password
-# 2. add user in mongo
-# 3. get id and add new user to EMQX
-# 4. set acl for user
 
 class Registrator:
 
     def __init__(self,
-                 session_maker: APISessionMaker,
+                 api_client: EMQXClient,
                  db_client: AsyncIOMotorClient,
                  password_len=20) -> None:
         self.password_len = password_len
-        self.session_maker = session_maker
+        self.api_client = api_client
         self.db_client = db_client
+        self.outbox = db_client.local.registrations
+        # Registrations confirmed by devices which outbox documents are still being completed
+        self.completing: set[str] = set()
 
     def _create_password(self) -> str:
         """Create secure password with given length
@@ -36,8 +58,49 @@ class Registrator:
         password = ''.join([secrets.choice(pool) for _ in range(self.password_len)])
         return password
 
+    async def _start(self, device_ids: list[ObjectId], device_types: list[str]) -> None:
+        """Create outbox documents reserving ids for new devices.
+
+            Args:
+                device_ids(list[ObjectId]): Reserved device ids.
+                device_types(list[str]): Type of every device.
+        """
+        now = datetime.now(timezone.utc)
+        await self.outbox.insert_many([{'_id': device_id, 'type': device_type, 'state': STARTED,
+                                        'created_at': now, 'updated_at': now}
+                                       for device_id, device_type in zip(device_ids, device_types)])
+
+    async def _advance(self, device_ids: list[ObjectId], state: str, error: str | None = None) -> None:
+        """Record registrations state.
+
+            Args:
+                device_ids(list[ObjectId]): Device ids.
+                state(str): New state.
+                error(str | None): Reason of compensation.
+        """
+        update = {'state': state, 'updated_at': datetime.now(timezone.utc)}
+        if error is not None:
+            update['error'] = error
+        await self.outbox.update_many({'_id': {'$in': device_ids}}, {'$set': update})
+
+    async def complete(self, device_id: str) -> None:
+        """Finish registration confirmed by device, nothing is compensated after that.
+
+            Args:
+                device_id(str): Device id.
+
+            Raises:
+                PyMongoError: If outbox document is neither removed nor marked delivered.
+        """
+        object_id = ObjectId(device_id)
+        try:
+            await self.outbox.delete_one({'_id': object_id})
+        except PyMongoError:
+            # Reconciler removes delivered registration instead of compensating it
+            await self._advance([object_id], DELIVERED)
+
     async def _create_emqx_user(self, client_id: str, password: str) -> None:
-        """Create EMQX user by api.
+        """Create EMQX user by api, password is replaced if user is left by previous attempt.
 
             Args:
                 client_id(str): Client id.
@@ -46,103 +109,222 @@ class Registrator:
             Raises:
                 RegistrationRequestError: If create request is not success.
         """
-        async with self.session_maker.get_session() as session:
-            credentials = {'user_id': client_id,
-                           'password': password}
-            url = 'http://localhost:18083/api/v5/authentication/password_based:built_in_database/users'
-            async with session.post(url=url, json=credentials) as response:
-                if str(response.status)[0] != '2':
-                    raise RegistrationRequestError("Request error. User is not created")
-
-    async def _insert_object(self, device_object) -> str:
-        """Insert document of new device
+        credentials = {'user_id': client_id,
+                       'password': password}
+        # Repeated create gets 409 and is finished by password update
+        status, _ = await self.api_client.request('POST', USERS_PATH, json=credentials, idempotent=True)
+        if status == 409:
+            status, _ = await self.api_client.request('PUT', f'{USERS_PATH}/{client_id}',
+                                                      json={'password': password})
+        if str(status)[0] != '2':
+            raise RegistrationRequestError("Request error. User is not created")
+
+    async def _import_emqx_users(self, credentials: list[tuple[str, str]]) -> None:
+        """Create many EMQX users by one bulk import request.
 
             Args:
-                device_object(dict): device json object interpretation.
+                credentials(list[tuple[str, str]]): Client ids with passwords.
 
-            Returns:
-                 str: ID given to object.
+            Raises:
+                RegistrationRequestError: If import request is not success or some users aren't imported.
         """
-        inserted_id = (await self.db_client.local.devices.insert_one(device_object)).inserted_id
-        return str(inserted_id)
+        users = [{'user_id': client_id, 'password': password, 'is_superuser': False}
+                 for client_id, password in credentials]
+        path = '/authentication/password_based:built_in_database/import_users'
+        # Import of many users takes longer than single request
+        status, result = await self.api_client.request('POST', path, json=users, params={'type': 'plain'},
+                                                       timeout=30)
+        if str(status)[0] != '2':
+            raise RegistrationRequestError("Request error. Users are not imported")
+        if result and result.get('failed', 0):
+            raise RegistrationRequestError(f"Request error. {result['failed']} users are not imported")
+
+    async def _insert_objects(self, device_objects: list[dict]) -> None:
+        """Insert documents of new devices with reserved ids, documents inserted before are kept.
+
+            Args:
+                device_objects(list[dict]): devices json object interpretations with '_id'.
+        """
+        try:
+            await self.db_client.local.devices.insert_many(device_objects, ordered=False)
+        except BulkWriteError as e:
+            if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
 
     async def emqx_user_rollback(self, device_id) -> None:
-        """Delete created emqx user.
+        """Delete created emqx user, missing user is considered deleted.
 
             Args:
                 device_id(str): Device id to delete.
 
             Raises:
-                RollbackError: If response code is not 20X.
+                RollbackError: If response code is not 20X or 404.
 
         """
-        async with self.session_maker.get_session() as session:
-            url = f'http://localhost:18083/api/v5/authentication/password_based:built_in_database/users/{device_id}'
-            async with session.delete(url=url) as response:
-                if str(response.status)[0] != '2':
-                    raise RollbackError("Request error. Delete request failed")
+        path = f'{USERS_PATH}/{device_id}'
+        try:
+            status, _ = await self.api_client.request('DELETE', path)
+        except RegistrationRequestError as e:
+            raise RollbackError(str(e))
+        if str(status)[0] != '2' and status != 404:
+            raise RollbackError("Request error. Delete request failed")
 
     async def emqx_acl_rollback(self, device_id) -> None:
-        """Delete created acl rules of user.
+        """Delete created acl rules of user, missing rules are considered deleted.
 
             Args:
                 device_id(str): Device id, rules will be deleted for.
 
             Raises:
-                RollbackError: If response code is not 20X.
+                RollbackError: If response code is not 20X or 404.
 
         """
-        async with self.session_maker.get_session() as session:
-            url = f'http://localhost:18083/api/v5/authorization/sources/built_in_database/rules/users/{device_id}'
-            async with session.delete(url=url) as response:
-                if str(response.status)[0] != '2':
-                    raise RollbackError("Request error. Delete request failed")
+        path = f'{ACL_PATH}/{device_id}'
+        try:
+            status, _ = await self.api_client.request('DELETE', path)
+        except RegistrationRequestError as e:
+            raise RollbackError(str(e))
+        if str(status)[0] != '2' and status != 404:
+            raise RollbackError("Request error. Delete request failed")
 
-    async def db_rollback(self, device_id) -> None:
-        """Delete document of created user.
+    async def db_bulk_rollback(self, device_ids: list[str]) -> None:
+        """Delete documents of created users.
 
             Args:
-                device_id(str): Document id to delete.
+                device_ids(list[str]): Documents ids to delete.
 
             Raises:
-                RollbackError: If document isn't deleted.
+                RollbackError: If documents can't be deleted.
         """
-        result = await self.db_client.local.devices.delete_one({'_id': ObjectId(device_id)})
-        if result.deleted_count == 0:
-            raise RollbackError("Id doesn't found")
+        try:
+            await self.db_client.local.devices.delete_many({'_id': {'$in': [ObjectId(device_id)
+                                                                              for device_id in device_ids]}})
+        except PyMongoError as e:
+            raise RollbackError(str(e))
 
-    async def _set_acl_rules(self, client_id, device_type) -> None:
-        """Create acl rules for emqx user.
+    async def rollback(self, device_ids: list[str], reason: str, concurrency: int = 20) -> bool:
+        """Compensate registrations: device documents, EMQX users and ACL rules are deleted concurrently.
+
+        Registrations stay in 'compensating' state until every deletion succeeds, reconciler retries them.
+
+            Args:
+                device_ids(list[str]): Ids of devices to remove.
+                reason(str): Why registrations are compensated.
+                concurrency(int): Max number of concurrent EMQX requests.
+
+            Returns:
+                bool: True if everything is deleted.
+        """
+        if not device_ids:
+            return True
+        object_ids = [ObjectId(device_id) for device_id in device_ids]
+        try:
+            await self._advance(object_ids, COMPENSATING, reason)
+        except PyMongoError:
+            # Outbox keeps previous state, reconciler compensates it when it becomes stale
+            pass
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(rollback, device_id):
+            async with semaphore:
+                await rollback(device_id)
+
+        with registration_stage('compensation'):
+            results = await asyncio.gather(self.db_bulk_rollback(device_ids),
+                                           *[limited(self.emqx_acl_rollback, device_id) for device_id in device_ids],
+                                           *[limited(self.emqx_user_rollback, device_id) for device_id in device_ids],
+                                           return_exceptions=True)
+        if any(isinstance(result, Exception) for result in results):
+            return False
+        try:
+            await self.outbox.delete_many({'_id': {'$in': object_ids}})
+        except PyMongoError:
+            return False
+        return True
+
+    @staticmethod
+    def _acl_config(client_id, device_type) -> dict:
+        """Build acl rules of one emqx user.
 
             Args:
                 client_id(str): Device id, rules created for.
                 device_type(str): Type of device, device or sensor.
 
-            Raises:
-                RegistrationError: If response code isn't 20X.
+            Returns:
+                dict: Rules of the user.
         """
         publish_rule = 'allow' if device_type == 'sensor' else 'deny'
         # If device is sensor, permit to publish data to the topic
-        acl_config = [
-            {
-                'rules': [
-                    {'action': 'publish',
-                     'permission': publish_rule,
-                     'topic': f'/devices/{client_id}/publish'},
-
-                    {'action': 'subscribe',
-                     'permission': 'allow',
-                     'topic': f'/devices/{client_id}'}
-                ],
-                'username': client_id
-            }
-        ]
-
-        async with self.session_maker.get_session() as session:
-            url = 'http://localhost:18083/api/v5/authorization/sources/built_in_database/rules/users/'
-            async with session.post(url=url, json=acl_config) as response:
-                if str(response.status)[0] != '2':
-                    raise RegistrationError("Request error. ACL rules is not created")
+        return {
+            'rules': [
+                {'action': 'publish',
+                 'permission': publish_rule,
+                 'topic': f'/devices/{client_id}/publish'},
+
+                {'action': 'subscribe',
+                 'permission': 'allow',
+                 'topic': f'/devices/{client_id}'}
+            ],
+            'username': client_id
+        }
+
+    async def _post_acl_rules(self, acl_config: list[dict]) -> None:
+        """Create acl rules for many emqx users by one request, rules existing already are kept.
+
+            Args:
+                acl_config(list[dict]): Rules of every user.
+
+            Raises:
+                RegistrationError: If response code isn't 20X.
+        """
+        try:
+            # Existing rules of one user are accepted below, bulk create fails if some of them exist
+            status, _ = await self.api_client.request('POST', ACL_PATH, json=acl_config,
+                                                      idempotent=len(acl_config) == 1)
+        except RegistrationRequestError as e:
+            raise RegistrationError(str(e))
+        if status == 409 and len(acl_config) == 1:
+            # Rules are derived from id and type only, existing ones are the same
+            return
+        if str(status)[0] != '2':
+            raise RegistrationError("Request error. ACL rules is not created")
+
+    async def _list(self, path: str) -> list[dict]:
+        """Read all pages of EMQX list endpoint.
+
+            Args:
+                path(str): Endpoint path.
+
+            Returns:
+                list[dict]: Items of all pages.
+
+            Raises:
+                RegistrationRequestError: If some page can't be read.
+        """
+        items = []
+        page = 1
+        while True:
+            status, body = await self.api_client.request('GET', path, params={'page': page, 'limit': PAGE_LIMIT})
+            if str(status)[0] != '2':
+                raise RegistrationRequestError(f"Request error. {path} is not listed")
+            items.extend(body['data'])
+            if not body['meta'].get('hasnext', len(body['data']) == PAGE_LIMIT):
+                return items
+            page += 1
+
+    async def list_emqx_users(self) -> list[str]:
+        return [user['user_id'] for user in await self._list(USERS_PATH)]
+
+    async def list_acl_users(self) -> list[str]:
+        return [rule['username'] for rule in await self._list(ACL_PATH)]
+
+    async def restore_acl_rules(self, devices: list[dict]) -> None:
+        """Create ACL rules missing for registered devices.
+
+            Args:
+                devices(list[dict]): Device documents with '_id' and 'type'.
+        """
+        await self._post_acl_rules([self._acl_config(str(device['_id']), device['type']) for device in devices])
 
     async def register_device(self, device_specification: DeviceSpecification) -> dict:
         """Register device in hub system.
@@ -156,32 +338,79 @@ class Registrator:
             Raises:
                 ExceptionGroup: If device creation aborted on some step.
         """
+        return (await self.register_devices([device_specification]))[0]
 
-        device_specification_dict = device_specification.model_dump()
+    @staticmethod
+    def _device_credentials(device_id: str, password: str) -> dict:
+        response = {'host': "111.111.111.111",
+                    'port': EMQX_PORT,
+                    'clientid': device_id,
+                    'password': password,
+                    'topic': f'/devices/{device_id}'}
+        return response
 
-        del device_specification_dict['response_details']
+    async def _run_steps(self, object_ids: list[ObjectId], device_specifications: list[DeviceSpecification],
+                         passwords: list[str]) -> None:
+        """Run registration steps after outbox documents are created, recording every finished step.
 
-        created_id = await self._insert_object(device_specification_dict)
-        device_password = self._create_password()
+            Args:
+                object_ids(list[ObjectId]): Reserved device ids.
+                device_specifications(list[DeviceSpecification]): Specifications in the same order.
+                passwords(list[str]): Passwords in the same order.
+        """
+        device_ids = [str(object_id) for object_id in object_ids]
+        single = len(object_ids) == 1
+        stage_prefix = '' if single else 'bulk_'
+
+        with registration_stage(f'{stage_prefix}database'):
+            await self._insert_objects([{**device_specification.model_dump(), '_id': object_id}
+                                        for object_id, device_specification
+                                        in zip(object_ids, device_specifications)])
+        await self._advance(object_ids, STORED)
+
+        with registration_stage('emqx_user' if single else 'bulk_emqx_users'):
+            if single:
+                await self._create_emqx_user(device_ids[0], passwords[0])
+            else:
+                await self._import_emqx_users(list(zip(device_ids, passwords)))
+        await self._advance(object_ids, USER_CREATED)
+
+        with registration_stage(f'{stage_prefix}acl'):
+            await self._post_acl_rules([self._acl_config(device_id, device_specification.type)
+                                        for device_id, device_specification
+                                        in zip(device_ids, device_specifications)])
+        await self._advance(object_ids, ACL_CREATED)
+
+    async def register_devices(self, device_specifications: list[DeviceSpecification]) -> list[dict]:
+        """Register many devices with one database insert, one EMQX users import and one ACL request.
+
+        Registrations stay in outbox until devices confirm them by 'complete' or are compensated by 'rollback'.
 
-        try:
-            await self._create_emqx_user(created_id, device_password)
-        except RegistrationError as e:
-            await self.db_rollback(created_id)
-            raise ExceptionGroup('User is not created', [e,
-                                                         RegistrationError('Request error, creation abort')])
+            Args:
+                device_specifications(list[DeviceSpecification]): Pydantic models with device specifications
 
+            Returns:
+                list[dict]: Info for every device in the same order: host and emqx port, credentials,
+                and created topic.
+
+            Raises:
+                ExceptionGroup: If devices creation aborted on some step, created data is compensated then.
+        """
+        object_ids = [ObjectId() for _ in device_specifications]
+        passwords = [self._create_password() for _ in object_ids]
         try:
-            await self._set_acl_rules(created_id, device_specification.type)
-        except RegistrationError as e:
-            await self.db_rollback(created_id)
-            await self.emqx_user_rollback(created_id)
-            raise ExceptionGroup('User is not created', [e,
-                                                         RegistrationError('Request error, creation abort')])
+            await self._start(object_ids, [device_specification.type for device_specification
+                                           in device_specifications])
+        except PyMongoError as e:
+            raise ExceptionGroup('Registration is not started', [RegistrationError(str(e))])
 
-        response = {'host': "111.111.111.111",
-                    'port': EMQX_PORT,
-                    'clientid': created_id,
-                    'password': device_password,
-                    'topic': f'/devices/{created_id}'}
-        return response
+        try:
+            await self._run_steps(object_ids, device_specifications, passwords)
+        except (RegistrationError, RegistrationRequestError, PyMongoError) as e:
+            # Import isn't atomic and step could be done before failure, everything is removed
+            await self.rollback([str(object_id) for object_id in object_ids], repr(e))
+            raise ExceptionGroup('Users are not created', [e,
+                                                           RegistrationError('Request error, creation abort')])
+
+        return [self._device_credentials(str(object_id), password)
+                for object_id, password in zip(object_ids, passwords)]
@@ -1,11 +1,109 @@
-from aiohttp import ClientSession, BasicAuth
+import asyncio
+import logging
+import random
+import time
+from aiohttp import ClientSession, ClientConnectorError, ClientError, ClientTimeout, BasicAuth, TCPConnector
 
+from .exceptions import RegistrationRequestError
+from metrics import EMQX_API_SECONDS, endpoint_label
 
-class APISessionMaker:
+logger = logging.getLogger('hub.emqx')
 
-    def __init__(self, api_key: str):
-        username, password = api_key.split(':')
-        self.auth_header = BasicAuth(username, password)
 
-    def get_session(self):
-        return ClientSession(auth=self.auth_header)
\ No newline at end of file
+class EMQXClient:
+    """Application-wide client of EMQX management API, keeps connections alive between requests"""
+
+    def __init__(self,
+                 api_key: str,
+                 base_url: str,
+                 retries: int = 3,
+                 backoff: float = 0.1,
+                 timeout: float = 5,
+                 pool_size: int = 20) -> None:
+        """Create new instance of EMQX API client
+
+            Args:
+                api_key(str): API key in 'key:secret' format.
+                base_url(str): API url, e.g. http://localhost:18083/api/v5.
+                retries(int): Number of retries after 5XX response or connection error.
+                backoff(float): Base delay before retry, doubled for every next retry and jittered.
+                timeout(float): Default seconds for whole request.
+                pool_size(int): Max number of open connections.
+        """
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.session: ClientSession | None = None
+
+    async def start(self) -> None:
+        username, password = self.api_key.split(':')
+        connector = TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+        self.session = ClientSession(auth=BasicAuth(username, password),
+                                     connector=connector,
+                                     timeout=ClientTimeout(total=self.timeout))
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _retry_delay(self, attempt: int) -> float:
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    async def request(self,
+                      method: str,
+                      path: str,
+                      json: object = None,
+                      params: dict | None = None,
+                      timeout: float | None = None,
+                      idempotent: bool | None = None) -> tuple[int, object]:
+        """Send request to EMQX API, retrying on 5XX responses and connection errors.
+
+        Request which isn't idempotent is retried only if connection wasn't established, after timeout or 5XX
+        response it could be applied already.
+
+            Args:
+                method(str): HTTP method.
+                path(str): Path relative to API url.
+                json(object): Request body.
+                params(dict | None): Query parameters.
+                timeout(float | None): Seconds for this request, default timeout if None.
+                idempotent(bool | None): Repeating request has the same effect, by default every method but POST.
+
+            Returns:
+                tuple[int, object]: Response status and decoded json body, None if body is empty.
+
+            Raises:
+                RegistrationRequestError: If EMQX API can't be reached after all retries.
+        """
+        url = f'{self.base_url}{path}'
+        if idempotent is None:
+            idempotent = method != 'POST'
+        # Passed timeout=None disables session timeout, so it is passed only when set
+        request_options = {'timeout': ClientTimeout(total=timeout)} if timeout is not None else {}
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    async with self.session.request(method, url, json=json, params=params,
+                                                    **request_options) as response:
+                        if response.status >= 500 and attempt < self.retries and idempotent:
+                            logger.warning('EMQX API server error, retrying',
+                                           extra={'method': method, 'path': path, 'status': response.status})
+                            await asyncio.sleep(self._retry_delay(attempt))
+                            continue
+                        status = response.status
+                        body = await response.read()
+                        return response.status, await response.json(content_type=None) if body else None
+                except (ClientError, asyncio.TimeoutError) as e:
+                    if attempt == self.retries or not (idempotent or isinstance(e, ClientConnectorError)):
+                        logger.error('EMQX API is unreachable', extra={'method': method, 'path': path,
+                                                                       'error': repr(e)})
+                        raise RegistrationRequestError(f"Request error. EMQX API is unreachable: {e!r}")
+                    await asyncio.sleep(self._retry_delay(attempt))
+        finally:
+            EMQX_API_SECONDS.labels(method, endpoint_label(path), str(status)).observe(time.perf_counter() - start)
@@ -1,11 +1,21 @@
 import asyncio
+import logging
+import os
+import time
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
-from motor.motor_asyncio import AsyncIOMotorClient
 
-from .servers import TCPServer
-from .requester import APISessionMaker
-from .registrator import Registrator
-from config import API_KEY, DB_URI
+from .requester import EMQXClient
+from .service import RegistrationService, log_failure
+from .schemas import BulkRegistrationResult, RegistrationEvent
+from config import API_KEY, EMQX_API_URL, DISCOVERY_PORT, DISCOVERY_RATE_LIMIT, LOCK_DIR, REGISTRATION_PORT
+from workers import WorkerLock
+
+emqx_client = EMQXClient(API_KEY, EMQX_API_URL)
+registration_service = RegistrationService(DISCOVERY_PORT, REGISTRATION_PORT, DISCOVERY_RATE_LIMIT)
+# Every worker of hub takes the same lock, registration servers run in the worker holding it
+registration_lock = WorkerLock(os.path.join(LOCK_DIR, f'hub-registration-{REGISTRATION_PORT}.lock'))
+
+logger = logging.getLogger('hub.registration')
 
 router = APIRouter(
     prefix="/register",
@@ -13,44 +23,71 @@ router = APIRouter(
 )
 
 
+async def _send_events(websocket: WebSocket, events: asyncio.Queue) -> None:
+    """Forward session events to websocket, the only place session sends from."""
+    while True:
+        event = await events.get()
+        await websocket.send_text(event.model_dump_json())
+
+
 @router.websocket('/ws/create_device')
 async def add_new_device(websocket: WebSocket):
+    """Operator session: receives devices announced to hub and approves them by sending their id."""
+    if not registration_service.active:
+        # Pending devices are kept by other worker, try again
+        await websocket.close(code=1013, reason='Registration is served by other worker')
+        return
+    await websocket.accept()
+    events = registration_service.subscribe()
+    sender = asyncio.create_task(_send_events(websocket, events))
+    approvals = set()
+
+    async def approve(pending_id: str) -> None:
+        result = await registration_service.approve(pending_id)
+        if result is None:
+            registration_service.notify(events, RegistrationEvent(event='unknown', id=pending_id))
+
+    try:
+        while True:
+            pending_id = await websocket.receive_text()
+            # Registration waits for device confirmation, don't block next approvals meanwhile
+            task = asyncio.create_task(approve(pending_id))
+            approvals.add(task)
+            task.add_done_callback(approvals.discard)
+            task.add_done_callback(log_failure)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        registration_service.unsubscribe(events)
+        sender.cancel()
+        logger.debug('Operator session closed')
+
+
+@router.websocket('/ws/bulk_create_devices')
+async def add_new_devices(websocket: WebSocket):
+    """Operator session: receives announced devices, sending 'register' registers all pending devices at once."""
+    if not registration_service.active:
+        await websocket.close(code=1013, reason='Registration is served by other worker')
+        return
     await websocket.accept()
+    events = registration_service.subscribe()
+    sender = asyncio.create_task(_send_events(websocket, events))
     try:
-        process = await asyncio.create_subprocess_shell(
-            """source /Users/egor/PycharmProjects/mqtt_homecontrol/hub/venv/bin/activate && 
-            python3 /Users/egor/PycharmProjects/mqtt_homecontrol/hub/src/run_broadcast_server.py""",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE)
-
-        requester = APISessionMaker(API_KEY)
-        client = AsyncIOMotorClient(DB_URI)
-        a = Registrator(requester, client)
-
-        loop = asyncio.get_event_loop()
-        server = TCPServer(loop, 12222, a)
-
-        reg_funcs = {}
-        async for name, func in server.run_server():
-            if name is not None:
-                await websocket.send_text(name)
-                reg_funcs[name] = func
-                print(name)
-            try:
-                response = await asyncio.wait_for(websocket.receive_text(), 2)
-            except TimeoutError:
+        while True:
+            if await websocket.receive_text() != 'register':
                 continue
-            print(response)
-            if response is not None:
-                result = await reg_funcs[response]()
-                print(result)
-                if result:
-                    await websocket.send_text('success')
-                    break
+            start = time.perf_counter()
+            results = await registration_service.approve_all()
+            elapsed = time.perf_counter() - start
+            registered = sum(results)
+            result = BulkRegistrationResult(registered=registered,
+                                            failed=len(results) - registered,
+                                            devices_per_second=registered / elapsed if elapsed else 0)
+            logger.info('Bulk registration finished', extra=result.model_dump())
+            registration_service.notify(events, result)
     except WebSocketDisconnect:
         pass
-    else:
-        await websocket.close()
     finally:
-        print('disconnected')
-        server.close()
+        registration_service.unsubscribe(events)
+        sender.cancel()
+        logger.debug('Operator session closed')
@@ -1,5 +1,6 @@
-from pydantic import BaseModel, field_validator, ValidationInfo
+from pydantic import BaseModel, model_validator
 from typing import Literal
+from validation import compile_field
 
 
 class Field(BaseModel):
@@ -7,35 +8,30 @@ class Field(BaseModel):
     value: int | float | str | bool
     min: int | float | None = None
     max: int | float | None = None
-    value: int | float | str | bool
+    enum: list[int | float | str | bool] | None = None
+    step: int | float | None = None
     type: Literal["int", "float", "str", "bool"]
 
-    @field_validator('type')
-    @classmethod
-    def check_numeric_restriction(cls, field_value, info: ValidationInfo):
-        print('Im here')
-        print(info.data)
-        print(field_value)
-        if eval(field_value) is int or eval(field_value) is float:
-            min = info.data.get('min', None)
-            max = info.data.get('max', None)
-            if max is not None and min is not None:
-                return field_value
-            else:
-                raise ValueError(f"Range should be defined for numeric field {info.field_name}")
-        return field_value
-
-
-class ResponseDetails(BaseModel):
-    address: str
-    port: str
+    @model_validator(mode='after')
+    def check_restrictions(self):
+        if self.type in ('int', 'float'):
+            if self.min is None or self.max is None:
+                raise ValueError(f"Range should be defined for numeric field {self.name}")
+            if self.min > self.max:
+                raise ValueError(f"Min is greater than max in field {self.name}")
+        if self.step is not None and self.step <= 0:
+            raise ValueError(f"Step should be positive in field {self.name}")
+        # Initial value must pass the same checks as later changes
+        error = compile_field(self.model_dump())(self.value)
+        if error is not None:
+            raise ValueError(f"{error} in field {self.name}")
+        return self
 
 
 class DeviceSpecification(BaseModel):
     name: str
     type: Literal["device", "sensor"]
     fields: list[Field]
-    response_details: ResponseDetails
 
 
 class ErrorForm(BaseModel):
@@ -46,3 +42,16 @@ class ErrorForm(BaseModel):
 
 class Confirm(BaseModel):
     status: bool
+
+
+class BulkRegistrationResult(BaseModel):
+    registered: int
+    failed: int
+    devices_per_second: float
+
+
+class RegistrationEvent(BaseModel):
+    event: Literal["announced", "registered", "failed", "disconnected", "unknown"]
+    id: str
+    name: str | None = None
+    type: Literal["device", "sensor"] | None = None
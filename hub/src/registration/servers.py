@@ -1,18 +1,21 @@
 import asyncio
-from socket import (socket, AF_INET, SOCK_DGRAM, SOCK_STREAM, IPPROTO_UDP, SO_REUSEPORT, SO_BROADCAST,
-                    SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR)
-import json
+import logging
 import time
+from socket import socket, AF_INET, SOCK_DGRAM, IPPROTO_UDP, SO_REUSEPORT, SO_BROADCAST, SOL_SOCKET
+import json
+import uuid
 from abc import ABC, abstractmethod
-import multiprocessing
 from pydantic import ValidationError
 from asyncio import BaseEventLoop
-from typing import Callable
 from pydantic import BaseModel
+from pymongo.errors import PyMongoError
 
 from .exceptions import RegistrationError
 from .registrator import Registrator
 from .schemas import DeviceSpecification, ErrorForm, Confirm
+from metrics import DISCOVERY_REPLY_SECONDS, DISCOVERY_REQUESTS, registration_stage
+
+logger = logging.getLogger('hub.registration')
 
 
 class Server(ABC):
@@ -48,234 +51,484 @@ class Server(ABC):
         pass
 
 
-class TCPServer(Server):
-    """TCP server that handle devices wanted to connect to hub and prepare registration functions for them"""
+class FramedConnection:
+    """Connection exchanging newline delimited json frames over asyncio streams"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+
+    @property
+    def address(self) -> tuple:
+        return self.writer.get_extra_info('peername')
+
+    async def receive(self, schema: type[BaseModel], timeout: float | None = None) -> BaseModel:
+        """Read one frame and validate it by given schema.
+
+            Args:
+                schema(type[BaseModel]): Pydantic validation schema.
+                timeout(float | None): Seconds to wait for the whole frame.
+
+            Returns:
+                BaseModel: Validated pydantic model.
+
+            Raises:
+                RegistrationError: If frame is too long or not correct.
+                ConnectionError: If connection is closed before frame end.
+                TimeoutError: If frame isn't received in time.
+        """
+        try:
+            frame = await asyncio.wait_for(self.reader.readuntil(b'\n'), timeout)
+        except asyncio.LimitOverrunError:
+            raise RegistrationError('Frame is too long')
+        except asyncio.IncompleteReadError:
+            raise ConnectionError('Connection closed before frame end')
+        try:
+            return schema.model_validate_json(frame)
+        except ValidationError as e:
+            raise RegistrationError(f'Input string format is not correct. {e.json()}')
+
+    async def send(self, data: str) -> None:
+        """Send one frame.
+
+            Args:
+                data(str): Json string without line breaks.
+        """
+        self.writer.write(data.encode() + b'\n')
+        await self.writer.drain()
+
+    async def send_error(self, error_type: str, exception: Exception | str) -> None:
+        """Send error frame.
 
-    def __init__(self, loop: BaseEventLoop, port: int, registrator: Registrator) -> None:
+            Args:
+                error_type(str): Short traceback of the error.
+                exception(Exception | str): Exception to response
+        """
+        error = ErrorForm(status='failure',
+                          type=error_type,
+                          detail=str(exception))
+        await self.send(error.model_dump_json())
+
+    async def wait_closed(self) -> None:
+        """Wait until peer closes connection while it isn't expected to send anything.
+
+        Data received meanwhile breaks protocol, so it is taken as closing too."""
+        try:
+            await self.reader.read(1)
+        except ConnectionError:
+            pass
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class PendingDevice:
+    """Device which sent its specification and waits on open connection for registration"""
+
+    def __init__(self, specification: DeviceSpecification, connection: FramedConnection) -> None:
+        self.id = uuid.uuid4().hex
+        self.specification = specification
+        self.connection = connection
+        # Drops device from pending ones when its connection is closed, cancelled when device is approved
+        self.watcher: asyncio.Task | None = None
+
+
+class TCPServer(Server):
+    """TCP server that handle devices wanted to connect to hub and register them.
+
+    Device sends specification frame and keeps connection open, after approval hub sends registration
+    info frame on the same connection and device answers with confirmation frame."""
+
+    def __init__(self,
+                 loop: BaseEventLoop,
+                 port: int,
+                 registrator: Registrator,
+                 max_clients: int = 100,
+                 confirm_timeout: float = 10,
+                 specification_timeout: float = 10,
+                 max_frame_size: int = 64 * 1024,
+                 complete_max_delay: float = 30) -> None:
         """Create new instance of TCP server
 
             Args:
                 loop(BaseEventLoop): Event loop.
                 port(int): Port binding to server.
                 registrator(Registrator): Registrator instance.
+                max_clients(int): Max number of clients sending specification at the same time.
+                confirm_timeout(float): Seconds to wait for device confirmation.
+                specification_timeout(float): Seconds to wait for device specification after connection.
+                max_frame_size(int): Max size of one frame in bytes.
+                complete_max_delay(float): Max seconds between retries of finishing confirmed registration in outbox.
         """
         self.port = port
         self.stop = False
         self.loop = loop
         self.registrator = registrator
+        self.max_clients = max_clients
+        self.confirm_timeout = confirm_timeout
+        self.specification_timeout = specification_timeout
+        self.max_frame_size = max_frame_size
+        self.complete_max_delay = complete_max_delay
+        self.completions: set[asyncio.Task] = set()
+
+        self.specifications: asyncio.Queue | None = None
+        self.server: asyncio.Server | None = None
+        self._semaphore = asyncio.Semaphore(max_clients)
+
+    async def start(self) -> None:
+        """Start accepting clients in background, pending devices are put to 'specifications' queue."""
+        self.specifications = asyncio.Queue()
+        self.server = await asyncio.start_server(self._handle_client,
+                                                 port=self.port,
+                                                 reuse_address=True,
+                                                 backlog=self.max_clients,
+                                                 limit=self.max_frame_size)
+        logger.info('Registration server started', extra={'port': self.port})
+
+    async def announced(self, timeout: float = 10) -> PendingDevice | None:
+        """Yield as generator devices wanted to connect
 
-        self.server = socket(AF_INET, SOCK_STREAM)
-        self.server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        self.server.bind(('', self.port))
-
-    async def run_server(self) -> tuple[str, Callable]:
-        """Start server and yield as generator clients wanted to connect
+            Args:
+                timeout(float): Seconds after which None is yielded if no client came.
 
             Yields:
-                str: Name of the current client.
-                callable: Function for client registration.
+                PendingDevice | None: The current client, None if no client came in time.
         """
-        self.server.listen(5)
-        self.server.settimeout(10)
-        # setting timeout to prevent infinite socket.recv wait with no data
-        print("Tcp server started")
-        while True:
+        while not self.stop:
             try:
-                conn, addr = await self.loop.sock_accept(self.server)
+                pending_device = await asyncio.wait_for(self.specifications.get(), timeout)
             except TimeoutError:
-                yield None, None
+                yield None
                 continue
-            print('client addr: ', addr)
-            # Process client request, receive client name and prepared registration function
-            name, registration_function = await self._handle_client(conn)
-            if name is not None:
-                yield name, registration_function
-            if self.stop:
-                break
-
-    @staticmethod
-    def _validate_request(json_string: str, schema: BaseModel):
-        """Validate json request by given schema.
+            yield pending_device
 
-            Args:
-                json_string(str): String requiring validation.
-                schema(Model): Pydantic validation schema.
+    async def run_server(self) -> PendingDevice | None:
+        """Start server and yield as generator devices wanted to connect
 
-            Returns:
-                Model: Validated pydantic model.
-
-            Raises:
-                 RegistrationError: If 'json_string' is not correct.
+            Yields:
+                PendingDevice | None: The current client, None if no client came in 10 seconds.
         """
+        await self.start()
         try:
-            device_specification = schema.model_validate_json(json_string)
-        except ValidationError as e:
-            raise RegistrationError(f'Input string format is not correct. {e.json()}')
-        return device_specification
+            async for pending_device in self.announced():
+                yield pending_device
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self.stop = True
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        for task in self.completions:
+            task.cancel()
 
-    async def _response(self, client: socket, data: str):
-        """Send response to client.
+    async def rollback(self, device_id: str, reason: str) -> None:
+        """Rollback all data created by registrator, reconciler finishes it if some deletion fails.
 
             Args:
-                client(socket): Socket client.
-                data(str): Data to send
+                device_id(str): ID to delete.
+                reason(str): Why registration is rolled back.
         """
-        data_encoded = data.encode()
-        await self.loop.sock_sendall(client, data_encoded)
+        if not await self.registrator.rollback([device_id], reason):
+            logger.warning('Registration is not rolled back, left to reconciler', extra={'device_id': device_id})
 
-    def close(self) -> None:
-        self.server.close()
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Receive client specification and put client to pending devices
 
-    async def _response_error(self, client: socket, error_type: str, exception: Exception):
-        """Send error to client.
+            Args:
+                reader(asyncio.StreamReader): Client stream reader.
+                writer(asyncio.StreamWriter): Client stream writer.
+        """
+        connection = FramedConnection(reader, writer)
+        logger.debug('Registration client connected', extra={'address': connection.address})
+        async with self._semaphore:
+            try:
+                with registration_stage('specification'):
+                    device_specification = await connection.receive(DeviceSpecification,
+                                                                    self.specification_timeout)
+            # send error and abort client registration
+            except RegistrationError as e:
+                logger.info('Wrong device specification', extra={'address': connection.address, 'error': str(e)})
+                try:
+                    await connection.send_error('Wrong format', e)
+                except ConnectionError:
+                    pass
+                connection.close()
+                return
+            except (ConnectionError, TimeoutError):
+                connection.close()
+                return
+        await self.specifications.put(PendingDevice(device_specification, connection))
+
+    async def _deliver_credentials(self, pending_device: PendingDevice, response: dict) -> bool:
+        """Send registration info to device and wait for its confirmation, rollback registration if device
+        doesn't confirm it.
 
             Args:
-                client(socket): Socket client.
-                error_type(str): Short traceback of the error.
-                exception(Exception): Exception to response
+                pending_device(PendingDevice): Device waiting for registration.
+                response(dict): Registration info created by registrator.
+
+            Returns:
+                bool: True if device confirmed registration or False if not
         """
-        error = ErrorForm(status='failure',
-                          type=error_type,
-                          detail=str(exception))
-        response = error.model_dump_json()
-        await self._response(client, response)
+        device_id = response['clientid']
+        connection = pending_device.connection
+        try:
+            with registration_stage('delivery'):
+                await connection.send(json.dumps(response))
+                # Trying to receive confirmation from device
+                confirm_validated = await connection.receive(Confirm, self.confirm_timeout)
+            # Rollback registration if device send confirmation status False
+            if not confirm_validated.status:
+                logger.info('Device declined registration', extra={'device_id': device_id})
+                await self.rollback(device_id, 'Device declined registration')
+                connection.close()
+                return False
 
-    async def rollback(self, device_id):
-        """Rollback all data created by registrator.
+        # Rollback registration if device send not correct data or doesn't send any data
+        except RegistrationError as e:
+            logger.info('Wrong registration confirmation', extra={'device_id': device_id, 'error': str(e)})
+            await self.rollback(device_id, repr(e))
+            try:
+                await connection.send_error('Wrong format', e)
+            except ConnectionError:
+                pass
+            connection.close()
+            return False
+
+        except (TimeoutError, ConnectionError) as e:
+            logger.info('Registration is not confirmed', extra={'device_id': device_id, 'error': repr(e)})
+            await self.rollback(device_id, repr(e))
+            connection.close()
+            return False
+        connection.close()
+        # Device has its credentials and is registered whatever happens to outbox
+        await self._complete(device_id)
+        logger.info('Device registered', extra={'device_id': device_id})
+        return True
+
+    async def _complete(self, device_id: str) -> None:
+        """Finish registration in outbox, if it fails it is retried in background until it succeeds and
+        reconciler doesn't take registration for abandoned one meanwhile.
 
             Args:
-                device_id(str): ID to delete.
+                device_id(str): Confirmed device id.
         """
-        await self.registrator.db_rollback(device_id)
-        await self.registrator.emqx_acl_rollback(device_id)
-        await self.registrator.emqx_user_rollback(device_id)
+        try:
+            await self.registrator.complete(device_id)
+            return
+        except PyMongoError as e:
+            logger.warning('Registration is not completed in outbox, retrying',
+                           extra={'device_id': device_id, 'error': repr(e)})
+        self.registrator.completing.add(device_id)
+        task = asyncio.create_task(self._keep_completing(device_id))
+        self.completions.add(task)
+        task.add_done_callback(self.completions.discard)
+
+    async def _keep_completing(self, device_id: str) -> None:
+        delay = 1
+        try:
+            while True:
+                await asyncio.sleep(delay)
+                try:
+                    await self.registrator.complete(device_id)
+                except PyMongoError as e:
+                    logger.warning('Registration is not completed in outbox, retrying',
+                                   extra={'device_id': device_id, 'error': repr(e)})
+                    delay = min(delay * 2, self.complete_max_delay)
+                    continue
+                logger.info('Registration is completed in outbox', extra={'device_id': device_id})
+                return
+        except asyncio.CancelledError:
+            logger.error('Registration is not completed in outbox before shutdown, reconciler can compensate it',
+                         extra={'device_id': device_id})
+            raise
+        finally:
+            self.registrator.completing.discard(device_id)
 
-    async def _handle_client(self, client: socket) -> tuple[str, Callable] | tuple[None, None]:
-        """Return clients name and client registration function
+    async def register_client(self, pending_device: PendingDevice) -> bool:
+        """Register device in system
 
             Args:
-                client(socket): Socket client.
+                pending_device(PendingDevice): Device waiting for registration.
+
             Returns:
-                str: Name of the current client.
-                callable: Function for client registration.
+                bool: True if device is registered or False if not
         """
         try:
-            input_data = (await self.loop.sock_recv(client, 1024)).decode()
-        except OSError:
-            client.close()
-            return None, None
+            response = await self.registrator.register_device(pending_device.specification)
+        except ExceptionGroup as e:
+            logger.warning('Device registration failed', extra={'error': repr(e.exceptions)})
+            await self._reject_clients([pending_device])
+            return False
+        return await self._deliver_credentials(pending_device, response)
+
+    async def register_clients(self, pending_devices: list[PendingDevice]) -> list[bool]:
+        """Register many devices by bulk requests and deliver credentials to them concurrently
+
+            Args:
+                pending_devices(list[PendingDevice]): Devices waiting for registration.
+
+            Returns:
+                list[bool]: For every device True if it is registered or False if not.
+        """
+        if not pending_devices:
+            return []
         try:
-            device_specification = self._validate_request(input_data, DeviceSpecification)
-        # send error and abort client registration function creation
-        except RegistrationError as e:
-            await self._response_error(client, 'Wrong format', e)
-            client.close()
-            return None, None
+            responses = await self.registrator.register_devices([pending_device.specification
+                                                                 for pending_device in pending_devices])
+        except ExceptionGroup as e:
+            logger.warning('Bulk registration failed', extra={'devices': len(pending_devices),
+                                                              'error': repr(e.exceptions)})
+            await self._reject_clients(pending_devices)
+            return [False] * len(pending_devices)
 
-        async def register_client() -> bool:
-            """Register device in system
+        return list(await asyncio.gather(*[self._deliver_credentials(pending_device, response)
+                                           for pending_device, response in zip(pending_devices, responses)]))
 
-                Returns:
-                    bool: True if device is registered or False if not
-            """
-            client_socket = socket(AF_INET, SOCK_STREAM)
-            connection_data = (
-                device_specification.response_details.address, int(device_specification.response_details.port))
-            client_socket.connect(connection_data)
+    @staticmethod
+    async def _reject_clients(pending_devices: list[PendingDevice]) -> None:
+        """Tell devices registration failed.
 
+            Args:
+                pending_devices(list[PendingDevice]): Rejected devices.
+        """
+
+        async def reject(pending_device: PendingDevice) -> None:
             try:
-                response = await self.registrator.register_device(device_specification)
-            except ExceptionGroup:
-                await self._response_error(client_socket, 'Registration error', "Internal Error")
-                client_socket.close()
-                return False
+                await pending_device.connection.send_error('Registration error', "Internal Error")
+            except ConnectionError:
+                pass
+            pending_device.connection.close()
 
-            await self._response(client_socket, json.dumps(response))
-            device_id = response['clientid']
+        await asyncio.gather(*[reject(pending_device) for pending_device in pending_devices])
 
-            # Trying to receive confirmation from device
-            try:
-                confirm_data = (await self.loop.sock_recv(client_socket, 1024)).decode()
-                confirm_validated = self._validate_request(confirm_data, Confirm)
-                if confirm_validated.status:
-                    self.stop = True
-                # Rollback registration if device send confirmation status False
-                else:
-                    await self.rollback(device_id)
-                    client_socket.close()
-                    return False
-
-            # Rollback registration if device send not correct data or doesn't send any data
-            except RegistrationError as e:
-                await self.rollback(device_id)
-                await self._response_error(client_socket, 'Wrong format', e)
-                client_socket.close()
-                return False
 
-            except TimeoutError:
-                await self.rollback(device_id)
-                client_socket.close()
-                return False
-            return True
+class BroadcastProtocol(asyncio.DatagramProtocol):
+    """Datagram protocol passing discovery requests to broadcast server"""
 
-        client.close()
-        return device_specification.name, register_client
+    def __init__(self, server: 'BroadcastServer') -> None:
+        self.server = server
+        self.transport: asyncio.DatagramTransport | None = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+        self.server._handle_client(self.transport, (data, addr))
 
 
 class BroadcastServer(Server):
     """UDP server that handle broadcast requests from devices and
     helps them find hub ip address in local network and port"""
 
-    def __init__(self, port: int, tcp_port: int) -> None:
+    def __init__(self,
+                 port: int,
+                 tcp_port: int,
+                 ip_refresh_interval: float = 5,
+                 rate_limit: int = 200,
+                 rate_period: float = 1) -> None:
         """Create new instance of UDP server.
 
             Args:
                 port(int): Port binding to server.
                 tcp_port(int): Port of tcp server.
+                ip_refresh_interval(float): Seconds between checks of local ip address.
+                rate_limit(int): Max number of replies to one source address in rate period, onboarding burst of
+                    devices sharing address must fit in it.
+                rate_period(float): Seconds rate limit is counted for.
         """
         self.port = port
         self.tcp_port = tcp_port
-        self.event = multiprocessing.Event()
-
-    def stop(self) -> None:
-        """Set even to stop server."""
-        self.event.set()
-
-    def run_server(self) -> None:
-        """Start UDP server."""
-        self.event.clear()
+        self.ip_refresh_interval = ip_refresh_interval
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.transport: asyncio.DatagramTransport | None = None
+        self.local_ip: str | None = None
+        self.reply: bytes = b''
+        # Source address -> (start of current rate period, replies sent in it)
+        self.replies: dict[str, tuple[float, int]] = {}
+        self._refresh_task: asyncio.Task | None = None
+        self._stopped: asyncio.Event | None = None
+
+    def _refresh_reply(self) -> None:
+        """Rebuild reply if local ip address is changed."""
+        local_ip = self.get_local_ip()
+        if local_ip != self.local_ip:
+            self.local_ip = local_ip
+            self.reply = json.dumps({'ip': local_ip, 'port': self.tcp_port}).encode()
+
+    async def _refresh(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.ip_refresh_interval)
+            self._refresh_reply()
+            # Forget sources which rate period is over
+            now = loop.time()
+            self.replies = {address: counter for address, counter in self.replies.items()
+                            if now - counter[0] < self.rate_period}
+
+    async def start(self) -> None:
+        """Bind UDP socket and start answering discovery requests in current event loop."""
+        loop = asyncio.get_running_loop()
         server = socket(AF_INET, SOCK_DGRAM, IPPROTO_UDP)
         server.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         server.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
         server.bind(('', self.port))
-        server.settimeout(5.0)  # Set timeout to prevent infinite sock.recv wait with no data
-        print('udp server started')
+        self._refresh_reply()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: BroadcastProtocol(self), sock=server)
+        self._refresh_task = asyncio.create_task(self._refresh())
+        self._stopped = asyncio.Event()
+        logger.info('Discovery server started', extra={'port': self.port})
 
-        while True:
-            if self.event.is_set():
-                print("udp server stop")
-                break
-            try:
-                request = server.recvfrom(1024)
-            except TimeoutError:
-                continue
-            except KeyboardInterrupt:
-                continue
-            print(request[0])
-            self._handle_client(server, request)
+    def stop(self) -> None:
+        """Close socket and stop server."""
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        if self._stopped is not None:
+            self._stopped.set()
+        logger.info('Discovery server stopped')
+
+    async def run_server(self) -> None:
+        """Start UDP server and wait until it is stopped."""
+        await self.start()
+        await self._stopped.wait()
+
+    def _allow(self, address: str) -> bool:
+        """Count reply to source address and check it fits rate limit.
+
+            Args:
+                address(str): Source ip address.
 
-    def _handle_client(self, sock: socket, client_data: str) -> None:
+            Returns:
+                bool: True if reply can be sent.
+        """
+        now = asyncio.get_running_loop().time()
+        period_start, count = self.replies.get(address, (now, 0))
+        if now - period_start >= self.rate_period:
+            period_start, count = now, 0
+        if count >= self.rate_limit:
+            return False
+        self.replies[address] = (period_start, count + 1)
+        return True
+
+    def _handle_client(self, transport: asyncio.DatagramTransport, client_data: tuple[bytes, tuple]) -> None:
         """Send to client tcp server address and port.
 
             Args:
-                sock(socket): UDP socket instance.
-                client_data(str): Data received from client.
+                transport(asyncio.DatagramTransport): UDP transport.
+                client_data(tuple[bytes, tuple]): Data received from client and client address.
         """
-        received_data = client_data[0]
+        start = time.perf_counter()
         client_addr = client_data[1]
-        print(f'Received from: {client_addr[0]}\n data: {received_data}')
-        return_dict = {'ip': self.get_local_ip(),
-                       'port': self.tcp_port}
-        time.sleep(1)
-        sock.sendto(json.dumps(return_dict).encode(), client_addr)
-        print(f'Response sent to server')
+        if not self._allow(client_addr[0]):
+            DISCOVERY_REQUESTS.labels('rate_limited').inc()
+            return
+        transport.sendto(self.reply, client_addr)
+        DISCOVERY_REQUESTS.labels('replied').inc()
+        DISCOVERY_REPLY_SECONDS.observe(time.perf_counter() - start)
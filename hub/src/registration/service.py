@@ -0,0 +1,214 @@
+import asyncio
+import logging
+from pydantic import BaseModel
+
+from .reconciler import Reconciler
+from .registrator import Registrator
+from .schemas import RegistrationEvent
+from .servers import BroadcastServer, TCPServer, PendingDevice
+from workers import WorkerLock
+
+logger = logging.getLogger('hub.registration')
+
+
+def log_failure(task: asyncio.Task) -> None:
+    """Done callback of background task, logs exception nobody awaits."""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('Registration task failed', exc_info=task.exception())
+
+
+class RegistrationService:
+    """Discovery responder and registration listener running for the whole application lifetime.
+
+    Every announced device is published to all operator sessions, any session can approve it by id."""
+
+    def __init__(self,
+                 discovery_port: int,
+                 registration_port: int,
+                 discovery_rate_limit: int = 200,
+                 subscriber_queue_size: int = 1000) -> None:
+        """Create new instance of registration service
+
+            Args:
+                discovery_port(int): UDP port devices broadcast discovery requests to.
+                registration_port(int): TCP port devices send their specification to.
+                discovery_rate_limit(int): Max discovery replies per second to one source address.
+                subscriber_queue_size(int): Max number of events waiting to be sent to one session.
+        """
+        self.discovery_port = discovery_port
+        self.registration_port = registration_port
+        self.discovery_rate_limit = discovery_rate_limit
+        self.subscriber_queue_size = subscriber_queue_size
+        self.broadcast_server: BroadcastServer | None = None
+        self.tcp_server: TCPServer | None = None
+        self.reconciler: Reconciler | None = None
+        self.pending: dict[str, PendingDevice] = {}
+        self.subscribers: set[asyncio.Queue] = set()
+        self.lock: WorkerLock | None = None
+        self._task: asyncio.Task | None = None
+        self._election: asyncio.Task | None = None
+
+    @property
+    def active(self) -> bool:
+        return self.tcp_server is not None
+
+    async def start(self, registrator: Registrator) -> None:
+        """Start discovery and registration servers in current event loop.
+
+            Args:
+                registrator(Registrator): Registrator used for every registration.
+        """
+        self.broadcast_server = BroadcastServer(self.discovery_port, self.registration_port,
+                                                rate_limit=self.discovery_rate_limit)
+        await self.broadcast_server.start()
+        self.tcp_server = TCPServer(asyncio.get_running_loop(), self.registration_port, registrator)
+        await self.tcp_server.start()
+        self._task = asyncio.create_task(self._collect())
+        self._task.add_done_callback(log_failure)
+        self.reconciler = Reconciler(registrator)
+        self.reconciler.start()
+
+    async def start_elected(self, registrator: Registrator, lock: WorkerLock, retry_interval: float = 5) -> None:
+        """Start servers if this hub worker holds lock, otherwise take them over when holder exits.
+
+        Ports are bound by one worker only and reconciler runs once, operator sessions are served by it.
+
+            Args:
+                registrator(Registrator): Registrator used for every registration.
+                lock(WorkerLock): Lock shared by workers of hub.
+                retry_interval(float): Seconds between attempts to take lock.
+        """
+        self.lock = lock
+        if lock.acquire():
+            await self.start(registrator)
+            return
+        logger.info('Registration is served by other worker', extra={'lock': lock.path})
+        self._election = asyncio.create_task(self._take_over(registrator, retry_interval))
+        self._election.add_done_callback(log_failure)
+
+    async def _take_over(self, registrator: Registrator, retry_interval: float) -> None:
+        while not self.lock.acquire():
+            await asyncio.sleep(retry_interval)
+        logger.info('Registration is taken over by this worker')
+        await self.start(registrator)
+
+    def stop(self) -> None:
+        if self._election is not None:
+            self._election.cancel()
+            self._election = None
+        if self.reconciler is not None:
+            self.reconciler.stop()
+            self.reconciler = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.tcp_server is not None:
+            self.tcp_server.close()
+            self.tcp_server = None
+        if self.broadcast_server is not None:
+            self.broadcast_server.stop()
+            self.broadcast_server = None
+        for pending_device in self.pending.values():
+            if pending_device.watcher is not None:
+                pending_device.watcher.cancel()
+            pending_device.connection.close()
+        self.pending.clear()
+        if self.lock is not None:
+            self.lock.release()
+
+    @staticmethod
+    def _event(event: str, pending_device: PendingDevice) -> RegistrationEvent:
+        return RegistrationEvent(event=event,
+                                 id=pending_device.id,
+                                 name=pending_device.specification.name,
+                                 type=pending_device.specification.type)
+
+    @staticmethod
+    def notify(queue: asyncio.Queue, message: BaseModel) -> None:
+        """Put message to session queue, slow session loses its oldest messages instead of blocking others.
+
+            Args:
+                queue(asyncio.Queue): Session queue.
+                message(BaseModel): Message to send.
+        """
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(message)
+
+    def _publish(self, event: RegistrationEvent) -> None:
+        for queue in self.subscribers:
+            self.notify(queue, event)
+
+    async def _collect(self) -> None:
+        """Keep announced devices pending and publish them to sessions."""
+        async for pending_device in self.tcp_server.announced():
+            if pending_device is None:
+                continue
+            self.pending[pending_device.id] = pending_device
+            pending_device.watcher = asyncio.create_task(self._watch(pending_device))
+            pending_device.watcher.add_done_callback(log_failure)
+            self._publish(self._event('announced', pending_device))
+
+    async def _watch(self, pending_device: PendingDevice) -> None:
+        """Drop pending device which closed its connection before approval."""
+        await pending_device.connection.wait_closed()
+        if self.pending.pop(pending_device.id, None) is not None:
+            pending_device.connection.close()
+            self._publish(self._event('disconnected', pending_device))
+
+    @staticmethod
+    async def _take(pending_device: PendingDevice) -> None:
+        """Stop watching connection of device leaving pending ones, registration reads from it."""
+        watcher = pending_device.watcher
+        if watcher is not None:
+            pending_device.watcher = None
+            watcher.cancel()
+            # Stream allows one reader, watcher must be gone before confirmation is read
+            await asyncio.gather(watcher, return_exceptions=True)
+
+    def subscribe(self) -> asyncio.Queue:
+        """Subscribe session to registration events, devices pending already are sent first.
+
+            Returns:
+                asyncio.Queue: Queue session receives events from.
+        """
+        queue = asyncio.Queue(self.subscriber_queue_size)
+        for pending_device in self.pending.values():
+            self.notify(queue, self._event('announced', pending_device))
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.subscribers.discard(queue)
+
+    async def approve(self, pending_id: str) -> bool | None:
+        """Register pending device, result is published to all sessions.
+
+            Args:
+                pending_id(str): Id of pending device.
+
+            Returns:
+                bool | None: True if device is registered, False if not, None if there is no such pending device.
+        """
+        # Taken out before registration, so device can't be approved twice
+        pending_device = self.pending.pop(pending_id, None)
+        if pending_device is None:
+            return None
+        await self._take(pending_device)
+        result = await self.tcp_server.register_client(pending_device)
+        self._publish(self._event('registered' if result else 'failed', pending_device))
+        return result
+
+    async def approve_all(self) -> list[bool]:
+        """Register all pending devices by bulk requests, results are published to all sessions.
+
+            Returns:
+                list[bool]: For every device True if it is registered or False if not.
+        """
+        pending_devices = list(self.pending.values())
+        self.pending.clear()
+        await asyncio.gather(*[self._take(pending_device) for pending_device in pending_devices])
+        results = await self.tcp_server.register_clients(pending_devices)
+        for pending_device, result in zip(pending_devices, results):
+            self._publish(self._event('registered' if result else 'failed', pending_device))
+        return results
@@ -1,22 +1,22 @@
 from registration.servers import BroadcastServer
-import multiprocessing
-import time
+import asyncio
 import datetime
+import logging
+from config import DISCOVERY_PORT, DISCOVERY_RATE_LIMIT, REGISTRATION_PORT, LOG_LEVEL
+from logs import setup_logging, stop_logging
 
 
 def main():
+    setup_logging(LOG_LEVEL)
     start = datetime.datetime.now()
-    udp_server = BroadcastServer(15555, 12222)
-    process = multiprocessing.Process(target=udp_server.run_server)
+    udp_server = BroadcastServer(DISCOVERY_PORT, REGISTRATION_PORT, rate_limit=DISCOVERY_RATE_LIMIT)
     try:
-        process.start()
-
-        while True:
-            time.sleep(1)
+        asyncio.run(udp_server.run_server())
     except KeyboardInterrupt:
-        udp_server.stop()
-        print(datetime.datetime.now() - start)
-        process.join()
+        logging.getLogger('hub').info('Discovery server interrupted',
+                                      extra={'uptime': str(datetime.datetime.now() - start)})
+    finally:
+        stop_logging()
 
 if __name__ == '__main__':
     main()
@@ -1,3 +1,4 @@
+from datetime import datetime
 from pydantic import BaseModel
 from typing import Literal
 
@@ -10,7 +11,15 @@ class ErrorSchema(BaseModel):
     type: str
     message: str
 
+class ShadowSchema(BaseModel):
+    reported: dict[str, bool | int | float | str]
+    desired: dict[str, bool | int | float | str]
+    delta: dict[str, bool | int | float | str]
+    version: int
+    updated_at: datetime
+
 class DeviceResponseSchema(BaseModel):
     name: str
     type: Literal["device", "sensor"]
-    fields: list[str]
\ No newline at end of file
+    fields: list[str]
+    shadow: ShadowSchema | None = None
\ No newline at end of file
@@ -0,0 +1,136 @@
+import math
+from typing import Callable
+
+Checker = Callable[[object], str | None]
+
+TYPE_CHECKS = {
+    'int': lambda value: isinstance(value, int) and not isinstance(value, bool),
+    'float': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    'str': lambda value: isinstance(value, str),
+    'bool': lambda value: isinstance(value, bool),
+}
+
+# Relative tolerance for step check of float values
+STEP_TOLERANCE = 1e-9
+
+
+def compile_field(field: dict) -> Checker:
+    """Build checker for one field specification, only restrictions defined in field are checked.
+
+        Args:
+            field(dict): Field specification with type and optional min, max, enum and step.
+
+        Returns:
+            Checker: Function returning error message for invalid value or None for valid one.
+    """
+    field_type = field['type']
+    type_check = TYPE_CHECKS[field_type]
+    checks: list[Checker] = []
+
+    minimum, maximum = field.get('min'), field.get('max')
+    if field_type in ('int', 'float') and (minimum is not None or maximum is not None):
+        low = -math.inf if minimum is None else minimum
+        high = math.inf if maximum is None else maximum
+        range_error = f'Value must be between {minimum} and {maximum}'
+        checks.append(lambda value: None if low <= value <= high else range_error)
+
+    enum = field.get('enum')
+    if enum is not None:
+        # Options of other type are dropped, so True doesn't allow 1 in int field
+        allowed = frozenset(option for option in enum if type_check(option))
+        enum_error = f'Value must be one of {enum}'
+        checks.append(lambda value: None if value in allowed else enum_error)
+
+    step = field.get('step')
+    if step is not None and field_type in ('int', 'float'):
+        base = minimum or 0
+        step_error = f'Value must be multiple of {step} starting from {base}'
+
+        def check_step(value):
+            steps = (value - base) / step
+            return None if abs(steps - round(steps)) <= STEP_TOLERANCE * max(1, abs(steps)) else step_error
+        checks.append(check_step)
+
+    type_error = f'Value must be {field_type}'
+
+    def check(value):
+        if not type_check(value):
+            return type_error
+        for restriction in checks:
+            error = restriction(value)
+            if error is not None:
+                return error
+        return None
+    return check
+
+
+class DeviceValidator:
+    """Compiled checkers for all fields of one device."""
+
+    def __init__(self, fields: list[dict]) -> None:
+        """Compile device fields
+
+            Args:
+                fields(list[dict]): Field specifications of device.
+        """
+        self.checkers: dict[str, Checker] = {field['name']: compile_field(field) for field in fields}
+
+    def check(self, name: str, value) -> str | None:
+        """Check value of one field.
+
+            Args:
+                name(str): Field name.
+                value: Value to check.
+
+            Returns:
+                str | None: Error message or None if value is valid.
+        """
+        checker = self.checkers.get(name)
+        if checker is None:
+            return f'Device has not "{name}" field'
+        return checker(value)
+
+    def is_valid(self, values: dict) -> bool:
+        """Check several field values at once.
+
+            Args:
+                values(dict): Field values by field name.
+
+            Returns:
+                bool: True if every value belongs to device field and passes its checks.
+        """
+        checkers = self.checkers
+        for name, value in values.items():
+            checker = checkers.get(name)
+            if checker is None or checker(value) is not None:
+                return False
+        return True
+
+
+class ValidatorCache:
+    """Compiled device validators by device id, entry must be invalidated when device fields change."""
+
+    def __init__(self) -> None:
+        self.validators: dict[str, DeviceValidator] = {}
+
+    def get(self, device: dict) -> DeviceValidator:
+        """Get validator of device, compiling it on first use.
+
+            Args:
+                device(dict): Device document.
+
+            Returns:
+                DeviceValidator: Validator for device fields.
+        """
+        device_id = str(device['_id'])
+        validator = self.validators.get(device_id)
+        if validator is None:
+            validator = DeviceValidator(device['fields'])
+            self.validators[device_id] = validator
+        return validator
+
+    def invalidate(self, device_id: str) -> None:
+        self.validators.pop(device_id, None)
+
+    def clear(self) -> None:
+        self.validators.clear()
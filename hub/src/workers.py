@@ -0,0 +1,49 @@
+import fcntl
+import os
+from typing import TextIO
+
+
+class WorkerLock:
+    """Exclusive lock of file electing one hub worker process on the host for work which must run once,
+    e.g. servers bound to fixed ports. Lock is released by system when process exits, so other worker can
+    take it over."""
+
+    def __init__(self, path: str) -> None:
+        """Create new worker lock
+
+            Args:
+                path(str): Lock file, the same for all workers of one hub.
+        """
+        self.path = path
+        self._file: TextIO | None = None
+
+    @property
+    def held(self) -> bool:
+        return self._file is not None
+
+    def acquire(self) -> bool:
+        """Take lock without waiting.
+
+            Returns:
+                bool: True if lock is held by this process.
+        """
+        if self._file is not None:
+            return True
+        file = open(self.path, 'a')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return False
+        # Pid of worker holding lock, for operator
+        file.truncate(0)
+        file.write(f'{os.getpid()}\n')
+        file.flush()
+        self._file = file
+        return True
+
+    def release(self) -> None:
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None